@@ -0,0 +1,125 @@
+from gameconst import *
+from game_engine import GameEngine, GameEvent, DIRECTIONS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ArrayGameEngine(GameEngine):
+    """A GameEngine keeping the tiles and the bomb counters in NumPy grids.
+    The explosions of all the bombs due in a turn are computed on whole
+    arrays at once: the blast of every bomb of a wave is a boolean mask,
+    and the bombs it reaches form the next wave (chain reactions).
+    An explosion goes through free tiles, soft blocks and bombs, and is only
+    stopped by the hard blocks, which never change: the order in which the
+    bombs explode does not matter, and the results are the same as with
+    GameEngine. Only the order of the events of a turn may differ.
+    It is worth it on big boards with many bombs (NumPy is required)."""
+
+    def __init__(self, width, height, map_init, positions):
+        super(ArrayGameEngine, self).__init__(width, height, map_init, positions)
+        # the content of each tile
+        self.map = numpy.array(map_init, dtype=numpy.int8).reshape(height, width)
+        # the hard blocks, which stop the explosions
+        self.hard_blocks = self.map == TileContent.HARD_BLOCK
+        # the counter of each bomb (only meaningful on the bomb tiles)
+        self.timers = numpy.zeros((height, width), dtype=numpy.int16)
+        # the order in which the bombs were posed
+        self.bomb_order = numpy.zeros((height, width), dtype=numpy.int64)
+        self._n_bombs_posed = 0
+        # (the initial bombs are in the same order as in GameEngine)
+        for x, y, i in self.bombs:
+            self._put_bomb(x, y, i)
+        # the bombs are only kept in the grids
+        self.bombs = None
+
+    def _put_bomb(self, x, y, counter):
+        self.map[y, x] = TileContent.BOMB
+        self.timers[y, x] = counter
+        self._n_bombs_posed += 1
+        self.bomb_order[y, x] = self._n_bombs_posed
+
+    def get_bombs(self):
+        """Get the list of active bombs (x, y, counter), as in GameEngine"""
+        ys, xs = numpy.nonzero(self.map == TileContent.BOMB)
+        order = numpy.argsort(self.bomb_order[ys, xs], kind='mergesort')
+        return [(int(xs[i]), int(ys[i]), int(self.timers[ys[i], xs[i]]))
+                for i in order]
+
+    def get_state(self):
+        return (self.turn,
+            tuple(tuple(int(c) for c in row) for row in self.map),
+            tuple((p.x, p.y, p.alive) for p in self.players),
+            tuple(self.get_bombs()))
+
+    def set_state(self, state):
+        super(ArrayGameEngine, self).set_state(state)
+        self.map = numpy.array(self.map, dtype=numpy.int8)
+        self.timers[:] = 0
+        self.bomb_order[:] = 0
+        self._n_bombs_posed = 0
+        for x, y, i in self.bombs:
+            self._put_bomb(x, y, i)
+        self.bombs = None
+
+    def is_available(self, x, y):
+        content = self.map[y, x]
+        return (content == TileContent.FREE or content == TileContent.BOMB)
+
+    def add_bomb(self, x, y):
+        self._put_bomb(x, y, BOMB_COUNTER_INIT)
+
+    def update_bombs(self):
+        """Update the bomb counters and trigger the explosions of the bombs
+        whose counter is zero"""
+        bombs = self.map == TileContent.BOMB
+        self.timers[bombs] -= 1
+        due = bombs & (self.timers <= 0)
+        if due.any():
+            self.trigger_explosions(due)
+
+    def blast_mask(self, xs, ys):
+        """Get the mask of the tiles reached by the explosions of the bombs
+        at the given coordinates (arrays)."""
+        mask = numpy.zeros((self.height, self.width), dtype=bool)
+        mask[ys, xs] = True
+        for dx, dy in DIRECTIONS:
+            # the rays which are not stopped yet
+            going = numpy.ones(len(xs), dtype=bool)
+            for i in xrange(1, BOMB_RADIUS + 1):
+                x = xs + i * dx
+                y = ys + i * dy
+                going &= (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+                x = x[going]
+                y = y[going]
+                mask[y, x] = True
+                # a hard block is reached, but stops the ray
+                going[going] = ~self.hard_blocks[y, x]
+        return mask
+
+    def trigger_explosions(self, due):
+        """Explode the bombs of the given mask, and the bombs they reach."""
+        bombs = self.map == TileContent.BOMB
+        exploded = numpy.zeros_like(due)
+        blasted = numpy.zeros_like(due)
+        wave = due
+        while wave.any():
+            exploded |= wave
+            ys, xs = numpy.nonzero(wave)
+            mask = self.blast_mask(xs, ys)
+            blasted |= mask
+            wave = mask & bombs & ~exploded
+        # the bombs are gone, and so are the soft blocks within the blasts
+        destroyed = blasted & (self.map == TileContent.SOFT_BLOCK)
+        self.map[exploded] = TileContent.FREE
+        self.map[destroyed] = TileContent.FREE
+        for y, x in zip(*numpy.nonzero(exploded)):
+            self._emit(GameEvent.BOMB_EXPLODED, int(x), int(y))
+        for y, x in zip(*numpy.nonzero(destroyed)):
+            self._emit(GameEvent.TILE_DESTROYED, int(x), int(y))
+        # kill any player within the blasts
+        for p in self.players:
+            if p.alive and blasted[p.y, p.x]:
+                self.kill(p)
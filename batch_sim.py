@@ -0,0 +1,190 @@
+"""Headless simulation of many games at once, e.g. to evaluate bot policies.
+
+The games are stepped in lockstep: each call to BatchSimulator.step executes
+one turn of every game from an array of actions, with the same rules as
+GameEngine, and without any server, socket or rendering.
+NumPy is required."""
+from gameconst import *
+import mapgen
+
+import numpy
+import random
+
+# the moves: action -> (dx, dy)
+MOVES = (
+    (Action.MOVE_RIGHT, 1, 0),
+    (Action.MOVE_LEFT, -1, 0),
+    (Action.MOVE_UP, 0, -1),
+    (Action.MOVE_DOWN, 0, 1),
+)
+
+
+class BatchSimulator(object):
+    """N independent games kept in stacked arrays:
+    - maps: the content of the tiles, (N x height x width)
+    - timers: the bomb counters (only meaningful on the bomb tiles)
+    - xs, ys, alive: the positions and the status of the players (N x players)
+    - turns: the turn number of each game
+    - done: tells whether each game is over.
+    The players start in the corners of the board, as in a party.
+    Generating a map takes longer than a turn of a thousand games, so the
+    maps are generated once, and each new game is played on a map drawn
+    from this pool.
+    The explosions of a turn are computed for all the games at once, by
+    shifting the blast masks in the four directions (see GameEngine for
+    why the order of the explosions does not matter)."""
+    # the reward of a player when it is killed / when it wins a game
+    DEATH_REWARD = -1.0
+    WIN_REWARD = 1.0
+
+    def __init__(self, n_games, n_players=NUM_PLAYERS,
+                 width=BOARD_WIDTH, height=BOARD_HEIGHT,
+                 max_turns=None, auto_reset=True, n_maps=256, seed=None):
+        """n_maps: the number of maps the games are drawn from
+        max_turns: a game still running after that many turns is a draw
+        (None for no limit)
+        auto_reset: start a new game in place of each game over,
+        on the next step"""
+        self.n_games = n_games
+        self.n_players = n_players
+        self.width = width
+        self.height = height
+        self.max_turns = max_turns
+        self.auto_reset = auto_reset
+        if seed is not None:
+            # (the maps are generated with the random module)
+            random.seed(seed)
+        self.random = numpy.random.RandomState(seed)
+        # the start positions: the corners of the board, then the edges
+        self.positions = mapgen.start_positions(width, height, n_players)
+        self.map_pool = numpy.array([mapgen.generate(width, height, self.positions)
+            for i in xrange(n_maps)], dtype=numpy.int8).reshape(n_maps, height, width)
+        shape = (n_games, height, width)
+        self.maps = numpy.zeros(shape, dtype=numpy.int8)
+        self.hard_blocks = numpy.zeros(shape, dtype=bool)
+        self.timers = numpy.zeros(shape, dtype=numpy.int16)
+        self.xs = numpy.zeros((n_games, n_players), dtype=numpy.intp)
+        self.ys = numpy.zeros((n_games, n_players), dtype=numpy.intp)
+        self.alive = numpy.zeros((n_games, n_players), dtype=bool)
+        self.turns = numpy.zeros(n_games, dtype=numpy.int64)
+        self.done = numpy.zeros(n_games, dtype=bool)
+        # the index of each game, to index the arrays game by game
+        self._games = numpy.arange(n_games)
+        self.reset()
+
+    def reset(self, games=None):
+        """Start new games in place of the given games (all if None)"""
+        if games is None:
+            games = self._games
+        games = numpy.asarray(games, dtype=numpy.intp)
+        self.maps[games] = self.map_pool[
+            self.random.randint(len(self.map_pool), size=len(games))]
+        self.hard_blocks[games] = self.maps[games] == TileContent.HARD_BLOCK
+        self.timers[games] = 0
+        for p, (x, y) in enumerate(self.positions):
+            self.xs[games, p] = x
+            self.ys[games, p] = y
+        self.alive[games] = True
+        self.turns[games] = 0
+        self.done[games] = False
+
+    def step(self, actions):
+        """Execute one turn of every game that is not over, given the
+        actions of the players (N x players array of Action values).
+        Returns the rewards of the players (N x players) and the done flags
+        of the games (N): a game is done on the turn it is over."""
+        if self.auto_reset and self.done.any():
+            self.reset(numpy.nonzero(self.done)[0])
+        actions = numpy.asarray(actions)
+        running = ~self.done
+        alive_before = self.alive.copy()
+        self.commit_actions(actions, running)
+        self.update_bombs(running)
+        self.turns[running] += 1
+        # the players killed this turn, and the games over
+        killed = alive_before & ~self.alive
+        n_alive = self.alive.sum(axis=1)
+        over = running & (n_alive <= 1)
+        if self.max_turns is not None:
+            over |= running & (self.turns >= self.max_turns)
+        self.done |= over
+        rewards = numpy.zeros(self.alive.shape, dtype=numpy.float32)
+        rewards[killed] = self.DEATH_REWARD
+        # the last player standing wins
+        winners = over & (n_alive == 1)
+        rewards[winners] += self.WIN_REWARD * self.alive[winners]
+        return rewards, over
+
+    def commit_actions(self, actions, running):
+        """Apply the actions of the players, in the order of their numbers
+        (a player cannot pose a bomb where another one just did)"""
+        games = self._games
+        maps = self.maps
+        for p in xrange(self.n_players):
+            action = actions[:, p]
+            able = running & self.alive[:, p]
+            x = self.xs[:, p]
+            y = self.ys[:, p]
+            # pose a bomb on a free tile
+            pose = able & (action == Action.POSE_BOMB) & (maps[games, y, x] == TileContent.FREE)
+            maps[games[pose], y[pose], x[pose]] = TileContent.BOMB
+            self.timers[games[pose], y[pose], x[pose]] = BOMB_COUNTER_INIT
+            # move to a free tile or a bomb, within the board
+            for move, dx, dy in MOVES:
+                moving = able & (action == move)
+                if not moving.any():
+                    continue
+                nx = x + dx
+                ny = y + dy
+                moving &= (nx >= 0) & (nx < self.width) & (ny >= 0) & (ny < self.height)
+                g = games[moving]
+                content = maps[g, ny[moving], nx[moving]]
+                moving[moving] = ((content == TileContent.FREE) |
+                                  (content == TileContent.BOMB))
+                x[moving] = nx[moving]
+                y[moving] = ny[moving]
+
+    def update_bombs(self, running):
+        """Update the bomb counters and trigger the explosions"""
+        bombs = (self.maps == TileContent.BOMB) & running[:, None, None]
+        self.timers[bombs] -= 1
+        due = bombs & (self.timers <= 0)
+        if due.any():
+            self.trigger_explosions(due, bombs)
+
+    def blast_mask(self, sources):
+        """Get the mask of the tiles reached by the explosions from the
+        given tiles (N x height x width mask)"""
+        mask = sources.copy()
+        open_tiles = ~self.hard_blocks
+        for i in xrange(4):
+            ray = sources
+            for r in xrange(BOMB_RADIUS):
+                shifted = numpy.zeros_like(ray)
+                if i == 0:
+                    shifted[:, :, 1:] = ray[:, :, :-1]
+                elif i == 1:
+                    shifted[:, :, :-1] = ray[:, :, 1:]
+                elif i == 2:
+                    shifted[:, :-1, :] = ray[:, 1:, :]
+                else:
+                    shifted[:, 1:, :] = ray[:, :-1, :]
+                # the hard blocks stop the rays
+                ray = shifted & open_tiles
+                mask |= ray
+        return mask
+
+    def trigger_explosions(self, due, bombs):
+        """Explode the bombs of the given mask, and the bombs they reach"""
+        exploded = numpy.zeros_like(due)
+        blasted = numpy.zeros_like(due)
+        wave = due
+        while wave.any():
+            exploded |= wave
+            mask = self.blast_mask(wave)
+            blasted |= mask
+            wave = mask & bombs & ~exploded
+        # the bombs are gone, and so are the soft blocks within the blasts
+        self.maps[exploded | (blasted & (self.maps == TileContent.SOFT_BLOCK))] = TileContent.FREE
+        # kill any player within the blasts
+        self.alive &= ~blasted[self._games[:, None], self.ys, self.xs]
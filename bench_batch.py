@@ -0,0 +1,32 @@
+"""Benchmark of the batched simulation, with random players.
+
+Usage: python bench_batch.py [n_games] [n_steps]"""
+from gameconst import *
+from batch_sim import BatchSimulator
+
+import numpy
+import sys
+import time
+
+ACTIONS = numpy.array([Action.DO_NOTHING, Action.MOVE_RIGHT, Action.MOVE_LEFT,
+    Action.MOVE_UP, Action.MOVE_DOWN, Action.POSE_BOMB])
+
+def main(n_games, n_steps):
+    print "%d games in lockstep, %d steps" % (n_games, n_steps)
+    sim = BatchSimulator(n_games, max_turns=1000, seed=0)
+    rng = numpy.random.RandomState(0)
+    # (drawing the actions is not part of the simulation)
+    actions = ACTIONS[rng.randint(len(ACTIONS), size=(64, n_games, sim.n_players))]
+    n_over = 0
+    t = time.time()
+    for i in xrange(n_steps):
+        rewards, done = sim.step(actions[i % len(actions)])
+        n_over += done.sum()
+    t = time.time() - t
+    turns = n_games * n_steps
+    print "%d games over" % n_over
+    print "%.0f turns/s (%.1fM turns/min)" % (turns / t, turns / t * 60 / 1e6)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 500)
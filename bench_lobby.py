@@ -0,0 +1,51 @@
+"""Benchmark of the lobby packet encoding with many pending parties.
+
+Usage: python bench_lobby.py [n_parties]"""
+import packets
+
+import random
+import socket
+import struct
+import sys
+import timeit
+
+def encode_reference(parties):
+    """The lobby packet encoding without any cache (appending each record)"""
+    data = struct.pack("<I", len(parties))
+    for p in parties:
+        record = struct.pack("<I", p.id)
+        record += socket.inet_aton(p.ip)
+        record += struct.pack("<HII", p.port, p.n_players, p.max_players)
+        data += record
+    return data
+
+def make_parties(n):
+    return [packets.PartyInfo(i, '127.0.0.1', random.randint(1024, 65535),
+        random.randint(0, 3), 4) for i in xrange(n)]
+
+def bench(label, fun, number):
+    t = min(timeit.repeat(fun, repeat=3, number=number)) / number
+    print "%-40s %10.3f ms" % (label, t * 1000)
+    return t
+
+def main(n_parties):
+    print "lobby packet with %d pending parties" % n_parties
+    parties = make_parties(n_parties)
+    assert packets.LobbyPacket(parties).encode() == encode_reference(parties)
+    bench("reference (no cache)", lambda: encode_reference(parties), 5)
+    # every record encoded again (as if every party changed)
+    def cold():
+        for p in parties:
+            p._encoded = None
+        return packets.LobbyPacket(parties).encode()
+    bench("cold (every record encoded)", cold, 5)
+    # the common case: a single party changed since the last tick
+    def one_changed():
+        i = random.randrange(n_parties)
+        p = parties[i]
+        parties[i] = packets.PartyInfo(p.id, p.ip, p.port, (p.n_players + 1) % 4, 4)
+        return packets.LobbyPacket(parties).encode()
+    bench("warm (one record changed)", one_changed, 20)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
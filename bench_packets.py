@@ -0,0 +1,268 @@
+"""Benchmark of the packet codec: the encoding and the decoding of each
+packet type, for several payload sizes, and the framing of the packets
+read from an in-memory buffer and from a socket pair.
+
+For each case, it prints:
+- the packets per second and the payload megabytes per second
+- the objects allocated per packet: the container objects (the ones the
+garbage collector tracks) still allocated once the packets are built,
+the results being kept.
+The packets are drawn at random with a fixed seed, so that two runs time
+the same packets.
+
+The results can be saved as a baseline, and a later run compared to it:
+the cases more than --threshold slower than the baseline are reported
+(and the exit status is 1).
+
+Usage: python bench_packets.py [--save baseline.json] [--compare baseline.json]
+                               [--filter substring] [--threshold 0.1]"""
+import packets
+from gameconst import *
+
+import argparse
+import gc
+import json
+import platform
+import random
+import socket
+import sys
+import time
+import timeit
+import zlib
+
+SEED = 42
+# the number of different packets timed per case
+N_SAMPLES = 64
+# min time of a timed run (in s), and the number of runs (the best is kept)
+MIN_TIME = 0.2
+REPEAT = 5
+# the bytes sent at once on the socket pair (less than its buffers)
+SOCKET_BATCH_SIZE = 64 * 1024
+
+
+def drawer(PacketClass, *args):
+    """Make a function drawing a packet of the given class"""
+    return lambda: PacketClass.random(*args)
+
+# (name, packet class, a function drawing a packet)
+CODEC_CASES = [
+    ("ActionRequest", packets.ActionRequestPacket,
+        drawer(packets.ActionRequestPacket)),
+    ("ActionsCommit 4p", packets.ActionsCommitPacket,
+        drawer(packets.ActionsCommitPacket, 4)),
+    ("ActionsCommit 64p", packets.ActionsCommitPacket,
+        drawer(packets.ActionsCommitPacket, 64)),
+    ("ActionsBatch 256x4", packets.ActionsBatchPacket,
+        drawer(packets.ActionsBatchPacket, 256, 4)),
+    ("PartyStatus", packets.PartyStatusPacket,
+        drawer(packets.PartyStatusPacket)),
+    ("Init 17x15", packets.InitPacket,
+        drawer(packets.InitPacket, 17, 15, 4)),
+    ("Init 51x45", packets.InitPacket,
+        drawer(packets.InitPacket, 51, 45, 4)),
+    ("Init 201x201", packets.InitPacket,
+        drawer(packets.InitPacket, 201, 201, 16)),
+    ("Lobby 10", packets.LobbyPacket,
+        drawer(packets.LobbyPacket, 10)),
+    ("Lobby 1000", packets.LobbyPacket,
+        drawer(packets.LobbyPacket, 1000)),
+    ("LobbyUpdate 100", packets.LobbyUpdatePacket,
+        drawer(packets.LobbyUpdatePacket, 100)),
+    ("PartyPage 10", packets.PartyPagePacket,
+        drawer(packets.PartyPagePacket, 10)),
+    ("StateSnapshot 4k", packets.StateSnapshotPacket,
+        drawer(packets.StateSnapshotPacket, 4096)),
+]
+
+# (name, a function drawing a game packet)
+FRAME_CASES = [
+    ("mixed", packets.GamePacket.random),
+    ("ActionsCommit 4p", lambda: packets.GamePacket(packets.PacketType.ACTION,
+        packets.ActionsCommitPacket.random(4).encode())),
+    ("ActionRequest", lambda: packets.ActionRequestPacket.random().wrap()),
+    ("Init 51x45", lambda: packets.InitPacket.random(51, 45, 4).wrap()),
+]
+
+
+def draw(name, fun):
+    """Draw N_SAMPLES items with fun, seeded by the case name"""
+    random.seed(SEED ^ zlib.crc32(name))
+    return [fun() for i in xrange(N_SAMPLES)]
+
+def time_per_op(fun, n_ops):
+    """The best time of a call to fun (which does n_ops operations),
+    divided by n_ops"""
+    number = 1
+    while True:
+        t = timeit.timeit(fun, number=number)
+        if t >= MIN_TIME:
+            break
+        number *= 2 if t <= 0 else max(2, int(MIN_TIME / t) + 1)
+    best = min(timeit.repeat(fun, repeat=REPEAT, number=number))
+    return best / (number * n_ops)
+
+def objects_per_op(fun, items):
+    """The number of tracked objects left allocated per call to fun"""
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        results = [fun(item) for item in items]
+        after = gc.get_count()[0]
+    finally:
+        gc.enable()
+    # (the results list itself does not count)
+    return max(0, after - before - 1) / float(len(results))
+
+def measure(fun, items, size):
+    """Time fun over the items, which total size payload bytes"""
+    def run():
+        for item in items:
+            fun(item)
+    t = time_per_op(run, len(items))
+    return {
+        'ops_per_s': 1.0 / t,
+        'mb_per_s': size / float(len(items)) / t / 1e6,
+        'objects_per_op': objects_per_op(fun, items),
+        'payload_bytes': size // len(items),
+    }
+
+def bench_codec(name, PacketClass, draw_packet):
+    sub_packets = draw(name, draw_packet)
+    payloads = [p.encode() for p in sub_packets]
+    size = sum(len(p) for p in payloads)
+    # the payloads as read by a PacketReader
+    views = [memoryview(p) for p in payloads]
+    return [
+        ("encode " + name, measure(lambda p: p.encode(), sub_packets, size)),
+        ("decode " + name, measure(PacketClass.decode, payloads, size)),
+        ("decode " + name + " (view)", measure(PacketClass.decode, views, size)),
+    ]
+
+def bench_frames(name, draw_packet):
+    game_packets = draw(name, draw_packet)
+    frames = [p.encode() for p in game_packets]
+    size = sum(len(f) for f in frames)
+    stream = "".join(frames)
+    results = []
+    # frame every packet from scratch
+    def frame(p):
+        p._encoded = None
+        return p.encode()
+    results.append(("frame " + name, measure(frame, game_packets, size)))
+    # split an in-memory stream into packets
+    def split(stream):
+        reader = packets.PacketReader(None)
+        reader.feed(stream)
+        return list(reader.buffered_packets())
+    stats = measure(split, [stream], size)
+    results.append(("read " + name + " (buffer)", per_packet(stats, len(frames))))
+    # send over a socket pair, read with GamePacket.recv and a PacketReader
+    a, b = socket.socketpair()
+    try:
+        batches = make_batches(frames)
+        def recv():
+            received = []
+            for batch, n in batches:
+                a.sendall(batch)
+                for i in xrange(n):
+                    received.append(packets.GamePacket.recv(b))
+            return received
+        stats = measure(lambda x: recv(), [None], size)
+        results.append(("recv " + name + " (socketpair)", per_packet(stats, len(frames))))
+        reader = packets.PacketReader(b)
+        def read():
+            received = []
+            for batch, n in batches:
+                a.sendall(batch)
+                expected = len(received) + n
+                while len(received) < expected:
+                    received.extend(reader.recv_packets())
+            return received
+        stats = measure(lambda x: read(), [None], size)
+        results.append(("read " + name + " (socketpair)", per_packet(stats, len(frames))))
+    finally:
+        a.close()
+        b.close()
+    return results
+
+def make_batches(frames):
+    """Group the frames into (bytes, number of frames) batches which fit in
+    the buffers of a socket pair"""
+    batches = []
+    batch = []
+    for f in frames:
+        if batch and sum(len(x) for x in batch) + len(f) > SOCKET_BATCH_SIZE:
+            batches.append(("".join(batch), len(batch)))
+            batch = []
+        batch.append(f)
+    batches.append(("".join(batch), len(batch)))
+    return batches
+
+def per_packet(stats, n_packets):
+    """Scale the stats of an operation on n_packets packets to a packet"""
+    stats['ops_per_s'] *= n_packets
+    stats['objects_per_op'] /= float(n_packets)
+    stats['payload_bytes'] //= n_packets
+    return stats
+
+def run(name_filter=None):
+    results = []
+    for name, PacketClass, draw_packet in CODEC_CASES:
+        if name_filter is None or name_filter in name:
+            results.extend(bench_codec(name, PacketClass, draw_packet))
+    for name, draw_packet in FRAME_CASES:
+        if name_filter is None or name_filter in name:
+            results.extend(bench_frames(name, draw_packet))
+    return results
+
+def print_results(results, baseline=None, threshold=0.1):
+    """Print the results (against the baseline if any), and return the
+    names of the cases slower than the baseline by more than threshold"""
+    regressions = []
+    print "%-36s %8s %12s %10s %8s %8s" % ("case", "bytes", "ops/s", "MB/s",
+        "objs/op", "vs base")
+    for name, stats in results:
+        ratio = ""
+        base = baseline.get(name) if baseline else None
+        if base:
+            speedup = stats['ops_per_s'] / base['ops_per_s']
+            ratio = "%.2fx" % speedup
+            if speedup < 1 - threshold:
+                ratio += " !"
+                regressions.append(name)
+        print "%-36s %8d %12.0f %10.1f %8.1f %8s" % (name,
+            stats['payload_bytes'], stats['ops_per_s'], stats['mb_per_s'],
+            stats['objects_per_op'], ratio)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Packet codec benchmark")
+    parser.add_argument("--save", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare to this JSON baseline")
+    parser.add_argument("--filter", help="only run the cases with this in their name")
+    parser.add_argument("--threshold", type=float, default=0.1,
+        help="the slow-down reported as a regression (default: 0.1)")
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    results = run(args.filter)
+    regressions = print_results(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'seed': SEED,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+                'results': dict(results),
+            }, f, indent=1, sort_keys=True)
+    if regressions:
+        print "%d case(s) slower than the baseline: %s" % (len(regressions),
+            ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Benchmark of the replay seeks, against the size of the replay file,
+for several keyframe intervals.
+
+Usage: python bench_replay.py [n_turns]"""
+from gameconst import *
+import mapgen
+import packets
+import replay
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ACTIONS = ([Action.DO_NOTHING] * 20 + [Action.MOVE_RIGHT, Action.MOVE_LEFT,
+    Action.MOVE_UP, Action.MOVE_DOWN, Action.POSE_BOMB])
+
+def make_game(n_turns):
+    n = BOARD_WIDTH
+    m = BOARD_HEIGHT
+    poss = mapgen.start_positions(n, m, NUM_PLAYERS)
+    tiles = mapgen.generate(n, m, poss)
+    init = packets.InitPacket(0, NUM_PLAYERS, int(TURN_LENGTH * 1000), n, m, tiles, poss)
+    turns = [(turn, bytearray(random.choice(ACTIONS) for i in xrange(NUM_PLAYERS)))
+             for turn in xrange(1, n_turns + 1)]
+    return init, turns
+
+def bench(path, init, turns, keyframe_interval, n_seeks=50):
+    writer = replay.ReplayWriter(path, init, keyframe_interval)
+    for turn, actions in turns:
+        writer.record(turn, actions)
+    writer.close()
+    replay.get_replay_writer().wait()
+    reader = replay.ReplayReader(path)
+    targets = [random.randint(0, len(reader)) for i in xrange(n_seeks)]
+    t = time.time()
+    for n in targets:
+        reader.seek(n)
+    t = (time.time() - t) / n_seeks
+    reader.close()
+    label = "every %d turns" % keyframe_interval if keyframe_interval else "none"
+    print "%-20s %10d bytes %10.3f ms" % (label, os.path.getsize(path), t * 1000)
+
+def main(n_turns):
+    random.seed(0)
+    init, turns = make_game(n_turns)
+    print "replay of %d turns: keyframes, file size, mean seek time" % n_turns
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for k in (0, 5000, 1000, 500, 100, 20):
+            bench(os.path.join(tmpdir, "%d.replay" % k), init, turns, k)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -42,6 +42,10 @@ class BotClient(object):
         # return False if the party was not found, 
         return False
             
+    def join_party(self, party_no):
+        """Join the party under the given no through the lobby connection"""
+        packets.JoinPartyPacket(party_no).wrap().send(self.sock)
+    
     def close_connection(self):
         if DEBUG: print "Shutting down connection with " + str(self.sock.getpeername())
         socket_utils.shutdown_close(self.sock)
@@ -65,8 +69,12 @@ if __name__ == "__main__":
     # find the party server address
     addr = bot.get_party_addr(party_no)
     if addr:
-        # connect to the party server
-        bot.reconnect(addr)
+        if MULTIPLEX_PARTIES:
+            # let the lobby hand this connection over to the party
+            bot.join_party(party_no)
+        else:
+            # connect to the party server
+            bot.reconnect(addr)
         # wait forever or until the connection is shut down by the server
         try:
             while True: packets.GamePacket.recv(bot.sock)
@@ -1,23 +1,27 @@
+import binascii
+import socket
 import sys
 import os
 from lobbyclient import LobbyClient
 from partyclient import PartyClient
 from gameconst import *
 
-def run_lobby_client(ip, port, partyfile):
+def run_lobby_client(ip, port, partyfile, sock=None):
     """Run the lobby client. The process where this procedure is called from
     will be exited once the user decides to join a party.
     The party server's address will be written"""
     client = LobbyClient(partyfile)
-    client.connect((lobby_ip, lobby_port))
+    client.connect((ip, port), sock)
     client.run()
 
-def run_party_client(ip, port):
+def run_party_client(ip, port, sock=None, buffered='', lobby_addr=None):
     """Run the party client. The process where this procedure is called from
     will be exited once the user decides to join a party.
-    The party server's address will be written"""
+    The party server's address will be written.
+    The game is rejoined through the lobby if the connection is lost."""
     partyclient = PartyClient()
-    partyclient.connect((ip, port))
+    partyclient.lobby_addr = lobby_addr
+    partyclient.connect((ip, port), sock, buffered)
     partyclient.run()
 
 # The client launcher will first run the lobby client in a child process,
@@ -37,11 +41,18 @@ if __name__ == "__main__":
     # open a temporary file so that the lobby client can write on it
     partyfile = os.tmpfile()
     exitcode = -1
+    # if the parties are joined through the lobby connection, open it here
+    # so that it can be handed over to the party client afterwards
+    lobby_sock = None
+    if MULTIPLEX_PARTIES:
+        lobby_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        lobby_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        lobby_sock.connect((lobby_ip, lobby_port))
     # launch the lobby client in a child process
     if DEBUG: print "launching lobby client"
     if os.fork() == 0:
         # child process
-        run_lobby_client(lobby_ip, lobby_port, partyfile)
+        run_lobby_client(lobby_ip, lobby_port, partyfile, lobby_sock)
     else:
         # parent process: wait until the lobby client process is done
         _, exitcode = os.wait()
@@ -59,8 +70,17 @@ if __name__ == "__main__":
         party_ip = partyfile.readline().strip()
         # second line is the port
         party_port = partyfile.readline().strip()
+        # if the party was joined through the lobby connection, the third line
+        # is the party id and the fourth one the bytes received but not read
+        party_id = partyfile.readline().strip()
+        buffered = binascii.unhexlify(partyfile.readline().strip())
         # we don't need the temporary file anymore, close it
         partyfile.close()
         # if the address was read successfully, launch the party client on it
         if party_ip and party_port:
-            run_party_client(party_ip, int(party_port))
+            lobby_addr = (lobby_ip, lobby_port)
+            if party_id and lobby_sock:
+                run_party_client(party_ip, int(party_port), lobby_sock, buffered,
+                    lobby_addr=lobby_addr)
+            else:
+                run_party_client(party_ip, int(party_port), lobby_addr=lobby_addr)
@@ -0,0 +1,313 @@
+from gameconst import *
+
+import collections
+import errno
+import heapq
+import os
+import select
+import sys
+import threading
+import time
+import traceback
+
+# the id of CLOCK_MONOTONIC for clock_gettime, by platform
+_CLOCK_MONOTONIC_IDS = {'linux': 1, 'linux2': 1, 'darwin': 6, 'freebsd': 4}
+
+def _get_monotonic():
+    """Get a function returning the time of a clock that never goes
+    backwards (in secs): Python 2 has no time.monotonic, so the one of the
+    system (clock_gettime) is called through ctypes.
+    Returns None if the platform has no such clock."""
+    clock_id = None
+    for prefix, i in _CLOCK_MONOTONIC_IDS.items():
+        if sys.platform.startswith(prefix):
+            clock_id = i
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return None
+    if clock_id is None:
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    # (clock_gettime is in the libc, or in librt with older glibc)
+    for name in (None, ctypes.util.find_library('rt')):
+        try:
+            clock_gettime = ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_gettime.restype = ctypes.c_int
+
+        def monotonic():
+            # (a timespec per call: the clock is read from several threads)
+            t = timespec()
+            if clock_gettime(clock_id, ctypes.byref(t)) != 0:
+                errno_ = ctypes.get_errno()
+                raise OSError(errno_, os.strerror(errno_))
+            return t.tv_sec + t.tv_nsec * 1e-9
+        try:
+            monotonic()
+        except OSError:
+            continue
+        return monotonic
+    return None
+
+# a clock that never goes backwards, so that the deadlines do not move with
+# the wall clock (falls back on time.time if the platform has none)
+monotonic = getattr(time, 'monotonic', None) or _get_monotonic()
+IS_MONOTONIC = monotonic is not None
+if not IS_MONOTONIC:
+    monotonic = time.time
+
+
+class Timer(object):
+    """A call scheduled on the event loop at an absolute deadline.
+    Cancelling a timer only marks it, the loop drops it when it is due."""
+
+    def __init__(self, deadline, fun, args):
+        self.deadline = deadline
+        self.fun = fun
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """A single-threaded reactor.
+    It watches any number of sockets for reading and writing
+    (using epoll when the platform has it, select otherwise)
+    and calls the registered functions back when they are ready.
+    It also runs timers scheduled at absolute deadlines.
+
+    Except for call_soon_threadsafe, the methods of the loop should only be
+    called from the loop's own thread."""
+    # max time (in secs) spent waiting for an event when no timer is pending
+    # (None to wait for as long as it takes: an idle loop never wakes up)
+    poll_interval = None
+    # tells whether the loop thread should be stopped when the main thread is done
+    daemon_threads = True
+
+    def __init__(self):
+        # the functions to call when a fd is ready: fd -> (fun, args)
+        self._readers = {}
+        self._writers = {}
+        # a heap of (deadline, sequence no, timer)
+        self._timers = []
+        self._timer_seq = 0
+        # the calls posted by other threads, run on the next iteration
+        self._callbacks = collections.deque()
+        self._running = False
+        self._thread = None
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+        else:
+            self._epoll = None
+        # a pipe used to wake up the loop when a call is posted from
+        # another thread while the loop is waiting for events
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        _set_non_blocking(self._wakeup_r)
+        _set_non_blocking(self._wakeup_w)
+        self.add_reader(self._wakeup_r, self._drain_wakeup)
+
+    def time(self):
+        """The current time of the loop's clock (in secs)"""
+        return monotonic()
+
+    def add_reader(self, sock, fun, args=()):
+        """Call fun(*args) every time sock has data to read"""
+        fd = _fileno(sock)
+        self._readers[fd] = (fun, args)
+        self._update_fd(fd)
+
+    def remove_reader(self, sock):
+        fd = _fileno(sock)
+        if fd in self._readers:
+            del self._readers[fd]
+            self._update_fd(fd)
+
+    def add_writer(self, sock, fun, args=()):
+        """Call fun(*args) every time data can be written to sock"""
+        fd = _fileno(sock)
+        self._writers[fd] = (fun, args)
+        self._update_fd(fd)
+
+    def remove_writer(self, sock):
+        fd = _fileno(sock)
+        if fd in self._writers:
+            del self._writers[fd]
+            self._update_fd(fd)
+
+    def call_at(self, deadline, fun, args=()):
+        """Call fun(*args) once the loop's clock reaches deadline.
+        Returns a Timer which can be cancelled."""
+        timer = Timer(deadline, fun, args)
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (deadline, self._timer_seq, timer))
+        return timer
+
+    def call_later(self, delay, fun, args=()):
+        """Call fun(*args) in delay seconds.
+        Returns a Timer which can be cancelled."""
+        return self.call_at(self.time() + delay, fun, args)
+
+    def call_soon_threadsafe(self, fun, args=()):
+        """Call fun(*args) on the loop's thread as soon as possible.
+        This may be called from any thread."""
+        self._callbacks.append((fun, args))
+        try:
+            os.write(self._wakeup_w, '\0')
+        except OSError, e:
+            # the pipe is full: the loop is already going to wake up
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def in_loop_thread(self):
+        """Tell whether the caller is running on the loop's thread"""
+        return threading.current_thread() is self._thread
+
+    def start(self):
+        """Run the loop in a new thread"""
+        t = threading.Thread(target=self.run_forever, args=())
+        t.daemon = self.daemon_threads
+        self._thread = t
+        t.start()
+        return t
+
+    def run_forever(self):
+        """Process events until stop() is called"""
+        self._thread = threading.current_thread()
+        self._running = True
+        try:
+            while self._running:
+                self.run_once()
+        finally:
+            self._running = False
+
+    def stop(self):
+        """Request the loop to stop after the current iteration"""
+        self._running = False
+        self.call_soon_threadsafe(lambda: None)
+
+    def run_once(self):
+        """Wait for the next events (or the next timer)
+        and call the matching functions."""
+        # do not wait past the next timer deadline
+        timeout = self.poll_interval
+        if self._callbacks:
+            timeout = 0
+        elif self._timers:
+            delay = max(0, self._timers[0][0] - self.time())
+            timeout = delay if timeout is None else min(timeout, delay)
+        for fun, args in self._poll(timeout):
+            self._run(fun, args)
+        # run the timers which are due
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                self._run(timer.fun, timer.args)
+        # run the calls posted by other threads
+        for i in xrange(len(self._callbacks)):
+            fun, args = self._callbacks.popleft()
+            self._run(fun, args)
+
+    def _poll(self, timeout):
+        """Return the list of (fun, args) to call for the ready fds"""
+        ready = []
+        if self._epoll is not None:
+            try:
+                events = self._epoll.poll(-1 if timeout is None else timeout)
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    return ready
+                raise
+            for fd, mask in events:
+                if mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                    if fd in self._readers:
+                        ready.append(self._readers[fd])
+                if mask & (select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR):
+                    if fd in self._writers:
+                        ready.append(self._writers[fd])
+        else:
+            try:
+                r, w, _ = select.select(self._readers.keys(),
+                    self._writers.keys(), [], timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    return ready
+                raise
+            ready.extend(self._readers[fd] for fd in r if fd in self._readers)
+            ready.extend(self._writers[fd] for fd in w if fd in self._writers)
+        return ready
+
+    def _run(self, fun, args):
+        """Call fun(*args), an error must not stop the whole loop"""
+        try:
+            fun(*args)
+        except Exception:
+            if VERBOSE: traceback.print_exc(file=sys.stderr)
+
+    def _update_fd(self, fd):
+        """Update the set of events watched for the given fd"""
+        if self._epoll is None:
+            return
+        mask = 0
+        if fd in self._readers:
+            mask |= select.EPOLLIN
+        if fd in self._writers:
+            mask |= select.EPOLLOUT
+        try:
+            if mask:
+                try:
+                    self._epoll.modify(fd, mask)
+                except IOError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    self._epoll.register(fd, mask)
+            else:
+                self._epoll.unregister(fd)
+        except (IOError, ValueError), e:
+            # the fd was already closed
+            if VERBOSE: print >> sys.stderr, str(e)
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+
+def _fileno(sock):
+    return sock if isinstance(sock, (int, long)) else sock.fileno()
+
+def _set_non_blocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+# the loop shared by every server of this process
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+def get_event_loop():
+    """Get the event loop shared by every server of this process.
+    The loop is created and started in its own thread on the first call."""
+    global _shared_loop
+    _shared_loop_lock.acquire()
+    # ------ enter critical section ------
+    if _shared_loop is None:
+        _shared_loop = EventLoop()
+        _shared_loop.start()
+    loop = _shared_loop
+    # ------ exit critical section -------
+    _shared_loop_lock.release()
+    return loop
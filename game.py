@@ -1,7 +1,7 @@
 from math import *
 from gameconst import *
+from game_engine import GameEvent, create_engine
 import mapgen
-import collections
 from direct.showbase.ShowBase import ShowBase
 from direct.showbase import DirectObject
 from direct.actor.Actor import Actor
@@ -9,7 +9,16 @@ from direct.task import Task
 from panda3d.core import *
 
 class GameController():
-    """Controller for a bomberman game"""
+    """Controller for a bomberman game.
+    The game rules are run by a GameEngine, the controller renders the game
+    and follows its state through the engine's events.
+    If PREDICT_LOCAL_PLAYER is set, the views follow a second engine instead,
+    which runs the current turn ahead of the server as soon as the local
+    player acts (assuming the other players do nothing): the player sees
+    its action without waiting for the server to commit it. When the
+    committed actions differ from the prediction, the predicted engine is
+    rolled back to the state of the game and the views are corrected.
+    The deaths and the end of the game are only shown once committed."""
     VIEWS = {
         'floor': {
             'model': 'assets/plane',
@@ -31,21 +40,30 @@ class GameController():
         self.width = width
         self.height = height
         self.turn_length = turn_length
-        # build the initial map for the game
+        # the game rules, following the actions committed by the server
+        self.engine = create_engine(width, height, map_init, players)
+        # the game as predicted with the local player's action (if any),
+        # and the (turn, action, postponed) predicted
+        self.predicted = None
+        self.prediction = None
+        if PREDICT_LOCAL_PLAYER:
+            self.predicted = create_engine(width, height, map_init, players)
+        view_engine = self.predicted or self.engine
+        view_engine.subscribe(GameEvent.BOMB_PLACED, self.on_bomb_placed)
+        view_engine.subscribe(GameEvent.BOMB_EXPLODED, self.on_tile_destroyed)
+        view_engine.subscribe(GameEvent.TILE_DESTROYED, self.on_tile_destroyed)
+        view_engine.subscribe(GameEvent.PLAYER_MOVED, self.on_player_moved)
+        self.engine.subscribe(GameEvent.PLAYER_KILLED, self.kill)
+        self.engine.subscribe(GameEvent.GAME_OVER, self.on_game_over)
+        # build the initial view of the map
         self.map = [[Tile(map_init[y * width + x], x, y, height)
                     for x in xrange(width)] for y in xrange(height)]
-        # the list of players
+        # the views of the players
         self.players = [Player(no, xi, yi, height, no == me) for no, (xi, yi) in enumerate(players)]
         # the turn number
         self.turn = 0
         # the no of the player who "I" am
         self.me = me
-        # maintain a list of active bombs
-        self.bombs = [(x, y, BOMB_COUNTER_INIT)
-                      for x in xrange(width) for y in xrange(height)
-                      if map_init[y * width + x] == TileContent.BOMB]
-        # the bomb to trigger will be added to this queue
-        self.to_explode = collections.deque()
         # init the environment
         self.init_world_view()
         # init the keyboard handler
@@ -135,25 +153,82 @@ class GameController():
     
     def execute_turn(self, turn_no, actions):
         """Starts a new turn with given turn no and player actions"""
-        # update the turn no
-        self.turn = turn_no + 1
-        # commit the player actions
-        self.commit_actions(actions)
-        # update the bombs
-        self.update_bombs()
-        # trigger the explosions
-        while self.to_explode:
-            xb, yb = self.to_explode.popleft()
-            self.trigger_explosion(xb, yb)
-        # check the remaining (alive) players in game:
-        # if there is only one player remains, he wins the game
-        alive_players = self.alive_players()
-        if len(alive_players) == 1:
-            self.declare_winner(self.players[0])
-        # if there is no player left, declare a draw/null
-        elif not alive_players:
-            self.declare_draw()
-        
+        if self.predicted is not None:
+            self.reconcile(turn_no, actions)
+        self.engine.execute_turn(turn_no, actions)
+        self.turn = self.engine.turn
+    
+    def _guess_actions(self, action):
+        """The actions of a turn where only the local player acts"""
+        actions = [Action.DO_NOTHING] * len(self.players)
+        actions[self.me] = action
+        return actions
+    
+    def predict(self, action):
+        """Show the local player's action right away, on the predicted game
+        (only if PREDICT_LOCAL_PLAYER is set)"""
+        if self.predicted is None or self.engine.players[self.me].is_dead():
+            return
+        if self.prediction is not None:
+            # (the server only keeps the last action requested in a turn)
+            self.rollback()
+        self.prediction = (self.turn, action, False)
+        self.predicted.execute_turn(self.turn, self._guess_actions(action))
+    
+    def reconcile(self, turn_no, actions):
+        """Bring the predicted game to the state following the actions
+        committed on the given turn, before the game itself executes it"""
+        if self.prediction is None:
+            self.predicted.execute_turn(turn_no, actions)
+            return
+        turn, action, postponed = self.prediction
+        self.prediction = None
+        if turn == turn_no and list(actions) == self._guess_actions(action):
+            # the prediction was right
+            return
+        # re-simulate the turn with the actions committed
+        self.rollback()
+        self.predicted.execute_turn(turn_no, actions)
+        if turn == turn_no and actions[self.me] != action and not postponed:
+            # the request reached the server after the turn was committed,
+            # the action will be committed on the next turn
+            self.prediction = (turn_no + 1, action, True)
+            self.predicted.execute_turn(turn_no + 1, self._guess_actions(action))
+    
+    def rollback(self):
+        """Bring the predicted game back to the state of the game"""
+        state = self.engine.get_state()
+        self.predicted.set_state(state)
+        self.update_views(state, self.turn_length)
+    
+    def restore_state(self, state):
+        """Restore the given state of the game (see GameEngine.get_state),
+        e.g. after rejoining the game, and update the views"""
+        self.engine.set_state(state)
+        self.turn = self.engine.turn
+        if self.predicted is not None:
+            self.predicted.set_state(state)
+            self.prediction = None
+        self.update_views(state, 0)
+        if self.engine.is_over:
+            alive_players = self.alive_players()
+            self.on_game_over(alive_players[0].no if alive_players else None)
+    
+    def update_views(self, state, move_time):
+        """Update the views of the tiles and of the players to the given
+        state of the game"""
+        turn, tiles, players, bombs = state
+        for y, row in enumerate(tiles):
+            for x, content in enumerate(row):
+                self.map[y][x].set_content(content)
+        for player, (x, y, alive) in zip(self.players, players):
+            if player.view is None:
+                # (already dead)
+                continue
+            if alive:
+                player.move_to(x, y, move_time)
+            else:
+                self.kill(player.no)
     
     def declare_winner(self, p):
         """Declare the given player winner"""
@@ -166,136 +241,28 @@ class GameController():
         text = "Draw."
         self.client.update_status_text(text)
     
-    def commit_actions(self, actions):
-        for i, a in enumerate(actions):
-            if self.can_do(i, a):
-                self.do(i, a)
-    
     def alive_players(self):
         """Return the list of players that are not dead"""
-        return [p for p in self.players if p.is_alive()]
-    
-    def can_do(self, player_no, action):
-        player = self.players[player_no]
-        if player.is_dead():
-            return False
-        # can a bomb be placed on another one ?
-        elif action == Action.POSE_BOMB:
-            return (player.has_bomb() and self.map[player.y][player.x].is_free())
-        # collision between 2 players ?
-        elif action == Action.MOVE_RIGHT:
-            return (player.x < self.width - 1 and
-                   self.map[player.y][player.x + 1].is_available())
-        elif action == Action.MOVE_LEFT:
-            return (player.x > 0 and
-                   self.map[player.y][player.x - 1].is_available())
-        elif action == Action.MOVE_UP:
-            return (player.y > 0 and
-                   self.map[player.y - 1][player.x].is_available())
-        elif action == Action.MOVE_DOWN:
-            return (player.y < self.height - 1 and
-                   self.map[player.y + 1][player.x].is_available())
-        else:
-            return True
+        return self.engine.alive_players()
     
-    def do(self, player_no, action):
-        player = self.players[player_no]
-        if action == Action.POSE_BOMB:
-            player.take_bomb()
-            self.add_bomb(player.x, player.y)
-        elif action in [Action.MOVE_RIGHT, Action.MOVE_LEFT, Action.MOVE_UP, Action.MOVE_DOWN]:
-            player.move(action, self.turn_length)
-    
-    def add_bomb(self, x, y):
+    def on_bomb_placed(self, x, y, player_no):
         self.map[y][x].put_bomb()
-        self.bombs.append((x, y, BOMB_COUNTER_INIT))
     
-    def update_bombs(self):
-        """Update the bomb counters and trigger explosions accordingly"""
-        # decrement counters
-        self.bombs = [(xb, yb, ib - 1) for xb, yb, ib in self.bombs]
-        # add to to_explode every bomb whose counter is zero
-        for xb, yb, ib in self.bombs:
-            if ib <= 0:
-                self.to_explode.append((xb, yb))
+    def on_tile_destroyed(self, x, y):
+        self.map[y][x].destroy()
     
-    def trigger_explosion(self, xb, yb):
-        """Start a bomb explosion event at (xb, yb)."""
-        # destroy the bomb and remove it from the list of active bombs
-        self.map[yb][xb].destroy()
-        self.bombs = [(x, y, i) for (x, y, i) in self.bombs if (x != xb or y != yb)]
-        
-        # kill any player on the tile where the bomb explodes
-        for p in self.alive_players():
-            if p.x == xb and p.y == yb:
-                self.kill(p)
-        # explosion to the right
-        for (x, y) in [(xb + i, yb) for i in xrange(1, BOMB_RADIUS + 1) if xb + i < self.width]:
-            t = self.map[y][x]
-            # kill any player within the explosion radius
-            for p in self.alive_players():
-                if p.x == x and p.y == y:
-                    self.kill(p)
-            # destroy any destructible block within the radius
-            if t.content == TileContent.SOFT_BLOCK:
-                t.destroy()
-            # add any bomb within the radius to a list of bombs to explode
-            elif t.content == TileContent.BOMB:
-                self.to_explode.append((x, y))
-            # stop the explosion if an indestructible block blocks it
-            elif t.content == TileContent.HARD_BLOCK:
-                break
-        # explosion to the left
-        for (x, y) in [(xb - i, yb) for i in xrange(1, BOMB_RADIUS + 1) if xb - i >= 0]:
-            t = self.map[y][x]
-            # kill any player within the explosion radius
-            for p in self.alive_players():
-                if p.x == x and p.y == y:
-                    self.kill(p)
-            # destroy any destructible block within the radius
-            if t.content == TileContent.SOFT_BLOCK:
-                t.destroy()
-            # add any bomb within the radius to a list of bombs to explode
-            elif t.content == TileContent.BOMB:
-                self.to_explode.append((x, y))
-            # stop the explosion if an indestructible block blocks it
-            elif t.content == TileContent.HARD_BLOCK:
-                break
-        # upward explosion
-        for (x, y) in [(xb, yb - i) for i in xrange(1, BOMB_RADIUS + 1) if yb - i >= 0]:
-            t = self.map[y][x]
-            # kill any player within the explosion radius
-            for p in self.alive_players():
-                if p.x == x and p.y == y:
-                    self.kill(p)
-            # destroy any destructible block within the radius
-            if t.content == TileContent.SOFT_BLOCK:
-                t.destroy()
-            # add any bomb within the radius to a list of bombs to explode
-            elif t.content == TileContent.BOMB:
-                self.to_explode.append((x, y))
-            # stop the explosion if an indestructible block blocks it
-            elif t.content == TileContent.HARD_BLOCK:
-                break
-        # downward explosion
-        for (x, y) in [(xb, yb + i) for i in xrange(1, BOMB_RADIUS + 1) if yb + i < self.height]:
-            t = self.map[y][x]
-            # kill any player within the explosion radius
-            for p in self.alive_players():
-                if p.x == x and p.y == y:
-                    self.kill(p)
-            # destroy any destructible block within the radius
-            if t.content == TileContent.SOFT_BLOCK:
-                t.destroy()
-            # add any bomb within the radius to a list of bombs to explode
-            elif t.content == TileContent.BOMB:
-                self.to_explode.append((x, y))
-            # stop the explosion if an indestructible block blocks it
-            elif t.content == TileContent.HARD_BLOCK:
-                break
+    def on_player_moved(self, player_no, x, y):
+        self.players[player_no].move_to(x, y, self.turn_length)
+    
+    def on_game_over(self, winner):
+        if winner is None:
+            self.declare_draw()
+        else:
+            self.declare_winner(self.players[winner])
     
-    def kill(self, player):
+    def kill(self, player_no):
         """Kill the given player."""
+        player = self.players[player_no]
         # trigger the death of the player
         player.die()
         # update the status text
@@ -307,12 +274,11 @@ class GameController():
             self.keyboard_handler = None
             text = "You lose!"
             self.client.update_status_text(text)
-        # (keep the player in the list of players but keep him dead)
         
     
 
 class Player(object):
-    """In-game model for a player"""
+    """In-game view of a player"""
     VIEWS = {
         0: {
             'model': 'assets/cone_actor',
@@ -345,12 +311,7 @@ class Player(object):
         super(Player, self).__init__()
         # player number
         self.no = no
-        # initial position
-        self.x = xi
-        self.y = yi
         self.height = height
-        # boolean flag, False if the player is dead
-        self.alive = True
         # the last interval action will be stored there
         # so that we can finish it prematurely  if a new one is to be executed
         self.last_action = None
@@ -375,42 +336,24 @@ class Player(object):
                 marker.setPos(params['pos'])
             marker.reparentTo(self.view)
 
-    def move(self, action, time):
-        """Move the player towards the given direction."""
-        if action == Action.MOVE_RIGHT:
-            self.x += 1
-        elif action == Action.MOVE_LEFT:
-            self.x -= 1
-        elif action == Action.MOVE_UP:
-            self.y -= 1
-        elif action == Action.MOVE_DOWN:
-            self.y += 1
+    def move_to(self, x, y, time):
+        """Move the player to the given tile."""
+        if self.view is None:
+            # (a dead player may still move on the predicted game)
+            return
         if self.last_action: self.last_action.finish()
-        self.last_action = self.view.posInterval(time / 1000.0, Point3(self.x, self.height - self.y - 1, 0.5))
+        self.last_action = self.view.posInterval(time / 1000.0, Point3(x, self.height - y - 1, 0.5))
         self.last_action.start()
         # self.view.posInterval(time / 1000, Point3(self.x, self.y, 0)).start()
     
-    def has_bomb(self):
-        return True
-    
-    def take_bomb(self):
-        pass
-    
     def die(self):
         """Trigger the death of the player"""
-        self.alive = False
         self.view.delete()
         self.view.removeNode()
         self.view = None
-    
-    def is_alive(self):
-        return self.alive
-    
-    def is_dead(self):
-        return not self.alive
 
 class Tile(object):
-    """In-game model for a tile"""
+    """In-game view of a tile"""
     VIEWS = {
         TileContent.SOFT_BLOCK: {
             'model': 'assets/cube',
@@ -460,14 +403,6 @@ class Tile(object):
             view.setScale(params['scale'])
         return view
     
-    def is_available(self):
-        """Return True if this tile can be crossed by a player."""
-        return (self.content == TileContent.FREE or self.content == TileContent.BOMB)
-        
-    def is_free(self):
-        """Return True a player can pose a bomb on this tile."""
-        return (self.content == TileContent.FREE)
-    
     def put_bomb(self):
         """Put a new bomb on this Tile"""
         if self.view: self.view.removeNode()
@@ -476,6 +411,21 @@ class Tile(object):
         self.view.setPos(self.x, self.height - self.y - 1, 0)
         self.view.reparentTo(render)
     
+    def set_content(self, content):
+        """Change the content of this tile (e.g. when the game is restored)"""
+        if content == self.content:
+            return
+        if content == TileContent.BOMB:
+            self.put_bomb()
+            return
+        if self.view: self.view.removeNode()
+        self.content = content
+        self.view = None
+        if not content == TileContent.FREE:
+            self.view = self.load_view(content)
+            self.view.setPos(self.x, self.height - self.y - 1, 0.5)
+            self.view.reparentTo(render)
+    
     def destroy(self):
         """Destroy this tile, making it a free tile"""
         if not self.content == TileContent.FREE:
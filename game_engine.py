@@ -0,0 +1,348 @@
+from gameconst import *
+import enum
+
+import collections
+import struct
+
+GameEvent = enum.enum("GameEvent",
+    # (x, y, player no) a player posed a bomb
+    BOMB_PLACED = 1,
+    # (x, y) a bomb exploded, its tile is free again
+    BOMB_EXPLODED = 2,
+    # (x, y) a soft block was destroyed by an explosion
+    TILE_DESTROYED = 3,
+    # (player no, x, y) a player moved to the given tile
+    PLAYER_MOVED = 4,
+    # (player no, ) a player was killed by an explosion
+    PLAYER_KILLED = 5,
+    # (winner no, ) the game is over, the winner is None for a draw
+    GAME_OVER = 6
+)
+
+# the directions of the explosions: right, left, up, down
+DIRECTIONS = ((1, 0), (-1, 0), (0, -1), (0, 1))
+
+# the blast rays of the maps seen so far (see get_blast_rays)
+_blast_rays = {}
+
+def get_blast_rays(width, height, map_init):
+    """Get the blast rays of every tile of a map, as a list indexed by
+    y * width + x: the rays of a tile are the tuples of the tiles (x, y)
+    an explosion goes through in each direction, within BOMB_RADIUS and the
+    map, and truncated before the first hard block.
+    The hard blocks never change, so the rays only depend on the initial
+    map: they are computed once and shared by every game on the same map."""
+    hard = tuple(i for i, c in enumerate(map_init) if c == TileContent.HARD_BLOCK)
+    key = (width, height, hard)
+    rays = _blast_rays.get(key)
+    if rays is not None:
+        return rays
+    hard = set(hard)
+    rays = []
+    for y in xrange(height):
+        for x in xrange(width):
+            tile_rays = []
+            for dx, dy in DIRECTIONS:
+                ray = []
+                for i in xrange(1, BOMB_RADIUS + 1):
+                    xi = x + i * dx
+                    yi = y + i * dy
+                    if not (0 <= xi < width and 0 <= yi < height):
+                        break
+                    if yi * width + xi in hard:
+                        break
+                    ray.append((xi, yi))
+                tile_rays.append(tuple(ray))
+            rays.append(tuple(tile_rays))
+    # (two threads may compute the same rays, either result is fine)
+    return _blast_rays.setdefault(key, rays)
+
+
+class PlayerState(object):
+    """The state of a player in the game rules"""
+
+    def __init__(self, no, x, y):
+        # player number
+        self.no = no
+        # position
+        self.x = x
+        self.y = y
+        # boolean flag, False if the player is dead
+        self.alive = True
+
+    def move(self, action):
+        """Move the player towards the given direction."""
+        if action == Action.MOVE_RIGHT:
+            self.x += 1
+        elif action == Action.MOVE_LEFT:
+            self.x -= 1
+        elif action == Action.MOVE_UP:
+            self.y -= 1
+        elif action == Action.MOVE_DOWN:
+            self.y += 1
+
+    def has_bomb(self):
+        return True
+
+    def take_bomb(self):
+        pass
+
+    def die(self):
+        self.alive = False
+
+    def is_alive(self):
+        return self.alive
+
+    def is_dead(self):
+        return not self.alive
+
+
+class GameEngine(object):
+    """The rules of a bomberman game, without any rendering.
+    The engine is initialized with the data of an init packet and executes
+    the turns committed by the server: given the same init and actions,
+    every engine reaches the same state, be it on a client, a bot or the
+    server. The views (e.g. the client's GameController) subscribe to the
+    game events to follow the state."""
+
+    def __init__(self, width, height, map_init, positions):
+        self.width = width
+        self.height = height
+        # the content of each tile
+        self.map = [[map_init[y * width + x] for x in xrange(width)]
+                    for y in xrange(height)]
+        # the list of players
+        self.players = [PlayerState(no, xi, yi)
+                        for no, (xi, yi) in enumerate(positions)]
+        # the turn number
+        self.turn = 0
+        # maintain a list of active bombs
+        self.bombs = [(x, y, BOMB_COUNTER_INIT)
+                      for x in xrange(width) for y in xrange(height)
+                      if map_init[y * width + x] == TileContent.BOMB]
+        # the tiles reached by an explosion from each tile
+        self.blast_rays = get_blast_rays(width, height, map_init)
+        # the bomb to trigger will be added to this queue
+        self.to_explode = collections.deque()
+        # tells whether the game is over (and GAME_OVER was emitted)
+        self.is_over = False
+        # the functions to call on each event (event type -> list of functions)
+        self._subscribers = collections.defaultdict(list)
+
+    @classmethod
+    def from_init(cls, init):
+        """Create the engine for the game described by an InitPacket"""
+        return cls(init.width, init.height, init.tiles, init.positions)
+
+    def subscribe(self, event, fun):
+        """Call fun(*args) every time the given event happens
+        (see GameEvent for the args of each event)"""
+        self._subscribers[event].append(fun)
+
+    def unsubscribe(self, event, fun):
+        self._subscribers[event].remove(fun)
+
+    def _emit(self, event, *args):
+        for fun in self._subscribers.get(event, ()):
+            fun(*args)
+
+    def get_state(self):
+        """Get the whole state of the game as a tuple,
+        e.g. to compare the states of two engines"""
+        return (self.turn,
+            tuple(tuple(row) for row in self.map),
+            tuple((p.x, p.y, p.alive) for p in self.players),
+            tuple(self.bombs))
+
+    def set_state(self, state):
+        """Restore a state returned by get_state (e.g. to seek in a replay).
+        No event is emitted: the views have to be rebuilt."""
+        turn, tiles, players, bombs = state
+        self.turn = turn
+        self.map = [list(row) for row in tiles]
+        for p, (x, y, alive) in zip(self.players, players):
+            p.x = x
+            p.y = y
+            p.alive = alive
+        self.bombs = list(bombs)
+        self.to_explode.clear()
+        # (the game is over as soon as there is one player left)
+        self.is_over = len(self.alive_players()) <= 1
+
+    def execute_turn(self, turn_no, actions):
+        """Starts a new turn with given turn no and player actions"""
+        # update the turn no
+        self.turn = turn_no + 1
+        # commit the player actions
+        self.commit_actions(actions)
+        # update the bombs
+        self.update_bombs()
+        # trigger the explosions
+        while self.to_explode:
+            xb, yb = self.to_explode.popleft()
+            self.trigger_explosion(xb, yb)
+        # check the remaining (alive) players in game:
+        # if there is only one player remains, he wins the game,
+        # if there is no player left, it is a draw
+        if not self.is_over:
+            alive_players = self.alive_players()
+            if len(alive_players) <= 1:
+                self.is_over = True
+                winner = alive_players[0].no if alive_players else None
+                self._emit(GameEvent.GAME_OVER, winner)
+
+    def commit_actions(self, actions):
+        for i, a in enumerate(actions):
+            if self.can_do(i, a):
+                self.do(i, a)
+
+    def alive_players(self):
+        """Return the list of players that are not dead"""
+        return [p for p in self.players if p.is_alive()]
+
+    def can_do(self, player_no, action):
+        if player_no >= len(self.players):
+            return False
+        player = self.players[player_no]
+        if player.is_dead():
+            return False
+        # can a bomb be placed on another one ?
+        elif action == Action.POSE_BOMB:
+            return (player.has_bomb() and
+                    self.map[player.y][player.x] == TileContent.FREE)
+        # collision between 2 players ?
+        elif action == Action.MOVE_RIGHT:
+            return (player.x < self.width - 1 and
+                    self.is_available(player.x + 1, player.y))
+        elif action == Action.MOVE_LEFT:
+            return (player.x > 0 and
+                    self.is_available(player.x - 1, player.y))
+        elif action == Action.MOVE_UP:
+            return (player.y > 0 and
+                    self.is_available(player.x, player.y - 1))
+        elif action == Action.MOVE_DOWN:
+            return (player.y < self.height - 1 and
+                    self.is_available(player.x, player.y + 1))
+        else:
+            return True
+
+    def is_available(self, x, y):
+        """Return True if the tile can be crossed by a player."""
+        content = self.map[y][x]
+        return (content == TileContent.FREE or content == TileContent.BOMB)
+
+    def do(self, player_no, action):
+        player = self.players[player_no]
+        if action == Action.POSE_BOMB:
+            player.take_bomb()
+            self.add_bomb(player.x, player.y)
+            self._emit(GameEvent.BOMB_PLACED, player.x, player.y, player_no)
+        elif action in (Action.MOVE_RIGHT, Action.MOVE_LEFT, Action.MOVE_UP, Action.MOVE_DOWN):
+            player.move(action)
+            self._emit(GameEvent.PLAYER_MOVED, player_no, player.x, player.y)
+
+    def add_bomb(self, x, y):
+        self.map[y][x] = TileContent.BOMB
+        self.bombs.append((x, y, BOMB_COUNTER_INIT))
+
+    def update_bombs(self):
+        """Update the bomb counters and trigger explosions accordingly"""
+        # decrement counters
+        self.bombs = [(xb, yb, ib - 1) for xb, yb, ib in self.bombs]
+        # add to to_explode every bomb whose counter is zero
+        for xb, yb, ib in self.bombs:
+            if ib <= 0:
+                self.to_explode.append((xb, yb))
+
+    def trigger_explosion(self, xb, yb):
+        """Start a bomb explosion event at (xb, yb)."""
+        # destroy the bomb and remove it from the list of active bombs
+        if self.map[yb][xb] != TileContent.FREE:
+            self.map[yb][xb] = TileContent.FREE
+            self._emit(GameEvent.BOMB_EXPLODED, xb, yb)
+        self.bombs = [(x, y, i) for (x, y, i) in self.bombs if (x != xb or y != yb)]
+        # kill any player on the tile where the bomb explodes
+        self.kill_players_at(xb, yb)
+        # explosion to the right, to the left, upward and downward
+        # (the rays already stop at the edges of the map and the hard blocks)
+        for ray in self.blast_rays[yb * self.width + xb]:
+            for x, y in ray:
+                self.blast_tile(x, y)
+
+    def blast_tile(self, x, y):
+        """Propagate an explosion through the tile at (x, y).
+        Returns True if the tile stops the explosion (the blast rays never
+        reach such a tile)."""
+        # kill any player within the explosion radius
+        self.kill_players_at(x, y)
+        content = self.map[y][x]
+        # destroy any destructible block within the radius
+        if content == TileContent.SOFT_BLOCK:
+            self.map[y][x] = TileContent.FREE
+            self._emit(GameEvent.TILE_DESTROYED, x, y)
+        # add any bomb within the radius to a list of bombs to explode
+        elif content == TileContent.BOMB:
+            self.to_explode.append((x, y))
+        # stop the explosion if an indestructible block blocks it
+        elif content == TileContent.HARD_BLOCK:
+            return True
+        return False
+
+    def kill_players_at(self, x, y):
+        for p in self.players:
+            if p.alive and p.x == x and p.y == y:
+                self.kill(p)
+
+    def kill(self, player):
+        """Kill the given player."""
+        player.die()
+        # (keep the player in the list of players but keep him dead)
+        self._emit(GameEvent.PLAYER_KILLED, player.no)
+
+
+def create_engine(width, height, map_init, positions):
+    """Create the engine of a game: an ArrayGameEngine if USE_ARRAY_ENGINE
+    is set and NumPy is installed, a GameEngine otherwise."""
+    if USE_ARRAY_ENGINE:
+        import array_engine
+        if array_engine.numpy is not None:
+            return array_engine.ArrayGameEngine(width, height, map_init, positions)
+    return GameEngine(width, height, map_init, positions)
+
+
+def encode_state(state):
+    """Encode a game state (see GameEngine.get_state), e.g. for the
+    keyframes of a replay, as:
+    - the size of the following data (a 4-byte integer)
+    - the turn number (a 4-byte integer)
+    - the number of players and of bombs (2-byte integers)
+    - the tiles (a byte per tile)
+    - the (x, y, alive) state of each player (2-byte integers, a byte)
+    - the (x, y, counter) state of each bomb, in the engine's order
+    (2-byte integers, a signed byte)"""
+    turn, tiles, players, bombs = state
+    parts = [struct.pack("<IHH", turn, len(players), len(bombs))]
+    parts.extend(str(bytearray(row)) for row in tiles)
+    parts.extend(struct.pack("<HHB", x, y, alive) for x, y, alive in players)
+    parts.extend(struct.pack("<HHb", x, y, i) for x, y, i in bombs)
+    data = "".join(parts)
+    return struct.pack("<I", len(data)) + data
+
+def decode_state(data, width, height):
+    """Decode an encoded game state (without its size)
+    into a game state (see GameEngine.get_state)"""
+    turn, n_players, n_bombs = struct.unpack("<IHH", data[:8])
+    offset = 8
+    tiles = tuple(tuple(bytearray(data[offset + y * width:offset + (y + 1) * width]))
+                  for y in xrange(height))
+    offset += width * height
+    players = []
+    for i in xrange(n_players):
+        x, y, alive = struct.unpack("<HHB", data[offset:offset + 5])
+        players.append((x, y, bool(alive)))
+        offset += 5
+    bombs = []
+    for i in xrange(n_bombs):
+        bombs.append(struct.unpack("<HHb", data[offset:offset + 5]))
+        offset += 5
+    return (turn, tiles, tuple(players), tuple(bombs))
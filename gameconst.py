@@ -5,6 +5,55 @@ VERBOSE = True
 PRINT_PACKETS = True # display every packet sent/received on the console
 DEBUG = True
 
+# serve all the connections (lobby and parties) on a single event loop thread
+# switch to False to use one thread per connection instead
+USE_EVENT_LOOP = True
+
+# number of worker processes hosting the parties, so that games do not share
+# the lobby's GIL (None for one per CPU core, 0 to host them in the lobby process)
+PARTY_WORKERS = 0
+
+# let the clients join the parties through their lobby connection
+# (the parties then do not listen on a port of their own),
+# not supported with PARTY_WORKERS
+MULTIPLEX_PARTIES = False
+
+# the spectators of a party are sent the actions of SPECTATOR_BATCH_TURNS
+# turns at once, SPECTATOR_DELAY_TURNS turns behind the players
+# (see spectator_channel.py)
+SPECTATOR_BATCH_TURNS = 1
+SPECTATOR_DELAY_TURNS = 0
+
+# record every game in a replay file (in REPLAY_DIR, see replay.py)
+RECORD_REPLAYS = False
+REPLAY_DIR = "replays"
+# the number of turns between two snapshots of the game state in a replay
+# (the smaller, the faster the seeks but the bigger the files; 0 for none)
+REPLAY_KEYFRAME_INTERVAL = 500
+
+# run the game rules on NumPy arrays if NumPy is installed
+# (only faster on big boards with many bombs)
+USE_ARRAY_ENGINE = False
+
+# show the local player's actions right away in the party client, on a
+# predicted copy of the game which is corrected when the actions committed
+# by the server differ (see GameController)
+PREDICT_LOCAL_PLAYER = False
+
+# hold the actions committed by the server in a playout buffer in the party
+# client, and play them back on a steady clock, with a delay adapted to the
+# jitter of the network (see JitterBuffer), between the given bounds (in s)
+# (the local player's actions are delayed as well: not meant to be used
+# with PREDICT_LOCAL_PLAYER)
+# tune it with the monitoring tool's DELAY and JITTER
+USE_JITTER_BUFFER = False
+JITTER_BUFFER_MIN_DELAY = 0.02
+JITTER_BUFFER_MAX_DELAY = 1.0
+
+# the largest packet accepted from a peer (in bytes): a longer one is taken
+# for a corrupt or hostile stream, and the connection is closed
+MAX_PACKET_SIZE = 1 << 20
+
 # monitoring tool
 USE_MONITORING = False # switch to True to use it
 DELAY = 200
@@ -0,0 +1,97 @@
+from gameconst import *
+import event_loop
+
+import collections
+
+class JitterBuffer(object):
+    """Playout buffer for the actions committed by the server.
+    The commits are held for a playout delay, then played back one per
+    turn length on a steady clock, so that the jitter of the network does
+    not show as uneven moves.
+    The jitter is estimated from the deviation of the inter-arrival times
+    from the turn length (a running mean, as in RFC 3550), and the delay
+    follows it (DELAY_FACTOR times the jitter, within the given bounds).
+    If the buffer runs dry (an underrun: a commit was later than the delay),
+    the clock is restarted when the next commit arrives. If it holds more
+    commits than the delay calls for (e.g. after the delay went down), the
+    commits are played slightly faster until it has caught up."""
+    # the weight of a new sample in the jitter estimate
+    JITTER_GAIN = 1.0 / 16
+    # the playout delay, in multiples of the jitter estimate
+    DELAY_FACTOR = 4.0
+    # how much faster the commits are played to catch up
+    CATCH_UP = 0.1
+
+    def __init__(self, turn_length, min_delay=JITTER_BUFFER_MIN_DELAY,
+                 max_delay=JITTER_BUFFER_MAX_DELAY):
+        """turn_length: the time between two commits (in s)
+        min_delay, max_delay: the bounds of the playout delay (in s)"""
+        self.turn_length = turn_length
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        # the jitter estimate and the playout delay (in s)
+        self.jitter = 0.0
+        self.delay = min_delay
+        # the number of underruns, and of commits played so far
+        self.n_underruns = 0
+        self.n_played = 0
+        # the (turn, actions) commits waiting for playout
+        self._commits = collections.deque()
+        self._last_arrival = None
+        # the time the next commit is due (None while the clock is stopped)
+        self._next_playout = None
+
+    @property
+    def depth(self):
+        """The number of commits waiting for playout"""
+        return len(self._commits)
+
+    def push(self, turn, actions, now=None):
+        """Buffer the actions committed on the given turn
+        (now: the time of arrival, on the monotonic clock)"""
+        if now is None:
+            now = event_loop.monotonic()
+        if self._last_arrival is not None:
+            deviation = abs(now - self._last_arrival - self.turn_length)
+            self.jitter += (deviation - self.jitter) * self.JITTER_GAIN
+            self.delay = min(max(self.DELAY_FACTOR * self.jitter,
+                                 self.min_delay), self.max_delay)
+        self._last_arrival = now
+        self._commits.append((turn, actions))
+        if self._next_playout is None:
+            # (re)start the clock
+            self._next_playout = now + self.delay
+
+    def pop_due(self, now=None):
+        """Get the list of the commits due for playout, in order"""
+        if now is None:
+            now = event_loop.monotonic()
+        due = []
+        while self._next_playout is not None and now >= self._next_playout:
+            if not self._commits:
+                self.n_underruns += 1
+                self._next_playout = None
+                break
+            due.append(self._commits.popleft())
+            self._next_playout += self._interval()
+        self.n_played += len(due)
+        return due
+
+    def _interval(self):
+        """The time until the next playout"""
+        target_depth = self.delay / self.turn_length
+        if len(self._commits) > target_depth + 1:
+            return self.turn_length * (1 - self.CATCH_UP)
+        return self.turn_length
+
+    def clear(self):
+        """Drop the commits waiting for playout and stop the clock
+        (e.g. when the state of the game is restored)"""
+        self._commits.clear()
+        self._last_arrival = None
+        self._next_playout = None
+
+    def __str__(self):
+        return ("(depth: %d | delay: %d ms | jitter: %d ms | underruns: %d)" %
+                (self.depth, self.delay * 1000, self.jitter * 1000,
+                 self.n_underruns))
@@ -7,6 +7,7 @@ from direct.showbase.ShowBase import ShowBase
 from direct.showbase import DirectObject
 from direct.gui.DirectGui import *
 
+import binascii
 import socket
 import select
 import sys
@@ -25,6 +26,9 @@ class LobbyClientConnectionHandle(TaskConnectionHandle):
         if packet.type == packets.PacketType.LOBBY:
             packet = packets.LobbyPacket.decode(packet.payload)
             self.client.update_parties(packet.parties)
+        elif packet.type == packets.PacketType.PARTY_PAGE:
+            packet = packets.PartyPagePacket.decode(packet.payload)
+            self.client.update_page(packet)
 
     def _do_on_shutdown(self):
         """On shutdown, notice the client."""
@@ -37,6 +41,8 @@ class LobbyClient(object, ShowBase):
     address_family = socket.AF_INET
     # use TCP sockets
     socket_type = socket.SOCK_STREAM
+    # number of parties shown at once
+    PAGE_SIZE = 6
     
     def __init__(self, partyfile):
         ShowBase.__init__(self)
@@ -46,22 +52,44 @@ class LobbyClient(object, ShowBase):
         # the list of buttons for the current pending parties
         # (fetched from the lobby server)
         self.buttons = []
+        # the page of parties shown (the fullest parties with free slots first)
+        self.page = 0
+        self.page_label = DirectLabel(text="", pos=(0, 0, -0.9),
+            text_fg=(1.0, 1.0, 1.0, 1.0), text_bg=(0, 0, 0, 0),
+            frameColor=(0, 0, 0, 0), scale=0.05, textMayChange=1)
         self.key_handler = LobbyKeyHandler(self)
         self.partyfile = partyfile
         base.setBackgroundColor(0.0, 0.0, 0.0)
     
-    def connect(self, addr):
-        """Connect the client with the server located at the given address."""
-        sock = socket.socket(self.address_family, self.socket_type)
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        sock.connect(addr)
-        if VERBOSE: print "Connected to " + str(addr)
+    def connect(self, addr, sock=None):
+        """Connect the client with the server located at the given address
+        (or use the given socket, already connected to it)."""
+        if sock is None:
+            sock = socket.socket(self.address_family, self.socket_type)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.connect(addr)
+            if VERBOSE: print "Connected to " + str(addr)
         self.conn = LobbyClientConnectionHandle(sock, addr, self)
+        self.send_party_query()
     
     def notice_connection_shutdown(self, handle):
         if VERBOSE: print "The connection to " + str(handle.addr) + " was shut down\nQuitting..."
         self.quit()
     
+    def send_party_query(self):
+        """Ask the server for the current page of parties.
+        The server sends it again whenever it changes."""
+        query_packet = packets.PartyQueryPacket(free_slots=True,
+            order=packets.PartyOrder.FILL_DESC, page=self.page,
+            page_size=self.PAGE_SIZE).wrap()
+        self.conn.send(query_packet)
+    
+    def change_page(self, delta):
+        """Show the next (delta = 1) or previous (delta = -1) page"""
+        if self.page + delta >= 0:
+            self.page += delta
+            self.send_party_query()
+    
     def send_create_party_request(self):
         """Send a create party request to the server."""
         createparty_packet = packets.CreatePartyPacket().wrap()
@@ -85,7 +113,7 @@ class LobbyClient(object, ShowBase):
         for i, p in enumerate(parties):
             label = "party %d: %d/%d" % (p.id, p.n_players, p.max_players)
             action = self.connect_to_party
-            args = ((p.ip, p.port), )
+            args = (p, )
             if i < len(self.buttons):
                 self.buttons[i]['text'] = label
                 self.buttons[i]['command'] = action
@@ -98,10 +126,30 @@ class LobbyClient(object, ShowBase):
             self.buttons[i].destroy()
         self.buttons = self.buttons[:len(parties)]
     
-    def connect_to_party(self, addr):
-        ip, port = addr
-        self.partyfile.write("%s\n" % ip)
-        self.partyfile.write("%d\n" % port)
+    def update_page(self, page):
+        """Show the page of parties sent by the lobby server"""
+        if page.page != self.page:
+            # answer to an outdated query
+            return
+        n_pages = max(1, (page.n_matching + self.PAGE_SIZE - 1) // self.PAGE_SIZE)
+        if self.page >= n_pages:
+            # the page is now past the end of the list, show the last one
+            self.page = n_pages - 1
+            self.send_party_query()
+            return
+        self.page_label['text'] = "page %d/%d" % (self.page + 1, n_pages)
+        self.update_parties(page.parties)
+    
+    def connect_to_party(self, party):
+        self.partyfile.write("%s\n" % party.ip)
+        self.partyfile.write("%d\n" % party.port)
+        if MULTIPLEX_PARTIES:
+            # join the party through this connection, which will be taken over
+            # by the party client along with the bytes not read yet
+            buffered = self.conn.detach()
+            packets.JoinPartyPacket(party.id).wrap().send(self.conn.conn)
+            self.partyfile.write("%d\n" % party.id)
+            self.partyfile.write("%s\n" % binascii.hexlify(buffered))
         if VERBOSE: print "quitting lobby client"
         self.quit()
     
@@ -116,6 +164,8 @@ class LobbyKeyHandler(DirectObject.DirectObject):
         self.master = master
         # init the handler send the actions corresponding to the key pressed
         self.accept('c', self.create_party)
+        self.accept('arrow_right', self.master.change_page, [1])
+        self.accept('arrow_left', self.master.change_page, [-1])
     
     def create_party(self):
         self.master.send_create_party_request()
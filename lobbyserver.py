@@ -1,53 +1,143 @@
-from server import Server
+from server import Server, BaseConnectionHandle
 from thread_connection import *
 import packets
 from gameconst import *
 from partyserver import *
+from party_pool import PartyPool
+from party_registry import PartyRegistry
+import event_loop
 
 import time
 
-class LobbyConnectionHandle(ThreadConnectionHandle):
+class LobbyConnectionHandle(BaseConnectionHandle):
     """This type of connection will listen for 'create new party' packets
     (type 15) and ignore any other packet."""
     packet_class = packets.GamePacket
+    # tells whether the client is pushed the changes of the list of parties
+    # instead of the whole list
+    is_subscribed = False
+    # the last party query of the client, if it asked for pages of the list
+    # instead of the whole list, and the payload of the page last sent
+    query = None
+    last_page = None
     
     def _process_client_packet(self, packet):
         if packet.type == packets.PacketType.CREATE_PARTY:
             self.master.create_party()
+        elif packet.type == packets.PacketType.LOBBY_SUBSCRIBE:
+            self.master.subscribe(self)
+        elif packet.type == packets.PacketType.PARTY_QUERY:
+            query = packets.PartyQueryPacket.decode(packet.payload)
+            self.master.query_parties(self, query)
+        elif packet.type == packets.PacketType.JOIN_PARTY:
+            join_packet = packets.JoinPartyPacket.decode(packet.payload)
+            self.master.join_party(self, join_packet.id)
+        elif packet.type == packets.PacketType.REJOIN_PARTY:
+            rejoin_packet = packets.RejoinPartyPacket.decode(packet.payload)
+            self.master.rejoin_party(self, rejoin_packet.token)
+        elif packet.type == packets.PacketType.SPECTATE_PARTY:
+            spectate_packet = packets.SpectatePartyPacket.decode(packet.payload)
+            self.master.spectate_party(self, spectate_packet.id)
+    
+    def wants_whole_list(self):
+        """Tells whether the client is to be sent the whole list of parties"""
+        return not self.is_subscribed and self.query is None
 
 class LobbyServer(Server):
     """The lobby server maintains a list of pending parties, and creates a new
     party if it receives a packet of appropriate type by a client.
     The lobby server also periodically sends to the connected clients
-    the list of current pending parties and their status."""
+    the list of current pending parties and their status.
+    The clients which subscribed to the changes of the list are sent a
+    snapshot of it first, then an update as soon as some parties are added,
+    removed or changed (or an empty one if nothing changes for a while).
+    The clients which sent a party query are sent the page they asked for,
+    then again whenever it changes."""
     ConnectionHandle = LobbyConnectionHandle
     SEND_INTERVAL = 0.5
+    # max time (in sec) without any update sent to the subscribed clients
+    KEEPALIVE_INTERVAL = 10
+    # time (in sec) left for close changes to be sent in a single update
+    UPDATE_DELAY = 0.05
+    # max number of parties in a page
+    MAX_PAGE_SIZE = 50
     
-    def __init__(self, address, bind_and_listen=True, no_init=False):
+    def __init__(self, address, bind_and_listen=True, no_init=False, n_workers=PARTY_WORKERS):
+        # fork the worker processes hosting the parties (if any) first,
+        # before this process starts any thread
+        self.party_pool = None
+        if not no_init and n_workers != 0:
+            self.party_pool = PartyPool(address, n_workers)
         # init the superclass's fields
         super(LobbyServer, self).__init__(address, bind_and_listen, no_init)
         if not no_init:
             # init the new fields
-            # a list of current pending parties
-            self._parties = []
+            # the current pending parties, indexed by id and fill level
+            self._parties = PartyRegistry()
             # a lock to access and update this resource safely
             self._parties_lock = threading.Lock()
+            # the parties hosted by this process, pending or in game, which
+            # can be watched (id -> PartyServer), under the same lock
+            self._hosted = {}
+            # the number of changes of the list so far, and the lobby packet
+            # last sent to the clients with the number of changes it includes
+            self._n_changes = 0
+            self._lobby_packet = (-1, None)
+            # the ids of the parties changed since the last update
+            self._changed_ids = set()
+            # set when there are changes to send
+            self._changed = threading.Event()
+            # the version of the list last sent to the subscribed clients,
+            # and the info of each party as it was sent (id -> PartyInfo)
+            self._version = 0
+            self._published = {}
+            # a lock keeping the snapshots and updates sent in order
+            self._publish_lock = threading.Lock()
     
     def create_party(self):
         """Creates a new party."""
+        if self.party_pool is not None:
+            # let a worker process host it, it will be added once ready
+            self.party_pool.create_party(self)
+            return
         # instance a new party server
         # new_party = PendingPartyServer.create_new(self)
         new_party = PartyServer.create_new(self)
-        new_party.do_in_thread(fun=new_party.serve_forever)
-        new_party.do_in_thread(fun=new_party.send_loop)
-        
+        if not MULTIPLEX_PARTIES:
+            new_party.do_in_thread(fun=new_party.serve_forever)
+        new_party.start_sending()
+        self._parties_lock.acquire()
+        # ------ enter critical section ------
+        self._hosted[new_party.id] = new_party
+        # ------ exit critical section -------
+        self._parties_lock.release()
+        self.add_party(new_party)
+    
+    def add_party(self, new_party):
+        """Add a party to the list of pending parties.
+        The party may be a PartyServer, or a RemoteParty hosted by a worker."""
         self._parties_lock.acquire()
         # ------ enter critical section ------
         # add the new party server to the list of current pending parties
-        self._parties.append(new_party)
+        self._parties.add(new_party)
+        self._changed_ids.add(new_party.id)
+        self._n_changes += 1
         # ------ exit critical section -------
         self._parties_lock.release()
+        self._changed.set()
         if VERBOSE: print "new party created"
+    
+    def notice_party_update(self, party):
+        """When the status of a pending party changes, it will inform the
+        lobby server by calling this function with itself as argument."""
+        self._parties_lock.acquire()
+        # ------ enter critical section ------
+        self._parties.update(party)
+        self._changed_ids.add(party.id)
+        self._n_changes += 1
+        # ------ exit critical section -------
+        self._parties_lock.release()
+        self._changed.set()
         
     def notice_party_shutdown(self, party):
         """When a party server shutdowns, it will inform the lobby server by
@@ -55,12 +145,78 @@ class LobbyServer(Server):
         self._parties_lock.acquire()
         # ------ enter critical section ------
         # remove the given party server from the list of pending parties
-        self._parties = [p for p in self._parties if p != party]
-        # self._parties = self._parties.remove(party)
-        #         if not self._parties:
-        #             self._parties = []
+        self._parties.remove(party.id)
+        self._changed_ids.add(party.id)
+        self._n_changes += 1
+        # ------ exit critical section -------
+        self._parties_lock.release()
+        self._changed.set()
+    
+    def notice_party_closed(self, party):
+        """When a game is over, the party server will inform the lobby
+        server by calling this function with itself as argument."""
+        self._parties_lock.acquire()
+        # ------ enter critical section ------
+        self._hosted.pop(party.id, None)
+        # ------ exit critical section -------
+        self._parties_lock.release()
+    
+    def join_party(self, handle, idp):
+        """Hand the connection of a lobby client over to the party of given id,
+        so that the client joins it without opening a new connection.
+        The connection is closed if there is no such party waiting for players."""
+        self._parties_lock.acquire()
+        # ------ enter critical section ------
+        party = self._parties.get(idp)
+        # ------ exit critical section -------
+        self._parties_lock.release()
+        # (parties hosted by worker processes cannot take a connection over)
+        # (the party checks its capacity again as it takes the connection over:
+        # another client may take the last seat in between)
+        if not isinstance(party, PartyServer) or not party.accepts_players():
+            if VERBOSE: print "no party %d to join for %s" % (idp, str(handle.addr))
+            handle.shutdown(non_blocking=True)
+            return
+        # stop handling the connection without closing it,
+        # and let the party take it over
+        handle.shutdown(non_blocking=True, silent=True)
+        self._remove_connection(handle)
+        party.adopt_connection(handle)
+    
+    def spectate_party(self, handle, idp):
+        """Hand the connection of a lobby client over to the spectators of
+        the party of given id, pending or in game.
+        The connection is closed if there is no such party in this process."""
+        self._parties_lock.acquire()
+        # ------ enter critical section ------
+        party = self._hosted.get(idp)
         # ------ exit critical section -------
         self._parties_lock.release()
+        if party is None:
+            if VERBOSE: print "no party %d to watch for %s" % (idp, str(handle.addr))
+            handle.shutdown(non_blocking=True)
+            return
+        handle.shutdown(non_blocking=True, silent=True)
+        self._remove_connection(handle)
+        party.spectators.add_spectator(handle)
+    
+    def rejoin_party(self, handle, token):
+        """Hand the connection of a player who lost its connection to a game
+        back to the party of the game, given the player's token.
+        The connection is closed if no game of this process has this token."""
+        self._parties_lock.acquire()
+        # ------ enter critical section ------
+        parties = self._hosted.values()
+        # ------ exit critical section -------
+        self._parties_lock.release()
+        for party in parties:
+            if party.accepts_token(token):
+                handle.shutdown(non_blocking=True, silent=True)
+                self._remove_connection(handle)
+                party.rejoin(handle, token)
+                return
+        if VERBOSE: print "no game to rejoin for %s" % str(handle.addr)
+        handle.shutdown(non_blocking=True)
     
     def get_parties(self):
         self._parties_lock.acquire()
@@ -74,17 +230,124 @@ class LobbyServer(Server):
     
     def send_parties(self):
         """Send to all clients connected to the lobby the list of pending
-        parties."""
-        parties = self.get_parties()
+        parties (but the subscribed ones, which are sent updates instead)."""
+        handles = [h for h in self.get_active_connections() if h.wants_whole_list()]
+        if not handles:
+            return
+        self._parties_lock.acquire()
+        # ------ enter critical section ------
+        parties = list(self._parties)
+        n_changes = self._n_changes
+        # ------ exit critical section -------
+        self._parties_lock.release()
+        # the packet (and its frame) is only built again if the list changed
+        packet_changes, packet = self._lobby_packet
+        if packet_changes != n_changes:
+            parties_info = [p.get_info() for p in parties]
+            packet = packets.LobbyPacket(parties_info).wrap()
+            self._lobby_packet = (n_changes, packet)
+        self.send_to_all(packet, handles)
+    
+    def subscribe(self, handle):
+        """Send the client a snapshot of the list of pending parties,
+        then push it the updates of the list instead of the whole list."""
+        self._publish_lock.acquire()
+        # ------ enter critical section ------
+        handle.is_subscribed = True
+        packet = packets.LobbyUpdatePacket(self._version,
+            self._published.values(), [], is_snapshot=True).wrap()
+        handle.send_client(packet)
+        # ------ exit critical section -------
+        self._publish_lock.release()
+    
+    def send_updates(self, keepalive=False):
+        """Send the parties changed since the last update to the subscribed
+        clients. If nothing changed, an empty update is sent if keepalive is
+        set. Returns True if an update was sent."""
+        self._parties_lock.acquire()
+        # ------ enter critical section ------
+        changed_ids = self._changed_ids
+        self._changed_ids = set()
+        self._changed.clear()
+        parties = dict((idp, self._parties.get(idp)) for idp in changed_ids)
+        # ------ exit critical section -------
+        self._parties_lock.release()
+        self._publish_lock.acquire()
+        # ------ enter critical section ------
+        changed = []
+        removed = []
+        for idp in changed_ids:
+            if parties[idp] is not None:
+                info = parties[idp].get_info()
+                published = self._published.get(idp)
+                if published is None or published.encode() != info.encode():
+                    self._published[idp] = info
+                    changed.append(info)
+            elif self._published.pop(idp, None) is not None:
+                removed.append(idp)
+        if changed or removed:
+            self._version += 1
+        is_sent = bool(changed or removed or keepalive)
+        if is_sent:
+            packet = packets.LobbyUpdatePacket(self._version, changed, removed).wrap()
+            handles = [h for h in self.get_active_connections() if h.is_subscribed]
+            self.send_to_all(packet, handles)
+        # send the pages which changed to the clients which asked for them
+        if changed_ids or keepalive:
+            for handle in self.get_active_connections():
+                if handle.query is not None:
+                    self._send_page(handle, force=keepalive)
+        # ------ exit critical section -------
+        self._publish_lock.release()
+        return is_sent
+    
+    def query_parties(self, handle, query):
+        """Send the client the page of the pending parties it asked for,
+        then again whenever it changes."""
+        self._publish_lock.acquire()
+        # ------ enter critical section ------
+        handle.query = query
+        self._send_page(handle, force=True)
+        # ------ exit critical section -------
+        self._publish_lock.release()
+    
+    def _send_page(self, handle, force=False):
+        """Send the page the client asked for if it changed since
+        the last time (or anyway if force is set).
+        Must be called with the publish lock held."""
+        query = handle.query
+        page_size = min(query.page_size, self.__class__.MAX_PAGE_SIZE)
+        self._parties_lock.acquire()
+        # ------ enter critical section ------
+        n_matching, parties = self._parties.query(query.free_slots,
+            query.order, query.page, page_size)
         parties_info = [p.get_info() for p in parties]
-        packet = packets.LobbyPacket(parties_info).wrap()
-        self.send_to_all(packet)
+        # ------ exit critical section -------
+        self._parties_lock.release()
+        packet = packets.PartyPagePacket(query.page, n_matching, parties_info).wrap()
+        if force or packet.payload != handle.last_page:
+            handle.last_page = packet.payload
+            handle.send_client(packet)
     
     def send_loop(self):
-        """Periodically send to all clients the list pending parties."""
+        """Push the changes of the list of pending parties to the subscribed
+        clients as they come, and periodically send the whole list to the
+        other clients."""
+        now = event_loop.monotonic()
+        next_list = now
+        next_keepalive = now + self.__class__.KEEPALIVE_INTERVAL
         while not self.is_shut_down():
-            self.send_parties()
-            time.sleep(self.__class__.SEND_INTERVAL)
+            now = event_loop.monotonic()
+            if now >= next_list:
+                self.send_parties()
+                next_list = now + self.__class__.SEND_INTERVAL
+            if self._changed.is_set():
+                # let close changes be sent in a single update
+                time.sleep(self.__class__.UPDATE_DELAY)
+            if self.send_updates(keepalive=(now >= next_keepalive)):
+                next_keepalive = event_loop.monotonic() + self.__class__.KEEPALIVE_INTERVAL
+            # wait for the next change or the next thing to send
+            self._changed.wait(max(0, min(next_list, next_keepalive) - event_loop.monotonic()))
         if VERBOSE: print "stop sending parties"
     
     
@@ -0,0 +1,245 @@
+from loop_shutdown import *
+from outbound_queue import *
+from gameconst import *
+from timer_wheel import get_timer_wheel
+
+import packets
+import socket_utils
+import errno
+import socket
+import sys
+
+class LoopConnectionHandle(LoopShutdownMixIn):
+    """Base class for connection handles served by the shared event loop.
+    It has the same interface as ThreadConnectionHandle, but owns no thread:
+    the loop calls the handle back when its socket is readable (or writable,
+    if some data are waiting to be sent), so that a single thread can serve
+    any number of connections.
+    If nothing is read for a given time, the connection will timeout and will
+    be shut down automatically (the timeout is checked on the shared timer
+    wheel, receiving a packet only records the time)."""
+    # tells whether the threads started with do_in_thread should be stopped
+    # when the main thread is done
+    daemon_threads = True
+    # timeout (in sec) to shut down the connection automatically
+    # if no activity is detected
+    timeout = 600
+    # max number of frames waiting to be sent to a slow client
+    max_queue_size = 256
+    # what to do when the queue of a slow client is full
+    queue_policy = QueuePolicy.DROP_STALE
+    # max time (in sec) a client may stay behind before being disconnected
+    max_lag = 10
+    # the packet received from this connection should be read as instances of this class
+    packet_class = packets.GamePacket
+    # dumb client counter, incremented every time a new client is instanced
+    _client_counter = 0
+
+    def __init__(self, conn, addr, master, start=True, no_init=False):
+        super(LoopConnectionHandle, self).__init__()
+        if not no_init:
+            self.conn        = conn # the socket doing the connection
+            self.addr        = addr # the address the socket is connected to
+            self.master      = master # a reference to the owner of the connection
+            # splits the bytes received into packets
+            self._reader = packets.PacketReader(conn, self.__class__.packet_class)
+            # the frames waiting for the socket to be writable
+            # (broadcast frames are shared with the other connections)
+            self._outbound = OutboundQueue(self.__class__.max_queue_size,
+                self.__class__.queue_policy, self.__class__.max_lag)
+            # tells whether the loop is watching the socket for writing
+            self._watching_writes = False
+            # tells whether to shut down once the queued frames are sent
+            self._closing = False
+            # a lock preventing two threads from writing at the same time
+            self._write_lock  = threading.Lock()
+            # get a client id
+            self.id = self.__class__._get_new_id()
+            if start:
+                self.start_handling()
+
+    @classmethod
+    def from_instance(cls, handle, master=None, start=True):
+        """Create a new connection handle from an existing one,
+        owned by the given master (by default, the same one).
+        The packets received and the frames queued by the existing handle
+        are taken over by the new one."""
+        new = cls(None, None, None, start=False, no_init=True)
+        new.conn        = handle.conn # the socket doing the connection
+        new.addr        = handle.addr # the address the socket is connected to
+        new.master      = master or handle.master # a reference to the owner of the connection
+        new._reader     = handle._reader
+        new._outbound   = handle._outbound
+        # (the frames queued are kept, under the limits of this class)
+        new._outbound.set_limits(cls.max_queue_size, cls.queue_policy, cls.max_lag)
+        new._watching_writes = False
+        new._closing    = False
+        new._write_lock = handle._write_lock
+        new.id          = handle.id # the client id
+        if start:
+            new.start_handling()
+        return new
+
+    def start_handling(self):
+        """Start processing the connection"""
+        if VERBOSE: print "handling " + str(self.addr)
+        self.conn.setblocking(0)
+        self._last_activity = self.loop.time()
+        self.do_on_readable(self.conn, self._on_readable)
+        self.do_in_loop(self._schedule_timeout)
+        # process the packets received and send the frames queued before the
+        # handle was started (e.g. by the handle it was created from)
+        self.do_in_loop(self._process_packets, (self._reader.buffered_packets(), ))
+        if self._outbound:
+            self.do_in_loop(self._on_writable)
+
+    def _schedule_timeout(self):
+        """Check for inactivity when the timeout would be due"""
+        deadline = self._last_activity + self.__class__.timeout
+        timer = get_timer_wheel().add(deadline, self._check_timeout)
+        # (the timer is cancelled on shutdown with the loop timers)
+        self._timers.append(timer)
+        self._idle_timer = timer
+
+    def _check_timeout(self):
+        if self.is_shut_down():
+            return
+        self._timers.remove(self._idle_timer)
+        if self.loop.time() - self._last_activity >= self.__class__.timeout:
+            # if the time is over, shut down the process
+            self.shutdown(non_blocking=True)
+        else:
+            # some packets were received since, wait for the new deadline
+            self._schedule_timeout()
+
+    def _on_readable(self):
+        """Read whatever is available and process every whole packet"""
+        try:
+            received = self._reader.recv_packets()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            # if the connection was closed on the client side,
+            # shut down the process
+            self.shutdown(non_blocking=True)
+            return
+        try:
+            self._process_packets(received)
+        except packets.PacketTooLarge, e:
+            # the stream cannot be trusted anymore: close it
+            if VERBOSE: print >> sys.stderr, str(e)
+            self.shutdown(non_blocking=True)
+
+    def _process_packets(self, received):
+        """Process the received packets, until the handle is shut down
+        (the remaining ones stay buffered in the reader)"""
+        for packet in received:
+            try:
+                if PRINT_PACKETS:
+                    print "Received: " + str(packet) + " from " + str(self.addr)
+                # process it
+                self._process_client_packet(packet)
+                # this client is active, push back the timeout
+                self._last_activity = self.loop.time()
+            except packets.PacketMismatch, e:
+                if VERBOSE: print >> sys.stderr, str(e)
+            if self.is_shut_down():
+                break
+
+    def _process_client_packet(self, packet):
+        """Process a packet which was sent by the client.
+        May be overriden."""
+        pass
+
+    def _do_on_shutdown(self):
+        """On shutdown, notice the master."""
+        if VERBOSE: print "shutting down " + str(self.addr)
+        self.master.notice_connection_shutdown(self)
+
+    def close_connection(self):
+        """Close the socket doing the connection"""
+        socket_utils.shutdown_close(self.conn)
+
+    def send_client(self, packet):
+        """Send a packet to the connected client.
+        What cannot be sent right away is queued and sent by the loop
+        as soon as the socket is writable, so this never blocks."""
+        if self.is_shut_down():
+            return
+        self._write_lock.acquire()
+        # ------ enter critical section ------
+        try:
+            was_empty = not self._outbound
+            self._outbound.push(packet.encode())
+            if was_empty:
+                self._flush()
+        except QueueOverflow, e:
+            # the client is too far behind, disconnect it
+            if VERBOSE: print >> sys.stderr, str(self.addr) + ": " + str(e)
+            self._outbound.clear()
+            self.shutdown(non_blocking=True)
+        # ------ exit critical section -------
+        self._write_lock.release()
+        if PRINT_PACKETS:
+            print "Sent " + str(packet) + " to " + str(self.addr)
+
+    def shutdown_when_flushed(self):
+        """Shut the connection down once the frames queued are sent
+        (or after max_lag seconds, if the client does not read them)."""
+        self.do_in_loop(self._shutdown_when_flushed)
+
+    def _shutdown_when_flushed(self):
+        if self.is_shut_down():
+            return
+        self._write_lock.acquire()
+        # ------ enter critical section ------
+        self._closing = True
+        is_empty = not self._outbound
+        # ------ exit critical section -------
+        self._write_lock.release()
+        if is_empty:
+            self.shutdown(non_blocking=True)
+        else:
+            self.do_later(self.__class__.max_lag, self.shutdown, (True, ))
+
+    def get_send_stats(self):
+        """Get the outbound queue depth and drop counters of this connection"""
+        return self._outbound.get_stats()
+
+    def _flush(self):
+        """Send as much of the queued frames as the socket accepts.
+        Must be called with the write lock held."""
+        try:
+            is_empty = self._outbound.flush(self.conn)
+        except socket.error, e:
+            self._outbound.clear()
+            self.shutdown(non_blocking=True)
+            return
+        if is_empty and self._closing:
+            self.shutdown(non_blocking=True)
+            return
+        # watch the socket for writing only while there is something to send
+        if is_empty == self._watching_writes:
+            self._watching_writes = not self._watching_writes
+            self.do_in_loop(self._update_write_watch)
+
+    def _update_write_watch(self):
+        if self.is_shut_down():
+            return
+        if self._watching_writes:
+            self.do_on_writable(self.conn, self._on_writable)
+        else:
+            self.stop_on_writable(self.conn)
+
+    def _on_writable(self):
+        self._write_lock.acquire()
+        # ------ enter critical section ------
+        self._flush()
+        # ------ exit critical section -------
+        self._write_lock.release()
+
+    @classmethod
+    def _get_new_id(cls):
+        """create a fresh id for a new client"""
+        cls._client_counter += 1
+        return cls._client_counter
@@ -0,0 +1,112 @@
+from gameconst import *
+import event_loop
+import threading
+
+class LoopShutdownMixIn(object):
+    """Mix-In class to serve sockets on the shared event loop until a shutdown
+    request is emitted. It offers the same interface as ThreadShutdownMixIn,
+    but instead of running its own loop in a thread, the process registers
+    its sockets and timers on the loop, which calls it back when needed."""
+    # tells whether the threads started with do_in_thread should be stopped
+    # when the main thread is done
+    # daemon_threads
+
+    def __init__(self):
+        self._silent_shutdown = False
+        # this event enables an other process to wait
+        # until this process is effectively shut down
+        self._is_shut_down = threading.Event()
+        # the loop serving this process
+        self.loop = event_loop.get_event_loop()
+        # the sockets and timers registered by this process on the loop,
+        # they are all removed on shutdown
+        self._readers = []
+        self._writers = []
+        self._timers = []
+
+    def do_in_loop(self, fun, args=()):
+        """Call fun(*args) on the loop's thread:
+        immediately if we already are on it, as soon as possible otherwise."""
+        if self.loop.in_loop_thread():
+            fun(*args)
+        else:
+            self.loop.call_soon_threadsafe(fun, args)
+
+    def do_on_readable(self, sock, fun, args=()):
+        """Call fun(*args) every time sock has data to read,
+        until this process is shut down."""
+        def register():
+            self._readers.append(sock)
+            self.loop.add_reader(sock, fun, args)
+        self._is_shut_down.clear()
+        self.do_in_loop(register)
+
+    def do_on_writable(self, sock, fun, args=()):
+        """Call fun(*args) every time data can be written to sock,
+        until stop_on_writable is called or this process is shut down.
+        Must be called from the loop's thread."""
+        if sock not in self._writers:
+            self._writers.append(sock)
+        self.loop.add_writer(sock, fun, args)
+
+    def stop_on_writable(self, sock):
+        """Stop watching sock for writing.
+        Must be called from the loop's thread."""
+        if sock in self._writers:
+            self._writers.remove(sock)
+        self.loop.remove_writer(sock)
+
+    def do_later(self, delay, fun, args=()):
+        """Call fun(*args) in delay seconds, unless this process is shut down
+        in the meantime. Must be called from the loop's thread."""
+        def run():
+            self._timers.remove(timer)
+            fun(*args)
+        timer = self.loop.call_later(delay, run)
+        self._timers.append(timer)
+        return timer
+
+    def _do_on_shutdown(self):
+        """This function is called just before the process is shut-downed.
+
+        May be overriden"""
+        pass
+
+    def shutdown(self, non_blocking=False, silent=False):
+        # if the silent option is true, the process will be shut down
+        # without calling the usual _do_on_shutdown
+        self._silent_shutdown = silent
+        self.do_in_loop(self._shutdown_now)
+        # never wait on the loop's thread: it is the one doing the shutdown
+        if not non_blocking and not self.loop.in_loop_thread():
+            self._is_shut_down.wait()
+
+    def _shutdown_now(self):
+        """Unregister everything from the loop and notice the shutdown.
+        Runs on the loop's thread."""
+        if self._is_shut_down.is_set():
+            return
+        for sock in self._readers:
+            self.loop.remove_reader(sock)
+        for sock in self._writers:
+            self.loop.remove_writer(sock)
+        for timer in self._timers:
+            timer.cancel()
+        self._readers, self._writers, self._timers = [], [], []
+        try:
+            if not self._silent_shutdown:
+                self._do_on_shutdown()
+        finally:
+            self._is_shut_down.set()
+
+    def is_shut_down(self):
+        return self._is_shut_down.is_set()
+
+    def do_in_thread(self, fun=(lambda: None), args=()):
+        t = threading.Thread(
+            target=fun,
+            args=args
+        )
+        t.daemon = self.daemon_threads
+        t.start()
+        return t
@@ -4,10 +4,12 @@ from gameconst import *
 
 class GridMap(object):
     """docstring for MapGrid"""
-    def __init__(self, height, width):
+    def __init__(self, height, width, free=()):
         super(GridMap, self).__init__()
         self.height = height
         self.width = width
+        # other tiles to keep free (e.g. the start positions beyond the corners)
+        self.free = set(free)
         self.init_grid()
     
     def init_grid(self):
@@ -58,7 +60,8 @@ class GridMap(object):
         #     print "bottom left %d, %d" % (i, j)
         # elif bottom_right:
         #     print "bottom right %d, %d" % (i, j)
-        return (top_left or top_right or bottom_left or bottom_right)
+        return (top_left or top_right or bottom_left or bottom_right or
+                (i, j) in self.free)
         # b = (
         #     ((i == 1 and (j == 1 or j == 2)) or (i == 2 and j == 1)) or # top left
         #     ((i == 1 and (j == self.width - 1 or j == self.width - 2)) or (i == 2 and j == self.width - 1)) or # top right
@@ -99,8 +102,29 @@ class GridMap(object):
                 for t in row]) for row in self.grid])
 
 
-def generate(n, m):
-    gridmap = GridMap(n + 2, m + 2)
+def start_positions(n, m, k):
+    """The start positions of k players on a n x m board: the corners first,
+    then evenly spread on the edges (on the tiles which are never blocks)"""
+    poss = [(0, 0), (n - 1, 0), (0, m - 1), (n - 1, m - 1)][:k]
+    # the players beyond the corners are dealt in turn to each edge
+    # (top, bottom, left, right) and spread evenly on it
+    per_edge = [(k - 4 + 3 - e) // 4 for e in xrange(4)]
+    for e, count in enumerate(per_edge):
+        length = n if e < 2 else m
+        for i in xrange(count):
+            # (an even coordinate: a hard block is at odd x and odd y)
+            c = (length - 1) * (i + 1) // (count + 1) // 2 * 2
+            poss.append([(c, 0), (c, m - 1), (0, c), (n - 1, c)][e])
+    return poss
+
+def generate(n, m, positions=()):
+    """Generate the tiles of a n x m board (flattened), keeping the given
+    start positions and their neighbours free (the corners always are)"""
+    free = set()
+    for (x, y) in positions:
+        for (dx, dy) in [(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)]:
+            free.add((x + dx + 1, y + dy + 1))
+    gridmap = GridMap(n + 2, m + 2, free)
     gridmap.iter_next_gen(2)
     return [gridmap.grid[i + 1][j + 1] for j in xrange(m) for i in xrange(n)]
 
@@ -0,0 +1,146 @@
+from gameconst import *
+from packets import PacketType
+import event_loop
+import enum
+import socket_utils
+
+import collections
+import errno
+import itertools
+import socket
+import struct
+
+QueuePolicy = enum.enum("QueuePolicy",
+    # make room by dropping the oldest snapshot frames waiting to be sent
+    DROP_STALE = 1,
+    # a new snapshot frame replaces the one of the same type waiting to be sent
+    COALESCE = 2,
+    # never drop anything: disconnect the client once its queue is full
+    DISCONNECT = 3
+)
+
+
+class QueueOverflow(Exception):
+    """Exception raised when a client is too far behind to be sent a frame."""
+    pass
+
+
+class OutboundQueue(object):
+    """A bounded queue of the frames waiting to be sent to a client.
+    Frames are pushed without ever blocking, and flushed whenever the socket
+    is writable. When a client cannot keep up, its queue is kept bounded
+    according to the queue policy, and it is disconnected (QueueOverflow)
+    if it stays behind for longer than max_lag seconds.
+    Only snapshot frames (lobby and party status) are ever dropped:
+    each of them makes the previous ones of the same type useless."""
+    # the packet types of the snapshot frames
+    SNAPSHOT_TYPES = (PacketType.LOBBY, PacketType.PARTY_STATUS)
+
+    def __init__(self, max_size, policy=QueuePolicy.DROP_STALE, max_lag=None):
+        # max number of frames waiting to be sent
+        self.max_size = max_size
+        self.policy = policy
+        # max time (in sec) the queue may stay non-empty, None for no limit
+        self.max_lag = max_lag
+        # the (packet type, frame) waiting to be sent
+        self._frames = collections.deque()
+        # the number of bytes of the first frame already sent
+        self._offset = 0
+        # the time since when the queue was not empty (None if empty)
+        self._behind_since = None
+        # counters
+        self.n_bytes = 0
+        self.n_dropped = 0
+        self.n_coalesced = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def set_limits(self, max_size, policy, max_lag=None):
+        """Change the limits and the policy of the queue, keeping the frames
+        waiting (e.g. when the connection is handed over to another kind of
+        handle)"""
+        self.max_size = max_size
+        self.policy = policy
+        self.max_lag = max_lag
+
+    def get_stats(self):
+        """Get the queue depth and drop counters"""
+        return {
+            'depth': len(self._frames),
+            'bytes': self.n_bytes,
+            'dropped': self.n_dropped,
+            'coalesced': self.n_coalesced,
+        }
+
+    def push(self, frame):
+        """Queue a frame to be sent.
+        Raises QueueOverflow if the client should be disconnected."""
+        now = event_loop.monotonic()
+        if self._behind_since is None:
+            self._behind_since = now
+        elif self.max_lag is not None and now - self._behind_since > self.max_lag:
+            raise QueueOverflow("client behind for %.1f s" % (now - self._behind_since))
+        ptype = struct.unpack_from("B", frame, 4)[0]
+        is_snapshot = ptype in self.SNAPSHOT_TYPES
+        if is_snapshot and self.policy == QueuePolicy.COALESCE:
+            if self._remove_first(lambda t: t == ptype):
+                self.n_coalesced += 1
+        if len(self._frames) >= self.max_size:
+            if self.policy == QueuePolicy.DROP_STALE:
+                if self._remove_first(lambda t: t in self.SNAPSHOT_TYPES):
+                    self.n_dropped += 1
+                elif is_snapshot:
+                    # nothing else to drop, but the new frame
+                    self.n_dropped += 1
+                    return
+            if len(self._frames) >= self.max_size:
+                raise QueueOverflow("outbound queue full (%d frames)" % len(self._frames))
+        self._frames.append((ptype, frame))
+        self.n_bytes += len(frame)
+
+    def _remove_first(self, matches):
+        """Remove the first waiting frame whose type matches (never the one
+        being sent). Returns True if a frame was removed."""
+        start = 1 if self._offset else 0
+        for i in xrange(start, len(self._frames)):
+            ptype, frame = self._frames[i]
+            if matches(ptype):
+                del self._frames[i]
+                self.n_bytes -= len(frame)
+                return True
+        return False
+
+    def flush(self, sock):
+        """Send as many frames as the (non-blocking) socket accepts.
+        Returns True if the queue is empty.
+        Raises socket.error if the connection is broken."""
+        frames = self._frames
+        try:
+            while frames:
+                buffers = [f for _, f in itertools.islice(frames,
+                    socket_utils.MAX_SEND_BUFFERS)]
+                if self._offset:
+                    buffers[0] = memoryview(buffers[0])[self._offset:]
+                sent = socket_utils.send_buffers(sock, buffers)
+                if not sent:
+                    raise socket.error("socket connection broken")
+                self.n_bytes -= sent
+                # drop the frames which were entirely sent
+                sent += self._offset
+                while frames and sent >= len(frames[0][1]):
+                    sent -= len(frames.popleft()[1])
+                self._offset = sent
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise
+        if not frames:
+            self._behind_since = None
+            return True
+        return False
+
+    def clear(self):
+        self._frames.clear()
+        self._offset = 0
+        self.n_bytes = 0
+        self._behind_since = None
@@ -4,25 +4,65 @@ import socket_utils
 import inspect
 import enum
 import random
+import zlib
+import collections
 from gameconst import *
 
 UINT32_MAX = pow(2, 32) - 1
 
+# the formats of the codec are compiled once: every packet class keeps the
+# structs of its fixed-size fields, and the arrays (e.g. a list of k
+# integers) are compiled on first use by get_array_struct
+UINT8 = struct.Struct("<B")
+UINT32 = struct.Struct("<I")
+UINT64 = struct.Struct("<Q")
+
+# the structs of the arrays, by format code then by length
+_array_structs = collections.defaultdict(dict)
+
+def get_array_struct(code, n):
+    """Get the compiled struct of an array of n values of the given format
+    code (e.g. 'I' for 4-byte unsigned integers)"""
+    structs = _array_structs[code]
+    s = structs.get(n)
+    if s is None:
+        s = structs[n] = struct.Struct("<%d%s" % (n, code))
+    return s
+
 
 PacketType = enum.enum("PacketType",
     LOBBY = 1,
+    LOBBY_SUBSCRIBE = 2,
+    LOBBY_UPDATE = 3,
+    PARTY_QUERY = 4,
+    PARTY_PAGE = 5,
     CREATE_PARTY = 15,
+    JOIN_PARTY = 16,
+    SPECTATE_PARTY = 17,
+    REJOIN_PARTY = 18,
 
     PARTY_STATUS = 21,
     INIT = 32,
+    STATE_SNAPSHOT = 33,
+
+    ACTION = 42,
+    ACTION_BATCH = 43
+)
 
-    ACTION = 42
+PartyOrder = enum.enum("PartyOrder",
+    # the fullest parties first
+    FILL_DESC = 1,
+    # the emptiest parties first
+    FILL_ASC = 2
 )
 
 
 class PartyInfo(object):
-    """Represents a pending party, waiting for players"""
-    SIZE = struct.calcsize("<IBBBBHII")
+    """Represents a pending party, waiting for players.
+    A PartyInfo is not to be modified once created (a new one is created when
+    the party changes), so that it is only encoded once."""
+    RECORD = struct.Struct("<I4sHII")
+    SIZE = RECORD.size
     
     def __init__(self, idp, ip, port, n_players, max_players):
         self.id = idp
@@ -30,6 +70,8 @@ class PartyInfo(object):
         self.port = port
         self.n_players = n_players
         self.max_players = max_players
+        # the encoded record, built on first use
+        self._encoded = None
 
     def __repr__(self):
         return "(%d | (%s, %d) | %d / %d)" % (self.id, self.ip, self.port,
@@ -38,23 +80,30 @@ class PartyInfo(object):
     def __str__(self):
         return "(id: %d | address: (%s, %d) | %d player(s) / %d max)" % (
             self.id, self.ip, self.port, self.n_players, self.max_players)
+    
+    @classmethod
+    def random(cls):
+        ip = socket.inet_ntoa(UINT32.pack(random.randint(0, UINT32_MAX)))
+        return cls(random.randint(0, UINT32_MAX), ip, random.randint(0, 65535),
+            random.randint(0, NUM_PLAYERS), NUM_PLAYERS)
 
     def encode(self):
         """Encode a single party"""
-        data = struct.pack("<I", self.id)
-        data += socket.inet_aton(self.ip)
-        data += struct.pack("<HII", self.port, self.n_players, self.max_players)
-        return data
-        # return (struct.pack("<I", self.id) + socket.inet_aton(self.ip) +
-        #             struct.pack("<H<I<I", self.port, self.n_players, self.max_players))
+        if self._encoded is None:
+            self._encoded = self.RECORD.pack(self.id, socket.inet_aton(self.ip),
+                self.port, self.n_players, self.max_players)
+        return self._encoded
     
     @classmethod
-    def decode(cls, data):
-        idp = struct.unpack("<I", data[:4])[0]
-        ip = socket.inet_ntoa(data[4:8])
-        port, n_p, max_p = struct.unpack("<HII", data[8:])
-        # idp, ip, port, n_p, max_p = struct.unpack("<IBBB<H<I<I", data)
-        return cls(idp, ip, port, n_p, max_p)
+    def decode(cls, data, offset=0):
+        """Decode a single party, at the given offset of data"""
+        idp, ip, port, n_p, max_p = cls.RECORD.unpack_from(data, offset)
+        return cls(idp, socket.inet_ntoa(ip), port, n_p, max_p)
+    
+    @classmethod
+    def decode_list(cls, data, offset, n):
+        """Decode n consecutive parties, from the given offset of data"""
+        return [cls.decode(data, offset + cls.SIZE * i) for i in xrange(n)]
     
 
 class SubPacket(object):
@@ -89,20 +138,174 @@ class LobbyPacket(SubPacket):
     def __str__(self):
         return "(num parties: %d | parties: %s)" % (self.n_parties, str(self.parties))
     
+    @classmethod
+    def random(cls, n_parties=None):
+        if n_parties is None:
+            n_parties = random.randint(0, 16)
+        return cls([PartyInfo.random() for i in xrange(n_parties)])
+    
     def encode(self):
-        data = struct.pack("<I", self.n_parties)
-        for p in self.parties:
-            data += p.encode()
-        return data
+        data = [UINT32.pack(self.n_parties)]
+        data.extend(p.encode() for p in self.parties)
+        return "".join(data)
     
     @classmethod
     def decode(cls, data):
-        n_parties = struct.unpack("<I", data[:4])[0]
-        parties = [ PartyInfo.decode(
-            data[4 + PartyInfo.SIZE * i : 4 + PartyInfo.SIZE * (i + 1)])
-            for i in range(n_parties) ]
+        n_parties = UINT32.unpack_from(data)[0]
+        return cls(PartyInfo.decode_list(data, UINT32.size, n_parties))
+
+class LobbySubscribePacket(SubPacket):
+    """A packet sent by a client to the lobby to be pushed the changes of the
+    list of pending parties (see LobbyUpdatePacket) instead of the whole list
+    every time. The clients which never send it keep receiving LobbyPackets."""
+    TYPE = PacketType.LOBBY_SUBSCRIBE
+    
+    def __init__(self):
+        pass
+    
+    def encode(self):
+        return ""
         
-        return cls(parties)
+    @classmethod
+    def decode(cls, data):
+        return cls()
+
+class LobbyUpdatePacket(SubPacket):
+    """A lobby update packet is composed of:
+    - a 4-byte version number of the list of pending parties
+    (incremented by each change, unchanged by a keepalive)
+    - a single byte flag, set if the update is a whole snapshot of the list:
+    the parties which are not part of it are to be forgotten
+    - a 4-byte integer for the number of parties added or changed
+    - for each of them, the party (as in a lobby packet)
+    - a 4-byte integer for the number of parties removed
+    - for each of them, its 4-byte ID"""
+    TYPE = PacketType.LOBBY_UPDATE
+    HEADER = struct.Struct("<IBI")
+    
+    def __init__(self, version, parties, removed, is_snapshot=False):
+        self.version = version
+        # the parties added or changed
+        self.parties = parties
+        # the IDs of the parties removed
+        self.removed = removed
+        self.is_snapshot = is_snapshot
+    
+    def __repr__(self):
+        return "(%d | %d | %s | %s)" % (self.version, self.is_snapshot,
+            repr(self.parties), repr(self.removed))
+    
+    def __str__(self):
+        return "(version: %d | snapshot: %s | parties: %s | removed: %s)" % (
+            self.version, self.is_snapshot, str(self.parties), str(self.removed))
+    
+    @classmethod
+    def random(cls, n_parties=None):
+        if n_parties is None:
+            n_parties = random.randint(0, 16)
+        parties = [PartyInfo.random() for i in xrange(n_parties)]
+        removed = [random.randint(0, UINT32_MAX) for i in xrange(random.randint(0, 16))]
+        return cls(random.randint(0, UINT32_MAX), parties, removed,
+            random.choice((True, False)))
+    
+    def encode(self):
+        data = [self.HEADER.pack(self.version, self.is_snapshot, len(self.parties))]
+        data.extend(p.encode() for p in self.parties)
+        n_removed = len(self.removed)
+        data.append(UINT32.pack(n_removed))
+        data.append(get_array_struct('I', n_removed).pack(*self.removed))
+        return "".join(data)
+    
+    @classmethod
+    def decode(cls, data):
+        version, is_snapshot, n_parties = cls.HEADER.unpack_from(data)
+        offset = cls.HEADER.size
+        parties = PartyInfo.decode_list(data, offset, n_parties)
+        offset += PartyInfo.SIZE * n_parties
+        n_removed = UINT32.unpack_from(data, offset)[0]
+        removed = list(get_array_struct('I', n_removed).unpack_from(data,
+            offset + UINT32.size))
+        return cls(version, parties, removed, bool(is_snapshot))
+
+class PartyQueryPacket(SubPacket):
+    """A packet sent by a client to the lobby to get a page of the pending
+    parties (see PartyPagePacket) instead of the whole list. The page is sent
+    again whenever it changes, until an other query is sent.
+    It is composed of:
+    - a single byte flag, set to only get the parties with free slots
+    - a single byte for the order of the parties (see PartyOrder)
+    - a 4-byte page number (from 0)
+    - a 4-byte integer for the number of parties per page"""
+    TYPE = PacketType.PARTY_QUERY
+    STRUCT = struct.Struct("<BBII")
+    
+    def __init__(self, free_slots=True, order=PartyOrder.FILL_DESC, page=0, page_size=10):
+        self.free_slots = free_slots
+        self.order = order
+        self.page = page
+        self.page_size = page_size
+    
+    def __repr__(self):
+        return "(%d | %d | %d | %d)" % (self.free_slots, self.order,
+            self.page, self.page_size)
+    
+    def __str__(self):
+        return "(free slots: %s | order: %s | page: %d | page size: %d)" % (
+            self.free_slots, PartyOrder.to_str(self.order), self.page, self.page_size)
+    
+    @classmethod
+    def random(cls):
+        return cls(random.choice((True, False)), random.choice(PartyOrder.values),
+            random.randint(0, UINT32_MAX), random.randint(0, UINT32_MAX))
+    
+    def encode(self):
+        return self.STRUCT.pack(self.free_slots, self.order, self.page, self.page_size)
+    
+    @classmethod
+    def decode(cls, data):
+        free_slots, order, page, page_size = cls.STRUCT.unpack_from(data)
+        return cls(bool(free_slots), order, page, page_size)
+
+class PartyPagePacket(SubPacket):
+    """A party page packet is the lobby's answer to a party query.
+    It is composed of:
+    - a 4-byte page number
+    - a 4-byte integer for the number of parties matching the query
+    - a 4-byte integer for the number of parties in the page
+    - for each of them, the party (as in a lobby packet)"""
+    TYPE = PacketType.PARTY_PAGE
+    HEADER = struct.Struct("<III")
+    
+    def __init__(self, page, n_matching, parties):
+        self.page = page
+        self.n_matching = n_matching
+        self.parties = parties
+    
+    def __repr__(self):
+        return "(%d | %d | %s)" % (self.page, self.n_matching, repr(self.parties))
+    
+    def __str__(self):
+        return "(page: %d | matching parties: %d | parties: %s)" % (
+            self.page, self.n_matching, str(self.parties))
+    
+    @classmethod
+    def random(cls, n_parties=None):
+        if n_parties is None:
+            n_parties = random.randint(0, 16)
+        parties = [PartyInfo.random() for i in xrange(n_parties)]
+        return cls(random.randint(0, UINT32_MAX), random.randint(n_parties, UINT32_MAX),
+            parties)
+    
+    def encode(self):
+        data = [self.HEADER.pack(self.page, self.n_matching, len(self.parties))]
+        data.extend(p.encode() for p in self.parties)
+        return "".join(data)
+    
+    @classmethod
+    def decode(cls, data):
+        page, n_matching, n_parties = cls.HEADER.unpack_from(data)
+        parties = PartyInfo.decode_list(data, cls.HEADER.size, n_parties)
+        return cls(page, n_matching, parties)
         
 class CreatePartyPacket(SubPacket):
     """A packet sent by a client to create a new party."""
@@ -118,6 +321,67 @@ class CreatePartyPacket(SubPacket):
     def decode(cls, data):
         return cls()
 
+class JoinPartyPacket(SubPacket):
+    """A packet sent by a client on its lobby connection to join a party
+    without opening a new connection: the lobby hands the connection over
+    to the party. It is composed of:
+    - a 4-byte ID of the party to join"""
+    TYPE = PacketType.JOIN_PARTY
+    
+    def __init__(self, idp):
+        self.id = idp
+    
+    def __repr__(self):
+        return "(%d)" % self.id
+    
+    def __str__(self):
+        return "(party id: %d)" % self.id
+    
+    @classmethod
+    def random(cls):
+        return cls(random.randint(0, UINT32_MAX))
+    
+    def encode(self):
+        return UINT32.pack(self.id)
+    
+    @classmethod
+    def decode(cls, data):
+        return cls(UINT32.unpack_from(data)[0])
+
+class SpectatePartyPacket(JoinPartyPacket):
+    """A packet sent by a client on its lobby connection to watch a party,
+    pending or in game: the lobby hands the connection over to the party's
+    spectator channel. It is composed of:
+    - a 4-byte ID of the party to watch"""
+    TYPE = PacketType.SPECTATE_PARTY
+
+class RejoinPartyPacket(SubPacket):
+    """A packet sent by a player on a new lobby connection to get back in
+    the game after its connection was lost: the lobby hands the connection
+    over to the party. It is composed of:
+    - the 8-byte token of the player (see InitPacket)"""
+    TYPE = PacketType.REJOIN_PARTY
+    
+    def __init__(self, token):
+        self.token = token
+    
+    def __repr__(self):
+        return "(%d)" % self.token
+    
+    def __str__(self):
+        return "(token: %d)" % self.token
+    
+    @classmethod
+    def random(cls):
+        return cls(random.randint(0, pow(2, 64) - 1))
+    
+    def encode(self):
+        return UINT64.pack(self.token)
+    
+    @classmethod
+    def decode(cls, data):
+        return cls(UINT64.unpack_from(data)[0])
+
 class PartyStatusPacket(SubPacket):
     """The server hosting the party regularly send a party status packet
     to inform the players of its current status.
@@ -126,17 +390,22 @@ class PartyStatusPacket(SubPacket):
     - a 4-byte integer for the max. number of players expected to be
     in the party before the game starts"""
     TYPE = PacketType.PARTY_STATUS
+    STRUCT = struct.Struct("<II")
 
     def __init__(self, n_players, max_players):
         self.n_players = n_players
         self.max_players = max_players
 
+    @classmethod
+    def random(cls):
+        return cls(random.randint(0, NUM_PLAYERS), NUM_PLAYERS)
+
     def encode(self):
-        return struct.pack("<II", self.n_players, self.max_players)
+        return self.STRUCT.pack(self.n_players, self.max_players)
 
     @classmethod
     def decode(cls, data):
-        n_players, max_players = struct.unpack("<II", data)
+        n_players, max_players = cls.STRUCT.unpack_from(data)
         return cls(n_players, max_players)
         
     def __repr__(self):
@@ -155,10 +424,13 @@ class InitPacket(SubPacket):
     - a 4-byte integer for the width n of the map
     - a 4-byte integer for the height m of the map
     - the concatenated (n x m) tile info
-    - the concatenated k (xi, yi) initial position of each player"""
+    - the concatenated k (xi, yi) initial position of each player
+    - an 8-byte token, for the player to rejoin the game if its connection
+    is lost (see RejoinPartyPacket)"""
     TYPE = PacketType.INIT
+    HEADER = struct.Struct("<IIIII")
     
-    def __init__(self, pID, k, dturn, n, m, tiles, poss):
+    def __init__(self, pID, k, dturn, n, m, tiles, poss, token=0):
         self.player_ID = pID
         self.n_players = k
         self.turn_length = dturn
@@ -168,6 +440,7 @@ class InitPacket(SubPacket):
         self.tiles = tiles
         # positions should be a list of k (x, y) couples
         self.positions = poss
+        self.token = token
     
     def __repr__(self):
         return "(%d | %d | %d | %d | %d | %s | %s)" % (
@@ -180,25 +453,75 @@ class InitPacket(SubPacket):
             self.player_ID, self.n_players, self.turn_length,
             self.width, self.height, str(self.tiles), str(self.positions))
     
+    @classmethod
+    def random(cls, n=BOARD_WIDTH, m=BOARD_HEIGHT, k=NUM_PLAYERS):
+        tiles = [random.choice(TileContent.values) for i in xrange(n * m)]
+        positions = [(random.randint(0, n - 1), random.randint(0, m - 1))
+            for i in xrange(k)]
+        return cls(random.randint(0, k - 1), k, int(TURN_LENGTH * 1000), n, m,
+            tiles, positions, random.randint(0, pow(2, 64) - 1))
+    
     def encode(self):
-        data = struct.pack("<IIIII", self.player_ID, self.n_players,
+        # (the fields are packed into a buffer of the size of the packet,
+        # the tiles as a single block of bytes)
+        n_tiles = len(self.tiles)
+        positions = get_array_struct('I', 2 * len(self.positions))
+        header = self.HEADER
+        buf = bytearray(header.size + n_tiles + positions.size + UINT64.size)
+        header.pack_into(buf, 0, self.player_ID, self.n_players,
             self.turn_length, self.width, self.height)
-        for t in self.tiles:
-            data += struct.pack("B", t)
-        for x, y in self.positions:
-            data += struct.pack("<II", x, y)
-        return data
+        offset = header.size
+        buf[offset:offset + n_tiles] = bytearray(self.tiles)
+        offset += n_tiles
+        positions.pack_into(buf, offset, *[c for p in self.positions for c in p])
+        UINT64.pack_into(buf, offset + positions.size, self.token)
+        return str(buf)
 
     @classmethod
     def decode(cls, data):
-        pID, k, dturn, n, m = struct.unpack("<IIIII", data[:20])
-        data = data[20:]
-        tiles = [ struct.unpack("B", data[i])[0]
-            for i in range(n * m) ]
-        data = data[(n * m):]
-        positions = [ struct.unpack("<II", data[i * 8: (i + 1) * 8])
-            for i in range(k)]
-        return cls(pID, k, dturn, n, m, tiles, positions)
+        pID, k, dturn, n, m = cls.HEADER.unpack_from(data)
+        offset = cls.HEADER.size
+        tiles = list(bytearray(data[offset:offset + n * m]))
+        offset += n * m
+        positions = get_array_struct('I', 2 * k)
+        coords = positions.unpack_from(data, offset)
+        offset += positions.size
+        # (no token if the init packet is from an older server)
+        token = 0
+        if len(data) >= offset + UINT64.size:
+            token = UINT64.unpack_from(data, offset)[0]
+        return cls(pID, k, dturn, n, m, tiles, zip(coords[::2], coords[1::2]), token)
+
+class StateSnapshotPacket(SubPacket):
+    """The state of a game, sent to a player rejoining it right after the
+    init packet: the player restores it, then executes the turns committed
+    from then on. It is composed of the state encoded by
+    game_engine.encode_state, compressed with zlib."""
+    TYPE = PacketType.STATE_SNAPSHOT
+    
+    def __init__(self, data):
+        # the encoded state (uncompressed)
+        self.data = data
+    
+    def __repr__(self):
+        return "(%s)" % repr(self.data)
+    
+    def __str__(self):
+        return "(state: %d bytes)" % len(self.data)
+    
+    @classmethod
+    def random(cls, size=1024):
+        return cls(str(bytearray(random.randint(0, 255) for i in xrange(size))))
+    
+    def encode(self):
+        return zlib.compress(self.data)
+    
+    @classmethod
+    def decode(cls, data):
+        # (zlib does not take memoryviews)
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return cls(zlib.decompress(data))
 
 class ActionRequestPacket(SubPacket):
     """An action packet is composed of:
@@ -207,7 +530,8 @@ class ActionRequestPacket(SubPacket):
     - the action (turn left, drop bomb, etc...)
     represented by a single byte unsigned integer"""
     TYPE = PacketType.ACTION
-    SIZE = 5
+    STRUCT = struct.Struct("<IB")
+    SIZE = STRUCT.size
     
     def __init__(self, turn, action):
         self.turn = turn
@@ -226,11 +550,11 @@ class ActionRequestPacket(SubPacket):
         return cls(turn, action)
     
     def encode(self):
-        return struct.pack("<IB", self.turn, self.action)
+        return self.STRUCT.pack(self.turn, self.action)
     
     @classmethod
     def decode(cls, data):
-        turn, action = struct.unpack("<IB", data)
+        turn, action = cls.STRUCT.unpack_from(data)
         return cls(turn, action)
 
 class ActionsCommitPacket(SubPacket):
@@ -240,7 +564,7 @@ class ActionsCommitPacket(SubPacket):
     - the list of actions performed by each player
     (each action being represented by a single bye unsigned integer)"""
     TYPE = PacketType.ACTION
-    # SIZE = 8 + NUM_PLAYERS
+    HEADER = struct.Struct("<II")
     
     def __init__(self, turn, actions):
         self.turn = turn
@@ -256,22 +580,91 @@ class ActionsCommitPacket(SubPacket):
         ]
         return "(turn: %s | actions: (%s))" % (str(self.turn), ", ".join(actions_str))
     
+    @classmethod
+    def random(cls, num_players=NUM_PLAYERS):
+        actions = tuple(random.choice(Action.values) for i in xrange(num_players))
+        return cls(random.randint(0, UINT32_MAX), actions)
+    
     def encode(self):
-        return struct.pack('<II' + 'B' * self.num_players, self.turn, self.num_players, *self.actions)
+        # (the actions may be any sequence of byte values, e.g. a bytearray)
+        return self.HEADER.pack(self.turn, self.num_players) + str(bytearray(self.actions))
         
     @classmethod
     def decode(cls, data):
-        # items = struct.unpack('<II' + 'B' * NUM_PLAYERS, data)
-        items = struct.unpack('<II', data[:8])
-        turn = items[0]
-        num_players = items[1]
-        actions = struct.unpack('B' * num_players, data[8:])
+        turn, num_players = cls.HEADER.unpack_from(data)
+        actions = get_array_struct('B', num_players).unpack_from(data, cls.HEADER.size)
         return cls(turn, actions)
 
+class ActionsBatchPacket(SubPacket):
+    """The actions committed on consecutive turns, sent to the spectators.
+    An actions batch packet is composed of:
+    - the number of the first turn (a 4-byte unsigned integer)
+    - the number of turns (a 4-byte unsigned integer)
+    - the number of players (a 4-byte unsigned integer)
+    - the actions committed on each turn, in the players' order
+    (a byte per action)"""
+    TYPE = PacketType.ACTION_BATCH
+    HEADER = struct.Struct("<III")
+    
+    def __init__(self, first_turn, num_players, actions):
+        self.first_turn = first_turn
+        self.num_players = num_players
+        # the actions of every turn, concatenated (a string of bytes)
+        self.actions = actions
+        self.num_turns = len(actions) // num_players if num_players else 0
+    
+    def __repr__(self):
+        return "(%d | %d | %d | %s)" % (self.first_turn, self.num_turns,
+            self.num_players, repr(self.actions))
+    
+    def __str__(self):
+        return "(turns: %d to %d | num. players: %d)" % (self.first_turn,
+            self.first_turn + self.num_turns - 1, self.num_players)
+    
+    @classmethod
+    def random(cls, num_turns=None, num_players=NUM_PLAYERS):
+        if num_turns is None:
+            num_turns = random.randint(1, 256)
+        actions = str(bytearray(random.choice(Action.values)
+            for i in xrange(num_turns * num_players)))
+        return cls(random.randint(0, UINT32_MAX), num_players, actions)
+    
+    def get_commits(self):
+        """Get the ActionsCommitPacket of each turn"""
+        k = self.num_players
+        return [ActionsCommitPacket(self.first_turn + i,
+                    tuple(bytearray(self.actions[i * k:(i + 1) * k])))
+                for i in xrange(self.num_turns)]
+    
+    def encode(self):
+        return self.HEADER.pack(self.first_turn, self.num_turns,
+            self.num_players) + self.actions
+    
+    @classmethod
+    def decode(cls, data):
+        first_turn, num_turns, num_players = cls.HEADER.unpack_from(data)
+        offset = cls.HEADER.size
+        actions = data[offset:offset + num_turns * num_players]
+        # (the actions are kept as a string, even from a memoryview)
+        if isinstance(actions, memoryview):
+            actions = actions.tobytes()
+        return cls(first_turn, num_players, actions)
+
 class PacketMismatch(Exception): 
     """Exception raised for errors on a packet's data format."""
     pass
 
+class PacketTooLarge(PacketMismatch):
+    """Exception raised when the length of a packet exceeds MAX_PACKET_SIZE.
+    The stream cannot be resynchronized: the connection has to be closed."""
+    pass
+
+def check_packet_length(length, max_size=MAX_PACKET_SIZE):
+    """Raise PacketTooLarge if a packet of this length is not accepted"""
+    if length > max_size:
+        raise PacketTooLarge("packet of %d bytes (more than %d)" %
+                             (length, max_size))
+
 class GamePacket(object):
     """A game packet is composed of a header including:
     - a 4-bytes little endian integer for the length of the packet
@@ -281,16 +674,28 @@ class GamePacket(object):
     # payload_classes = {} # may be overriden by derived classes
     payload_classes = {
         PacketType.LOBBY: LobbyPacket,
+        PacketType.LOBBY_SUBSCRIBE: LobbySubscribePacket,
+        PacketType.LOBBY_UPDATE: LobbyUpdatePacket,
+        PacketType.PARTY_QUERY: PartyQueryPacket,
+        PacketType.PARTY_PAGE: PartyPagePacket,
         PacketType.CREATE_PARTY: CreatePartyPacket,
+        PacketType.JOIN_PARTY: JoinPartyPacket,
+        PacketType.SPECTATE_PARTY: SpectatePartyPacket,
+        PacketType.REJOIN_PARTY: RejoinPartyPacket,
         
         PacketType.PARTY_STATUS: PartyStatusPacket,
         PacketType.INIT: InitPacket,
+        PacketType.STATE_SNAPSHOT: StateSnapshotPacket,
+        PacketType.ACTION_BATCH: ActionsBatchPacket,
     }
+    HEADER = struct.Struct("<IB")
     
     def __init__(self, ptype, payload):
         self.len = 1 + (len(payload) if payload else 0)
         self.type = ptype
         self.payload = payload
+        # the wire frame, encoded on first use (e.g. once for a broadcast)
+        self._encoded = None
         
     def __repr__(self):
         return "(%s | %s)" % (repr(self.type), repr(self.payload))
@@ -321,26 +726,42 @@ class GamePacket(object):
             payload = PayloadClass().encode()
         return cls(ptype, payload)
     
+    def encode(self):
+        """Return the packet as it is sent on the wire (header included).
+        The frame is only built once, however many times the packet is sent."""
+        if self._encoded is None:
+            payload = self.payload
+            if isinstance(payload, memoryview):
+                payload = payload.tobytes()
+            self._encoded = self.HEADER.pack(self.len, self.type) + payload
+        return self._encoded
+    
     def send(self, socket):
-        packet = struct.pack("<IB", self.len, self.type) + self.payload
-        socket_utils.send(socket, packet)
+        socket_utils.send(socket, self.encode())
             
     @classmethod
     def recv(cls, socket):
         # read the packet's length
         length = cls._read_len(socket)
+        check_packet_length(length)
         # receive the whole packet (without the length)
         packet = socket_utils.recv(socket, length)
+        return cls.decode(packet)
+    
+    @classmethod
+    def decode(cls, packet):
+        """Decode a packet whose length was already read
+        (i.e. the type byte followed by the payload)"""
         # decode the packet type, leave payload as is
-        ptype = struct.unpack("B", packet[0])[0]
-        payload = packet[1:] if length >= 2 else ''
+        ptype = UINT8.unpack_from(packet)[0]
+        payload = packet[1:] if len(packet) >= 2 else ''
         return cls(ptype, payload)
     
     @classmethod
     def _read_len(cls, sock):
         # the first byte of the packet should indicate its length
         len_encoded = socket_utils.recv(sock, 4)
-        return struct.unpack("<I", len_encoded)[0]
+        return UINT32.unpack(len_encoded)[0]
     
     @classmethod
     def _read_type(cls, sock):
@@ -349,5 +770,82 @@ class GamePacket(object):
         if not ptype:
             raise socket.error("socket connection broken")
         else:
-            return struct.unpack("B", ptype_encoded)[0]
+            return UINT8.unpack(ptype_encoded)[0]
+
 
+class PacketReader(object):
+    """Splits the stream of bytes received from a socket into packets.
+    Each call to recv_packets drains the bytes available on the socket into a
+    single growable buffer with one recv_into, and yields every whole packet
+    received so far. The packets which are not iterated over stay buffered.
+    To avoid copies, the payloads of the returned packets are memoryview slices
+    of the buffer. The bytes they point to are never overwritten: when the
+    buffer is full, the pending bytes are moved to a fresh buffer instead.
+    The buffer grows with the bytes actually received, never with the length
+    announced by the peer, and a packet longer than max_packet_size raises
+    PacketTooLarge."""
+    # initial size of the buffer (in bytes)
+    buffer_size = 4096
+    # a fresh buffer is used when less than this many bytes are free at its end
+    min_recv_size = 1024
+    # the longest packet accepted (in bytes)
+    max_packet_size = MAX_PACKET_SIZE
+    
+    def __init__(self, sock, packet_class=GamePacket):
+        self.sock = sock
+        self.packet_class = packet_class
+        self._buffer = bytearray(self.buffer_size)
+        self._view = memoryview(self._buffer)
+        # the bytes in [_start, _end) were received but not yet read as packets
+        self._start = 0
+        self._end = 0
+    
+    def recv_packets(self):
+        """Receive whatever is available on the socket and return an iterator
+        over the whole packets received so far (maybe none).
+        Blocks if the socket is blocking and there is nothing to read.
+        Raises socket.error if the connection was closed, and (on iteration)
+        PacketTooLarge if the peer announced a packet which is too long."""
+        self._make_room(self.min_recv_size)
+        received = self.sock.recv_into(self._view[self._end:])
+        if not received:
+            raise socket.error("socket connection broken")
+        self._end += received
+        return self.buffered_packets()
+    
+    def buffered_packets(self):
+        """Iterate over the whole packets in the pending bytes"""
+        while self._end - self._start >= 4:
+            length = UINT32.unpack_from(self._buffer, self._start)[0]
+            check_packet_length(length, self.max_packet_size)
+            begin = self._start + 4
+            if self._end - begin < length:
+                break
+            self._start = begin + length
+            yield self.packet_class.decode(self._view[begin:begin + length])
+    
+    def get_buffered_bytes(self):
+        """Get the pending bytes (the ones not read as packets yet)"""
+        return self._view[self._start:self._end].tobytes()
+    
+    def feed(self, data):
+        """Add bytes received by other means (e.g. by another reader
+        of the same connection) to the pending bytes"""
+        self._make_room(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+    
+    def _make_room(self, size):
+        """Make sure the end of the buffer can hold the next size bytes"""
+        if len(self._buffer) - self._end >= size:
+            return
+        # move the pending bytes to a fresh buffer, twice as large as needed
+        # (so that a long packet takes a logarithmic number of copies)
+        pending = self._end - self._start
+        new_size = max(self.buffer_size, 2 * (pending + size))
+        buf = bytearray(new_size)
+        buf[:pending] = self._view[self._start:self._end]
+        self._buffer = buf
+        self._view = memoryview(buf)
+        self._start = 0
+        self._end = pending
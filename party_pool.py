@@ -0,0 +1,178 @@
+from partyserver import PartyServer
+from gameconst import *
+import packets
+
+import multiprocessing
+import select
+import sys
+import threading
+
+
+class RemoteParty(object):
+    """Stands for a party hosted by a worker process, in the lobby process.
+    Its info is updated from the reports of the worker."""
+
+    def __init__(self, idp, worker):
+        self.id = idp
+        self.worker = worker
+        self.info = None
+
+    def get_info(self):
+        """Returns the PartyInfo object last reported by the worker."""
+        return self.info
+
+
+class WorkerLobby(object):
+    """Stands for the lobby server, in a worker process.
+    The parties notice it when they are full, and the worker forwards it."""
+
+    def __init__(self, address):
+        self.address = address
+        # the ids of the parties which are no longer pending
+        self.closed = []
+
+    def notice_party_update(self, party):
+        # (the worker reports the status of every pending party anyway)
+        pass
+
+    def notice_party_shutdown(self, party):
+        # (the worker's main thread reads this list and reports it)
+        self.closed.append(party.id)
+
+    def notice_party_closed(self, party):
+        # (the parties of the workers cannot be watched)
+        pass
+
+
+class PartyWorker(multiprocessing.Process):
+    """A worker process hosting parties for the lobby.
+    It receives the ids of the parties to create through a pipe, and reports
+    back the status of its pending parties through the same pipe:
+    - ('info', id, ip, port, n_players, max_players) when it changes
+    - ('closed', id) when the party is no longer pending"""
+    # max time (in sec) between two reports of the pending parties status
+    report_interval = 0.1
+
+    def __init__(self, conn, address, lobby_conns=()):
+        super(PartyWorker, self).__init__()
+        self.daemon = True
+        # the worker's end of the pipe
+        self.conn = conn
+        self.address = address
+        # the lobby's ends of the pipes, inherited by the worker
+        self.lobby_conns = lobby_conns
+
+    def run(self):
+        # only the lobby may hold the lobby's ends of the pipes, so that the
+        # workers see the pipes closed when the lobby is gone
+        for c in self.lobby_conns:
+            c.close()
+        lobby = WorkerLobby(self.address)
+        # the pending parties (id -> party) and their last reported status
+        parties = {}
+        reported = {}
+        try:
+            while True:
+                if self.conn.poll(self.report_interval):
+                    idp = self.conn.recv()
+                    party = PartyServer.create_new(lobby, idp)
+                    party.do_in_thread(fun=party.serve_forever)
+                    party.start_sending()
+                    parties[idp] = party
+                # report the closed parties, then the ones which changed
+                while lobby.closed:
+                    idp = lobby.closed.pop(0)
+                    parties.pop(idp, None)
+                    reported.pop(idp, None)
+                    self.conn.send(('closed', idp))
+                for idp, party in parties.items():
+                    info = party.get_info()
+                    status = (info.ip, info.port, info.n_players, info.max_players)
+                    if reported.get(idp) != status:
+                        reported[idp] = status
+                        self.conn.send(('info', idp) + status)
+        except (EOFError, IOError), e:
+            # the lobby is gone
+            pass
+
+
+class PartyPool(object):
+    """A pool of worker processes hosting the parties of the lobby,
+    so that the games do not share the lobby's GIL.
+    New parties are handed to the workers in turn. A single thread of the
+    lobby process reads the reports of every worker and keeps the matching
+    RemoteParty objects up to date.
+    The pool must be created before the lobby process starts any thread."""
+    # tells whether the report thread should be stopped when the main thread is done
+    daemon_threads = True
+
+    def __init__(self, address, n_workers=None):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        self.workers = []
+        lobby_conns = []
+        for i in xrange(n_workers):
+            lobby_end, worker_end = multiprocessing.Pipe()
+            lobby_conns.append(lobby_end)
+            worker = PartyWorker(worker_end, address, list(lobby_conns))
+            worker.start()
+            worker_end.close()
+            worker.lobby_conn = lobby_end
+            self.workers.append(worker)
+        # the index of the worker hosting the next party
+        self._next_worker = 0
+        # the parties created and still pending (id -> RemoteParty)
+        self._parties = {}
+        # a lock preventing two threads from writing to a pipe at the same time
+        self._send_lock = threading.Lock()
+        self.lobby = None
+        self._thread = None
+
+    def create_party(self, lobby):
+        """Have the next worker create a new party.
+        The lobby's add_party is called once the worker reports its address."""
+        self.lobby = lobby
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._receive_loop, args=())
+            self._thread.daemon = self.daemon_threads
+            self._thread.start()
+        idp = PartyServer.new_id()
+        self._send_lock.acquire()
+        # ------ enter critical section ------
+        worker = self.workers[self._next_worker]
+        self._next_worker = (self._next_worker + 1) % len(self.workers)
+        self._parties[idp] = RemoteParty(idp, worker)
+        worker.lobby_conn.send(idp)
+        # ------ exit critical section -------
+        self._send_lock.release()
+
+    def _receive_loop(self):
+        """Read the reports of every worker and update the parties"""
+        conns = dict((w.lobby_conn.fileno(), w.lobby_conn) for w in self.workers)
+        while conns:
+            ready = select.select(conns.keys(), [], [])[0]
+            for fd in ready:
+                try:
+                    report = conns[fd].recv()
+                except (EOFError, IOError), e:
+                    if VERBOSE: print >> sys.stderr, "party worker is gone"
+                    del conns[fd]
+                    continue
+                self._process_report(report)
+
+    def _process_report(self, report):
+        party = self._parties.get(report[1])
+        if party is None:
+            return
+        if report[0] == 'info':
+            _, idp, ip, port, n_players, max_players = report
+            is_new = party.info is None
+            party.info = packets.PartyInfo(idp, ip, port, n_players, max_players)
+            # the party can be listed once its address is known
+            if is_new:
+                self.lobby.add_party(party)
+            else:
+                self.lobby.notice_party_update(party)
+        elif report[0] == 'closed':
+            del self._parties[party.id]
+            self.lobby.notice_party_shutdown(party)
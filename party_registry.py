@@ -0,0 +1,98 @@
+from packets import PartyOrder
+
+import bisect
+
+class PartyRegistry(object):
+    """The pending parties of the lobby, indexed by id and by fill level
+    (the ratio of players to the max. number of players).
+    The indexes are a dict and sorted lists searched by bisection: a lookup
+    is O(log n), and an insertion or a removal only moves the end of a list
+    in memory. The parties are listed in increasing id order.
+    The registry is not thread-safe: its owner has to lock it."""
+
+    def __init__(self):
+        # id -> (party, fill key)
+        self._parties = {}
+        # the ids of the parties, in increasing order
+        self._ids = []
+        # the fill keys (fill level, id) of the parties, in increasing order
+        self._fills = []
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        parties = self._parties
+        return (parties[idp][0] for idp in self._ids)
+
+    def __contains__(self, idp):
+        return idp in self._parties
+
+    def get(self, idp):
+        """Get the party of given id (None if there is no such party)"""
+        entry = self._parties.get(idp)
+        return entry[0] if entry is not None else None
+
+    @staticmethod
+    def _fill_key(party):
+        info = party.get_info()
+        # a party with no room is as full as it can be
+        fill = float(info.n_players) / info.max_players if info.max_players else 1.0
+        return (fill, party.id)
+
+    def add(self, party):
+        """Add a party, or update its fill level if it was already added"""
+        if party.id in self._parties:
+            self.update(party)
+            return
+        key = self._fill_key(party)
+        self._parties[party.id] = (party, key)
+        bisect.insort(self._ids, party.id)
+        bisect.insort(self._fills, key)
+
+    def update(self, party):
+        """Index the party by its current fill level.
+        Does nothing if the party is not registered."""
+        entry = self._parties.get(party.id)
+        if entry is None:
+            return
+        key = self._fill_key(party)
+        if key != entry[1]:
+            self._remove_key(self._fills, entry[1])
+            bisect.insort(self._fills, key)
+            self._parties[party.id] = (party, key)
+
+    def remove(self, idp):
+        """Remove the party of given id.
+        Returns the party removed (None if there was no such party)."""
+        entry = self._parties.pop(idp, None)
+        if entry is None:
+            return None
+        self._remove_key(self._ids, idp)
+        self._remove_key(self._fills, entry[1])
+        return entry[0]
+
+    @staticmethod
+    def _remove_key(keys, key):
+        i = bisect.bisect_left(keys, key)
+        del keys[i]
+
+    def query(self, free_slots=False, order=PartyOrder.FILL_DESC, page=0, page_size=10):
+        """Get a page of the parties sorted by fill level (then by id,
+        in the same direction), only the ones with free slots if asked.
+        Returns the number of parties matching the query, and the page."""
+        fills = self._fills
+        end = len(fills)
+        if free_slots:
+            # the full parties are at the end of the index
+            end = bisect.bisect_left(fills, (1.0, ))
+        start = page * page_size
+        if start >= end:
+            return end, []
+        if order == PartyOrder.FILL_ASC:
+            keys = fills[start:min(end, start + page_size)]
+        else:
+            keys = fills[max(0, end - start - page_size):end - start]
+            keys.reverse()
+        parties = self._parties
+        return end, [parties[idp][0] for _, idp in keys]
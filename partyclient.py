@@ -8,6 +8,8 @@ from direct.gui.DirectGui import *
 from direct.gui.OnscreenText import OnscreenText
 from direct.task import Task
 import game
+from game_engine import decode_state
+from jitter_buffer import JitterBuffer
 
 from task_connection import TaskConnectionHandle
 import packets
@@ -47,7 +49,13 @@ class PartyClientConnectionHandle(TaskConnectionHandle):
         ask the client to commit them."""
         if packet.type == packets.PacketType.ACTION:
             actions_packet = packets.ActionsCommitPacket.decode(packet.payload)
-            self.client.controller.execute_turn(actions_packet.turn, actions_packet.actions)
+            self.client.receive_commit(actions_packet.turn, actions_packet.actions)
+        # (after a rejoin: the same init packet, then the state of the game)
+        elif packet.type == packets.PacketType.INIT:
+            self.client.token = packets.InitPacket.decode(packet.payload).token
+        elif packet.type == packets.PacketType.STATE_SNAPSHOT:
+            snapshot = packets.StateSnapshotPacket.decode(packet.payload)
+            self.client.restore_state(snapshot)
     
     def _do_on_shutdown(self):
         """On shutdown, notice the client."""
@@ -59,6 +67,8 @@ class PartyClient(object, ShowBase):
     address_family = socket.AF_INET
     # use TCP sockets
     socket_type = socket.SOCK_STREAM
+    # max number of attempts to rejoin the game in a row
+    MAX_REJOIN_ATTEMPTS = 3
     
     def __init__(self):
         ShowBase.__init__(self)
@@ -70,6 +80,14 @@ class PartyClient(object, ShowBase):
         # self.key_handler = PartyKeyHandler(self)
         # boolean flag to tell if the game has started
         self.is_ingame = False
+        # the address of the lobby server, to rejoin the game through it if
+        # the connection is lost (None not to rejoin)
+        self.lobby_addr = None
+        # the token to rejoin the game, and the attempts to rejoin so far
+        self.token = 0
+        self.n_rejoin_attempts = 0
+        # the playout buffer of the commits (if USE_JITTER_BUFFER is set)
+        self.jitter_buffer = None
         # init the world view
         self.init_window()
         
@@ -85,13 +103,19 @@ class PartyClient(object, ShowBase):
             fg=(1.0, 1.0, 1.0, 1.0),
             mayChange=True)
     
-    def connect(self, addr):
-        """Connect the client with the server located at the given address."""
-        sock = socket.socket(self.address_family, self.socket_type)
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        sock.connect(addr)
-        if VERBOSE: print "Connected to " + str(addr)
+    def connect(self, addr, sock=None, buffered=''):
+        """Connect the client with the server located at the given address.
+        If a socket is given, take over this connection instead
+        (e.g. the lobby connection, handed over to the party), along with the
+        bytes received from it but not read yet."""
+        if sock is None:
+            sock = socket.socket(self.address_family, self.socket_type)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.connect(addr)
+            if VERBOSE: print "Connected to " + str(addr)
         self.conn = PartyClientConnectionHandle(sock, addr, self)
+        if buffered:
+            self.conn.feed(buffered)
     
     def update_party_status(self, status):
         """Update the current party status info"""
@@ -108,14 +132,71 @@ class PartyClient(object, ShowBase):
         self.update_status_text(text)
         self.controller = game.GameController(self, init.width, init.height,
             init.turn_length, init.tiles, init.positions, init.player_ID)
+        self.token = init.token
         self.is_ingame = True
+        if USE_JITTER_BUFFER:
+            self.jitter_buffer = JitterBuffer(init.turn_length / 1000.0)
+            taskMgr.add(self.play_commits, 'play commits')
+    
+    def receive_commit(self, turn, actions):
+        """Execute the actions committed on the given turn,
+        or buffer them for playout"""
+        if self.jitter_buffer is not None:
+            self.jitter_buffer.push(turn, actions)
+        else:
+            self.controller.execute_turn(turn, actions)
+    
+    def play_commits(self, task):
+        """Execute the buffered commits due for playout (each frame)"""
+        for turn, actions in self.jitter_buffer.pop_due():
+            self.controller.execute_turn(turn, actions)
+        if self.controller.engine.is_over:
+            if VERBOSE: print "Playout buffer: " + str(self.jitter_buffer)
+            return Task.done
+        return Task.cont
+    
+    def rejoin(self):
+        """Open a new connection to the lobby server and ask it to hand the
+        connection over to the game, with the token of the player."""
+        self.n_rejoin_attempts += 1
+        if VERBOSE: print "Rejoining the game through " + str(self.lobby_addr)
+        sock = socket.socket(self.address_family, self.socket_type)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect(self.lobby_addr)
+        self.conn = PartyClientConnectionHandle(sock, self.lobby_addr, self)
+        self.conn.send(packets.RejoinPartyPacket(self.token).wrap())
+    
+    def restore_state(self, snapshot):
+        """Restore the state of the game sent after a rejoin"""
+        controller = self.controller
+        state = decode_state(snapshot.data[4:], controller.width, controller.height)
+        if self.jitter_buffer is not None:
+            # (the commits buffered before the connection was lost are
+            # already part of the state)
+            self.jitter_buffer.clear()
+        controller.restore_state(state)
+        self.n_rejoin_attempts = 0
     
     def send_action_request(self, action):
         """Send an action request packet to the server."""
         action_packet = packets.ActionRequestPacket(self.controller.turn, action).wrap()
         self.conn.send(action_packet)
+        # show the action before the server commits it (if enabled)
+        self.controller.predict(action)
     
     def notice_connection_shutdown(self, handle):
+        if handle is not self.conn:
+            # (a connection already replaced)
+            return
+        if (self.is_ingame and self.token and self.lobby_addr is not None and
+                not self.controller.engine.is_over and
+                self.n_rejoin_attempts < self.MAX_REJOIN_ATTEMPTS):
+            if VERBOSE: print "The connection to " + str(handle.addr) + " was lost"
+            try:
+                self.rejoin()
+                return
+            except socket.error, e:
+                if VERBOSE: print >> sys.stderr, str(e)
         if VERBOSE: print "The connection to " + str(handle.addr) + " was shut down\nQuitting..."
         self.quit()
         
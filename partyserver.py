@@ -1,13 +1,23 @@
-from server import Server
+from server import Server, BaseConnectionHandle
 from thread_connection import *
 import packets
 from gameconst import *
+from turn_scheduler import get_turn_scheduler
+from game_engine import create_engine, encode_state
 import mapgen
+import replay
+from spectator_channel import SpectatorChannel
 
-import time
+import os
+import struct
+import threading
 
 
-class PartyConnectionHandle(ThreadConnectionHandle):
+class PartyConnectionHandle(BaseConnectionHandle):
+    # the index of the player's actions in the party's action buffers
+    # (assigned when the game starts)
+    slot = None
+    
     def _process_client_packet(self, packet):
         """Record any received ingame packet, else ignore it."""
         if self.master.is_ingame:
@@ -23,28 +33,65 @@ class PartyServer(Server):
     # ID count
     next_id = 0
     
-    def __init__(self, address, lobby, bind_and_listen=True, no_init=False, max_players=NUM_PLAYERS):
+    def __init__(self, address, lobby, bind_and_listen=True, no_init=False, max_players=NUM_PLAYERS, idp=None):
         super(PartyServer, self).__init__(address, bind_and_listen, no_init)
         if not no_init:
-            # assign the next available id and increment the global counter
             self.lobby = lobby
-            self.id = self.__class__.next_id
-            self.__class__.next_id += 1
+            # use the given id or assign the next available one
+            self.id = idp if idp is not None else self.__class__.new_id()
             self.max_players = max_players
             self.n_players = 0
+            # a lock making the capacity check and the player count a single
+            # step (the players join from the lobby's connection threads)
+            # (reentrant: a connection may be shut down while a player joins)
+            self._players_lock = threading.RLock()
+            # the PartyInfo matching the current status (None when outdated)
+            self._info = None
             self.is_ingame = False
-            # a record of the client actions
-            self._action_record = {}
-            # a lock to access and update this resource safely
-            self._action_record_lock = threading.Lock()
+            # the actions requested for the current turn, indexed by the
+            # players' slots (a byte per player), and the buffer of the last
+            # turn, which is reused for the next one
+            self._actions = None
+            self._spare_actions = None
+            # a lock used to store an action and to swap the buffers safely
+            # (the actions are received on the connections' threads, and
+            # swapped on the turn scheduler's)
+            self._actions_lock = threading.Lock()
+            # the replay of the game (None if it is not recorded)
+            self.replay = None
+            # the connections watching the party
+            self.spectators = SpectatorChannel(self)
+            # the game rules, followed turn by turn to send the state of the
+            # game to the players who rejoin it
+            self.engine = None
+            # the init packet of the game (without player no or token),
+            # and the token of each player (token -> slot)
+            self._init = None
+            self._tokens = {}
+            # the connections of the players rejoining the game, with their
+            # slot, taken over on the next turn
+            self._rejoining = []
         
     @classmethod
-    def create_new(cls, lobby):
+    def new_id(cls):
+        """Get the next available id and increment the global counter"""
+        idp = cls.next_id
+        cls.next_id += 1
+        return idp
+    
+    @classmethod
+    def create_new(cls, lobby, idp=None):
         """Creates a new PartyServer, picking any available port
         the OS will give us."""
+        if MULTIPLEX_PARTIES:
+            # the clients join through the lobby: no listening socket,
+            # the address given to the clients is the lobby's
+            new = cls(lobby.address, lobby, bind_and_listen=False, idp=idp)
+            new.socket.close()
+            return new
         # Take the same IP as lobby and let the OS pick a random available port
         ip = lobby.address[0]
-        new = cls((ip, 0), lobby)
+        new = cls((ip, 0), lobby, idp=idp)
         # update the address and party info
         new.address = new.socket.getsockname()
         # if we are using the monitoring tool, we have to launch it on an arbitrary port
@@ -58,11 +105,18 @@ class PartyServer(Server):
         return new
         
     def get_info(self):
-        """Returns the PartyInfo object matching this server."""
+        """Returns the PartyInfo object matching this server.
+        The same object is returned until the party's status changes."""
+        info = self._info
+        if info is None:
+            info = self._info = self._make_info()
+        return info
+    
+    def _make_info(self):
         idp = self.id
         ip, port = self.address
         # if we use the montoring tool, give the monitoring port to the clients
-        if USE_MONITORING:
+        if USE_MONITORING and not MULTIPLEX_PARTIES:
             port = self.monitoring_port
         # n_players = len(self.get_active_connections())
         n_players = self.n_players
@@ -71,31 +125,98 @@ class PartyServer(Server):
     
     def handle_connection(self, conn, client_addr):
         """Handle a new client connection."""
-        super(PartyServer, self).handle_connection(conn, client_addr)
+        self._players_lock.acquire()
+        # ------ enter critical section ------
+        try:
+            super(PartyServer, self).handle_connection(conn, client_addr)
+            self._add_player()
+        finally:
+            # ------ exit critical section -------
+            self._players_lock.release()
+    
+    def adopt_connection(self, handle):
+        """Take over a client connection handed over by the lobby.
+        The connection is closed if the party is full or in game.
+        Returns the new handle of the connection (None if it was closed)."""
+        self._players_lock.acquire()
+        # ------ enter critical section ------
+        try:
+            if not self.accepts_players():
+                if VERBOSE: print "party %d is full, closing %s" % (self.id, str(handle.addr))
+                handle.close_connection()
+                return None
+            new = super(PartyServer, self).adopt_connection(handle)
+            self._add_player()
+            return new
+        finally:
+            # ------ exit critical section -------
+            self._players_lock.release()
+    
+    def accepts_players(self):
+        """Tells whether the party is still waiting for players"""
+        return not self.is_ingame and self.n_players < self.max_players
+    
+    def _add_player(self):
+        """Count a new player in, and start the game if the party is full"""
         self.n_players += 1
         if VERBOSE: print str(self.n_players) + " players currently connected"
+        self._info = None
+        self.lobby.notice_party_update(self)
         if self.n_players == self.max_players:
             self.start_game()
     
     def notice_connection_shutdown(self, handle):
         """This function is called when a connection about to be shut-down."""
         super(PartyServer, self).notice_connection_shutdown(handle)
-        self.n_players -= 1
+        self._players_lock.acquire()
+        # ------ enter critical section ------
+        try:
+            self.n_players -= 1
+            if not self.is_ingame:
+                self._info = None
+                self.lobby.notice_party_update(self)
+        finally:
+            # ------ exit critical section -------
+            self._players_lock.release()
         # shut down the party server if it is ingame and there is no player left
+        # (the players who lost their connection can rejoin until then)
+        # (without waiting: a multiplexed party never serves a listener, so
+        # nothing would notice the shutdown on the threads)
         if self.n_players == 0 and self.is_ingame:
-            self.shutdown()
-    
-    def send_loop(self):
-        while True:
-            if self.is_ingame:
-                if self.n_players != 0:
-                    self.send_actions()
-                    self.current_turn += 1
-                else: # stop the loop if there is no player left
-                    break
-            else:
-                self.send_status()
-            time.sleep(self.__class__.SEND_INTERVAL)
+            self.shutdown(non_blocking=True)
+    
+    def start_sending(self):
+        """Let the shared turn scheduler call send_tick every SEND_INTERVAL."""
+        self._send_task = get_turn_scheduler().add_periodic(
+            self.__class__.SEND_INTERVAL, self.send_tick)
+    
+    def send_tick(self):
+        """Send the party status while the party is pending,
+        and commit the players' actions once per turn when it is ingame.
+        Returns False to stop the ticks once there is no player left."""
+        if self.is_ingame:
+            if self.n_players != 0:
+                self.send_actions()
+                self.current_turn += 1
+            else: # stop the ticks if there is no player left
+                # close the connections of the players who did not rejoin
+                # the game in time
+                self._tokens = {}
+                for handle, slot, token in self._rejoining:
+                    handle.close_connection()
+                self._rejoining = []
+                if self.replay is not None:
+                    self.replay.close()
+                self.spectators.close()
+                self.lobby.notice_party_closed(self)
+                return False
+        else:
+            self.send_status()
+        return True
+    
+    def get_tick_stats(self):
+        """Get the tick count, skipped ticks and lateness of this party"""
+        return self._send_task.get_stats()
     
     def send_status(self):
         """Send to all connected players the current party status
@@ -105,21 +226,21 @@ class PartyServer(Server):
         self.send_to_all(packet)
     
     def send_actions(self):
-        # get the commited packets and flush the record
-        record = self.get_action_record()
-        self._flush_record()
-        # retrieve the actions in appropriate order
-        clients = sorted(record.iterkeys(), cmp=lambda c1, c2: c1.id - c2.id)
-        actions = [packets.Action.DO_NOTHING] * NUM_PLAYERS
-        for i, c in enumerate(clients[:NUM_PLAYERS]):
-            actions[i] = record[c]
-
+        if self._rejoining:
+            self._take_rejoining()
+        # get the committed actions (already in the players' order)
+        actions = self._swap_actions()
         # create a packet to commit these actions
         commit_packet = packets.ActionsCommitPacket(self.current_turn, actions)
+        if self.replay is not None:
+            self.replay.record(self.current_turn, actions)
+        self.spectators.record(self.current_turn, actions)
         if DEBUG: print commit_packet
         response = commit_packet.wrap()
         # send it to every client in the party
         self.send_to_all(response)
+        # follow the game
+        self.engine.execute_turn(self.current_turn, actions)
     
     def start_game(self):
         """This function is called when a room is full and starts a new game,
@@ -132,14 +253,23 @@ class PartyServer(Server):
         m = BOARD_HEIGHT
         # game_map = mapgen.generate(n, m)
         # tiles = game_map.get_tiles()
-        tiles = mapgen.generate(n, m)
-        poss = [(0, 0), (n - 1, 0), (0, m - 1), (n - 1, m - 1)]
+        poss = mapgen.start_positions(n, m, k)
+        tiles = mapgen.generate(n, m, poss)
+        init = packets.InitPacket(0, k, dturn, n, m, tiles, poss)
+        self._init = init
+        self.engine = create_engine(n, m, tiles, poss)
         pID = 0
         self.players = self.get_active_connections()
         for handle in self.players:
-            packet = packets.InitPacket(pID, k, dturn, n, m, tiles, poss).wrap()
-            handle.send_client(packet)
+            # the player's actions are recorded under its ID
+            handle.slot = pID
+            token = struct.unpack("<Q", os.urandom(8))[0]
+            self._tokens[token] = pID
+            handle.send_client(self._make_init_packet(pID, token))
             pID += 1
+        self.spectators.start_game(init)
+        if RECORD_REPLAYS:
+            self.replay = replay.ReplayWriter(replay.replay_path(self.id), init)
         
         # notice the server that this party is full and no longer accepts
         # new clients
@@ -148,54 +278,100 @@ class PartyServer(Server):
         # morph into the "in-game" server
         self.start_ingame()
     
+    def _make_init_packet(self, pID, token):
+        init = self._init
+        return packets.InitPacket(pID, init.n_players, init.turn_length,
+            init.width, init.height, init.tiles, init.positions, token).wrap()
+    
+    def accepts_token(self, token):
+        """Tells whether a player of this game holds the given token"""
+        return self.is_ingame and token in self._tokens
+    
+    def rejoin(self, handle, token):
+        """Take over the connection of a player rejoining the game with the
+        given token (see accepts_token) on the next turn.
+        The other server should have shut the handle down silently."""
+        self._rejoining.append((handle, self._tokens[token], token))
+    
+    def _take_rejoining(self):
+        """Take over the connections of the players rejoining the game:
+        each of them is sent its init packet and the current state of the
+        game, right before the actions of this turn.
+        Runs on the turn path, so that nothing is committed in between."""
+        while self._rejoining:
+            handle, slot, token = self._rejoining.pop(0)
+            # (the slot is set before the handle is started: the actions
+            # it received already are recorded under it)
+            new = self.ConnectionHandle.from_instance(handle, self, start=False)
+            new.slot = slot
+            self._players_lock.acquire()
+            # ------ enter critical section ------
+            try:
+                self.n_players += 1
+            finally:
+                # ------ exit critical section -------
+                self._players_lock.release()
+            self._add_active_connection(new)
+            new.start_handling()
+            # (a connection of the player which is not lost yet is replaced)
+            for h in self.get_active_connections():
+                if h is not new and h.slot == slot:
+                    h.shutdown(non_blocking=True)
+            if VERBOSE: print "player %d rejoined the game" % slot
+            new.send_client(self._make_init_packet(slot, token))
+            state = encode_state(self.engine.get_state())
+            new.send_client(packets.StateSnapshotPacket(state).wrap())
+    
     def start_ingame(self):
+        # allocate the action buffers, once for the whole game
+        # (before going ingame: the actions are recorded from then on)
+        self._no_actions = bytearray([packets.Action.DO_NOTHING]) * self.max_players
+        self._spare_actions = bytearray(self._no_actions)
+        self._actions = bytearray(self._no_actions)
         # self.current_turn = 0
         self.current_turn = 1
         self.is_ingame = True
         # stop accepting new connections
-        self.shutdown(silent=True)
-        # flush the record
-        self._flush_record()
+        # (without waiting: we may be on the accepting thread itself)
+        self.shutdown(non_blocking=True, silent=True)
     
     def record_packet(self, packet, client):
-        """Save a client action packet in the action record"""
+        """Save a client action packet in the action buffer"""
         # process the received packet to retrieve the requested action
         if (packet.type == packets.ActionRequestPacket.TYPE):
             action_packet = packets.ActionRequestPacket.decode(packet.payload)
         # process the packet if it is not outdated (given turn is the current turn)
         # or if DUMP_OLD_PACKET was set to False
             if self.current_turn == action_packet.turn or (not DUMP_OLD_PACKET):
-                action = action_packet.action
-                # save the action
-                self._action_record_lock.acquire()
-                # ------ enter critical section ------
-                # if there's no action already committed for this client,
-                # comit this action
-                self._action_record[client] = action
-                # else, ignore the packet
-                # ------ exit critical section -------
-                self._action_record_lock.release()
+                # save the action in the player's slot, overwriting any action
+                # already requested this turn
+                # (a slot out of the buffer is ignored)
+                slot = client.slot
+                if slot is not None and 0 <= slot < len(self._actions):
+                    self._actions_lock.acquire()
+                    # ------ enter critical section ------
+                    try:
+                        # (the action goes either to this turn or to the next
+                        # one, never to the buffer being committed)
+                        self._actions[slot] = action_packet.action
+                    finally:
+                        # ------ exit critical section -------
+                        self._actions_lock.release()
     
-    def get_action_record(self):
-        """Get the current packet record"""
-        """Save a client packet in the record"""
-        self._action_record_lock.acquire()
+    def _swap_actions(self):
+        """Take the actions recorded for the current turn, and start
+        recording the next turn's in the spare buffer.
+        The returned buffer stays valid until the next swap."""
+        # reset the spare buffer before it gets any action
+        fresh = self._spare_actions
+        fresh[:] = self._no_actions
+        self._actions_lock.acquire()
         # ------ enter critical section ------
-        # return a copy of the packet record
-        record = self._action_record.copy()
-        # else, ignore the packet
-        # ------ exit critical section -------
-        self._action_record_lock.release()
+        try:
+            record = self._actions
+            self._actions = fresh
+        finally:
+            # ------ exit critical section -------
+            self._actions_lock.release()
+        self._spare_actions = record
         return record
-    
-    def _flush_record(self):
-        """Empty the current packet record"""
-        self._action_record_lock.acquire()
-        # ------ enter critical section ------
-        self._action_record = {
-            client: packets.Action.DO_NOTHING
-            for client in self.players
-            # for client in self.get_active_connections()
-        }
-        # ------ exit critical section -------
-        self._action_record_lock.release()
@@ -0,0 +1,314 @@
+from gameconst import *
+from game_engine import create_engine, encode_state, decode_state
+import packets
+
+import mmap
+import os
+import Queue
+import struct
+import sys
+import threading
+import time
+import traceback
+
+# a replay file starts with this magic string and the format version
+MAGIC = "BMRP"
+VERSION = 2
+# the magic string ending the index of the keyframes
+INDEX_MAGIC = "BMRX"
+# the trailer of a replay: the number of keyframes, the offset of the index
+# and the index magic string
+TRAILER = struct.Struct("<IQ4s")
+
+class ReplayWriter(object):
+    """Records a game in a replay file, which is made of:
+    - the magic string and the format version (a byte)
+    - the length of the init data (a 4-byte integer)
+    - the init data: an encoded InitPacket (board size, tiles and initial
+    positions), the player no being meaningless
+    - the keyframe interval K (a 4-byte integer, 0 if there is no keyframe)
+    - a record per turn: the turn number (a 4-byte integer) followed by
+    the action of each player (a byte per player), with a keyframe (the
+    state of the game, see encode_state) after every K records
+    - when the replay is closed: the index of the keyframes (the offset of
+    each, 8-byte integers) and the trailer (see TRAILER).
+    The records are buffered, and the full buffers are handed over to a
+    shared writer thread, which writes them and computes the keyframes,
+    so that recording a turn never waits for the disk or the game rules.
+    The more frequent the keyframes, the bigger the file but the faster
+    a seek (see ReplayReader.seek)."""
+    # the number of turns buffered before the records are written
+    FLUSH_TURNS = 256
+
+    def __init__(self, path, init, keyframe_interval=REPLAY_KEYFRAME_INTERVAL):
+        self.path = path
+        self.n_players = init.n_players
+        self.record_size = 4 + self.n_players
+        self.keyframe_interval = keyframe_interval
+        self._writer = get_replay_writer()
+        self._buffer = bytearray()
+        self._n_buffered = 0
+        self.closed = False
+        # (the following is only used by the writer thread)
+        self._file = None
+        self._engine = None
+        self._n_records = 0
+        self._keyframes = []
+        self._writer.submit(self._write_header, init)
+
+    def record(self, turn, actions):
+        """Record the actions committed on the given turn
+        (the actions may be any sequence of byte values)"""
+        buf = self._buffer
+        buf += struct.pack("<I", turn)
+        buf += actions
+        self._n_buffered += 1
+        if self._n_buffered >= self.FLUSH_TURNS:
+            self.flush()
+
+    def flush(self):
+        """Hand the buffered records over to the writer thread"""
+        if self._buffer:
+            self._writer.submit(self._write_records, self._buffer)
+            self._buffer = bytearray()
+            self._n_buffered = 0
+
+    def close(self):
+        """Write the last records and the index, and close the file"""
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self._writer.submit(self._write_index)
+
+    def _write_header(self, init):
+        self._file = open(self.path, 'wb')
+        data = init.encode()
+        self._file.write(MAGIC + struct.pack("<BI", VERSION, len(data)) +
+                         data + struct.pack("<I", self.keyframe_interval))
+        if self.keyframe_interval:
+            self._engine = create_engine(init.width, init.height,
+                                         init.tiles, init.positions)
+
+    def _write_records(self, data):
+        if not self.keyframe_interval:
+            self._file.write(data)
+            return
+        size = self.record_size
+        k = self.keyframe_interval
+        engine = self._engine
+        start = 0
+        for offset in xrange(0, len(data), size):
+            turn, = struct.unpack_from("<I", data, offset)
+            engine.execute_turn(turn, data[offset + 4:offset + size])
+            self._n_records += 1
+            if self._n_records % k == 0:
+                # write the records up to this keyframe, then the keyframe
+                self._file.write(data[start:offset + size])
+                start = offset + size
+                self._keyframes.append(self._file.tell())
+                self._file.write(encode_state(engine.get_state()))
+        self._file.write(data[start:])
+
+    def _write_index(self):
+        f = self._file
+        index_offset = f.tell()
+        f.write(struct.pack("<%dQ" % len(self._keyframes), *self._keyframes))
+        f.write(TRAILER.pack(len(self._keyframes), index_offset, INDEX_MAGIC))
+        f.close()
+
+
+class ReplayWriterThread(object):
+    """Runs the writes of every replay of the process, in order,
+    on its own thread."""
+    # tells whether the thread should be stopped when the main thread is done
+    daemon_threads = True
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+
+    def submit(self, fun, *args):
+        """Call fun(*args) on the writer thread"""
+        self._queue.put((fun, args))
+
+    def wait(self):
+        """Wait until every write submitted so far is done"""
+        self._queue.join()
+
+    def start(self):
+        t = threading.Thread(target=self.run_forever, args=())
+        t.daemon = self.daemon_threads
+        t.start()
+        return t
+
+    def run_forever(self):
+        while True:
+            fun, args = self._queue.get()
+            try:
+                fun(*args)
+            except Exception:
+                if VERBOSE: traceback.print_exc(file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+
+# the writer thread shared by every replay of this process
+_shared_writer = None
+_shared_writer_lock = threading.Lock()
+
+def get_replay_writer():
+    """Get the writer thread shared by every replay of this process.
+    It is started on the first call."""
+    global _shared_writer
+    _shared_writer_lock.acquire()
+    # ------ enter critical section ------
+    if _shared_writer is None:
+        _shared_writer = ReplayWriterThread()
+        _shared_writer.start()
+    writer = _shared_writer
+    # ------ exit critical section -------
+    _shared_writer_lock.release()
+    return writer
+
+
+class ReplayReader(object):
+    """Reads a replay file (see ReplayWriter) through a memory map:
+    the turns are only read when they are accessed.
+    The keyframes are found through the index, or by skipping from one
+    keyframe to the next if the replay was not closed (e.g. if the server
+    was killed), in which case a truncated last record is ignored."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("not a replay file: %s" % path)
+        offset = len(MAGIC)
+        version, length = struct.unpack("<BI", self._map[offset:offset + 5])
+        if version != VERSION:
+            self.close()
+            raise ValueError("unsupported replay version: %d" % version)
+        offset += 5
+        self.init = packets.InitPacket.decode(self._map[offset:offset + length])
+        offset += length
+        self.keyframe_interval, = struct.unpack("<I", self._map[offset:offset + 4])
+        self.n_players = self.init.n_players
+        self.record_size = 4 + self.n_players
+        # the offset of the first turn record
+        self.start = offset + 4
+        self._load_index()
+
+    def _load_index(self):
+        """Find the offsets of the keyframes and the number of records"""
+        m = self._map
+        end = len(m)
+        if end - self.start >= TRAILER.size:
+            n, index_offset, magic = TRAILER.unpack(m[end - TRAILER.size:])
+            if magic == INDEX_MAGIC:
+                self.keyframes = list(struct.unpack("<%dQ" % n,
+                    m[index_offset:index_offset + 8 * n]))
+                self._set_length(index_offset)
+                return
+        # no index: skip from keyframe to keyframe
+        self.keyframes = []
+        if self.keyframe_interval:
+            block = self.keyframe_interval * self.record_size
+            offset = self.start + block
+            while offset + 4 <= end:
+                size, = struct.unpack("<I", m[offset:offset + 4])
+                if offset + 4 + size > end:
+                    break
+                self.keyframes.append(offset)
+                offset += 4 + size + block
+        self._set_length(end)
+
+    def _set_length(self, end):
+        # the records following the last keyframe
+        # (at most a keyframe interval of them: past it, the bytes are those
+        # of the next keyframe, cut short if the replay was not closed)
+        last = self._records_offset(len(self.keyframes))
+        n_tail = max(0, end - last) // self.record_size
+        if self.keyframe_interval:
+            n_tail = min(n_tail, self.keyframe_interval)
+        self.n_records = len(self.keyframes) * self.keyframe_interval + n_tail
+
+    def _records_offset(self, k):
+        """Get the offset of the records following the k-th keyframe
+        (the records of the start of the game for k = 0)"""
+        if k == 0:
+            return self.start
+        offset = self.keyframes[k - 1]
+        size, = struct.unpack("<I", self._map[offset:offset + 4])
+        return offset + 4 + size
+
+    def __len__(self):
+        """The number of turns recorded"""
+        return self.n_records
+
+    def __getitem__(self, i):
+        """Get the i-th turn recorded, as a (turn, actions) tuple
+        (the actions being a string of a byte per player)"""
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("replay turn index out of range")
+        if self.keyframe_interval:
+            k, i = divmod(i, self.keyframe_interval)
+            offset = self._records_offset(k) + i * self.record_size
+        else:
+            offset = self.start + i * self.record_size
+        record = self._map[offset:offset + self.record_size]
+        return struct.unpack("<I", record[:4])[0], record[4:]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def create_engine(self):
+        """Create an engine at the start of the recorded game"""
+        init = self.init
+        return create_engine(init.width, init.height, init.tiles, init.positions)
+
+    def get_keyframe(self, k):
+        """Get the game state after the k * K first turns (k >= 1)"""
+        offset = self.keyframes[k - 1]
+        size, = struct.unpack("<I", self._map[offset:offset + 4])
+        return decode_state(self._map[offset + 4:offset + 4 + size],
+                            self.init.width, self.init.height)
+
+    def seek(self, n, engine=None):
+        """Get an engine in the state following the n first turns:
+        the engine is restored from the nearest keyframe, and only the
+        remaining turns are executed.
+        The given engine is reused (it must be an engine of this replay)."""
+        if not 0 <= n <= len(self):
+            raise IndexError("replay turn index out of range")
+        k = 0
+        if self.keyframe_interval:
+            k = min(n // self.keyframe_interval, len(self.keyframes))
+        if engine is None or k == 0:
+            engine = self.create_engine()
+        if k:
+            engine.set_state(self.get_keyframe(k))
+        for i in xrange(k * self.keyframe_interval, n):
+            turn, actions = self[i]
+            engine.execute_turn(turn, bytearray(actions))
+        return engine
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def replay_path(party_id):
+    """Get the path of the replay of a party (in REPLAY_DIR)"""
+    if not os.path.isdir(REPLAY_DIR):
+        try:
+            os.makedirs(REPLAY_DIR)
+        except OSError:
+            # (another party may just have created it)
+            pass
+    name = "%s-party-%d.replay" % (time.strftime("%Y%m%d-%H%M%S"), party_id)
+    return os.path.join(REPLAY_DIR, name)
@@ -1,8 +1,14 @@
-from thread_shutdown import ThreadShutdownMixIn as ShutdownMixIn
+from gameconst import *
+# serve every connection on the shared event loop, or with a thread each
+if USE_EVENT_LOOP:
+    from loop_shutdown import LoopShutdownMixIn as ShutdownMixIn
+    from loop_connection import LoopConnectionHandle as BaseConnectionHandle
+else:
+    from thread_shutdown import ThreadShutdownMixIn as ShutdownMixIn
+    from thread_connection import ThreadConnectionHandle as BaseConnectionHandle
 from thread_connection import *
 import packets
 import mapgen
-from gameconst import *
 
 import socket
 import socket_utils
@@ -22,7 +28,7 @@ class Server(ShutdownMixIn):
     # the max number of connection request that can be queued
     request_queue_size = 5
     # the class to instance connection handle objects
-    ConnectionHandle = ThreadConnectionHandle
+    ConnectionHandle = BaseConnectionHandle
     # time interval between checks to a shutdown request (in secs)
     poll_interval = 0.5
     # tells whether the server should be shut down when the main thread is done
@@ -39,9 +45,10 @@ class Server(ShutdownMixIn):
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             # disable Naggle
             self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            # a maintained list of active connections
-            self._active_connections = []
-            # a lock used to access safely the active connections list
+            # a maintained snapshot (tuple) of the active connections:
+            # it is never modified, but replaced when a client joins or leaves
+            self._active_connections = ()
+            # a lock used to replace safely the active connections snapshot
             self._active_connections_lock = threading.Lock()
             if bind_and_listen:
                 self.bind()
@@ -61,11 +68,17 @@ class Server(ShutdownMixIn):
         a request to shut down the server is emitted.
 
         Polls for shutdown request every poll_interval seconds.
+        On the event loop, this only registers the listener socket and returns:
+        the loop will accept the connections as they come.
         """
-        self.do_while_not_shut_down(
-            iter_fun=self._accept_connection,
-                args=(poll_interval, )
-        )
+        if USE_EVENT_LOOP:
+            self.socket.setblocking(0)
+            self.do_on_readable(self.socket, self._accept)
+        else:
+            self.do_while_not_shut_down(
+                iter_fun=self._accept_connection,
+                    args=(poll_interval, )
+            )
         
     def _accept_connection(self, timeout):
         """Wait for a connection request.
@@ -73,12 +86,16 @@ class Server(ShutdownMixIn):
         accept the new client and handle the connection."""
         ready_to_read = select.select([self.socket], [], [], timeout)[0]
         if self.socket in ready_to_read:
-            try:
-                conn, client_addr = self.socket.accept()
-                if VERBOSE: print "accepted " + str(client_addr)
-                self.handle_connection(conn, client_addr)
-            except socket.error, e:
-                if VERBOSE: print >> sys.stderr, str(e)
+            self._accept()
+    
+    def _accept(self):
+        """Accept a pending client and handle the connection."""
+        try:
+            conn, client_addr = self.socket.accept()
+            if VERBOSE: print "accepted " + str(client_addr)
+            self.handle_connection(conn, client_addr)
+        except socket.error, e:
+            if VERBOSE: print >> sys.stderr, str(e)
                 
     def close_server(self):
         """Close the server (closes the listener socket)"""
@@ -87,28 +104,33 @@ class Server(ShutdownMixIn):
     def handle_connection(self, conn, client_addr):
         """Handle a new client connection"""
         # create a new handle for this connection
-        # and start the handling process immediately
-        handle = self.ConnectionHandle(conn, client_addr, self, start=True)
-        # add the handle to the list of active connections
+        handle = self.ConnectionHandle(conn, client_addr, self, start=False)
+        # add the handle to the list of active connections, then start the
+        # handling process (which may hand the connection over to another
+        # server, e.g. a party: the handle has to be registered by then)
         self._add_active_connection(handle)
+        handle.start_handling()
+    
+    def adopt_connection(self, handle):
+        """Take over a client connection handled by another server
+        (e.g. the lobby), as if the client had connected to this one.
+        The other server should have shut the handle down silently.
+        Returns the new handle of the connection."""
+        new = self.ConnectionHandle.from_instance(handle, self, start=False)
+        self._add_active_connection(new)
+        new.start_handling()
+        return new
     
     def get_active_connections(self):
-        """Get the list of active connections"""
-        self._active_connections_lock.acquire()
-        # ------ enter critical section ------
-        # copy the list of active connections
-        active_connections_copy = list(self._active_connections)
-        # ------ exit critical section -------
-        self._active_connections_lock.release()
-        # return the copy
-        return active_connections_copy
+        """Get the (immutable) snapshot of the active connections"""
+        return self._active_connections
     
     def _add_active_connection(self, handle):
         """Add a new connection to the list of active connections"""
         self._active_connections_lock.acquire()
         # ------ enter critical section ------
-        # append the new connection handle to the list of active connections
-        self._active_connections.append(handle)
+        # replace the snapshot with one including the new connection handle
+        self._active_connections = self._active_connections + (handle, )
         # ------ exit critical section -------
         self._active_connections_lock.release()
     
@@ -116,10 +138,9 @@ class Server(ShutdownMixIn):
         """Remove a connection from the list of active connections"""
         self._active_connections_lock.acquire()
         # ------ enter critical section ------
-        # remove the given connection handle from the list of active connections
-        self._active_connections.remove(handle)
-        if not self._active_connections:
-            self._active_connections = []
+        # replace the snapshot with one without the given connection handle
+        self._active_connections = tuple(h for h in self._active_connections
+            if h is not handle)
         # ------ exit critical section -------
         self._active_connections_lock.release()
     
@@ -149,9 +170,14 @@ class Server(ShutdownMixIn):
             handle.close_connection()
         self.close_server()
         
-    def send_to_all(self, packet):
-        """Broadcast a packet to every client currently connected"""
-        for handle in self.get_active_connections():
+    def send_to_all(self, packet, handles=None):
+        """Broadcast a packet to every client currently connected
+        (or to the given handles only).
+        The packet is encoded once, and the same frame is sent to every client."""
+        packet.encode()
+        if handles is None:
+            handles = self.get_active_connections()
+        for handle in handles:
             handle.send_client(packet)
     
     def _do_on_shutdown(self):
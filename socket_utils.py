@@ -11,15 +11,28 @@ def send(sock, data):
             raise socket.error("socket connection broken")
         totalsent += sent
 
+# max number of buffers given to a single sendmsg call
+MAX_SEND_BUFFERS = 64
+
+def send_buffers(sock, buffers):
+    # send as much of the given buffers as the socket accepts in a single call,
+    # without joining them (scatter-gather sendmsg, where the platform has it)
+    # return the number of bytes sent
+    if hasattr(sock, 'sendmsg'):
+        return sock.sendmsg(buffers[:MAX_SEND_BUFFERS])
+    return sock.send(buffers[0])
+
 def recv(sock, size):
-    # call socket.recv() until we have actually received data of size "size"
-    data = ''
-    while len(data) < size:
-        chunk = sock.recv(size - len(data))
-        if not chunk:
+    # call socket.recv_into() until we have actually received data of size "size"
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
             raise socket.error("socket connection broken")
-        data += chunk
-    return data
+        received += n
+    return str(data)
 
 def shutdown_close(sock):
     try:
@@ -0,0 +1,196 @@
+from server import BaseConnectionHandle
+from outbound_queue import QueuePolicy
+import packets
+from gameconst import *
+
+import Queue
+import sys
+import threading
+import traceback
+
+# the player no given to the spectators in the init packet
+SPECTATOR_ID = packets.UINT32_MAX
+
+class SpectatorConnectionHandle(BaseConnectionHandle):
+    """A read-only connection: anything the spectator sends is ignored."""
+    # the commits are never dropped: a spectator too far behind is disconnected
+    queue_policy = QueuePolicy.DISCONNECT
+    # (a spectator never sends anything, keep it for a whole game)
+    timeout = 4 * 3600
+
+    def _process_client_packet(self, packet):
+        pass
+
+
+class SpectatorChannel(object):
+    """The spectators of a party. They are sent the init packet of the game,
+    then the actions committed so far, then the actions of every turn
+    (batch_turns turns per packet, delay_turns turns behind the players).
+    The party only records the actions on its turn path: the packets are
+    built and sent to the spectators by a shared fan-out thread, so that
+    the number of spectators never slows the turns down.
+    The spectators join through the lobby (see SpectatePartyPacket): the
+    channel has no socket of its own, it is the master of their handles."""
+    ConnectionHandle = SpectatorConnectionHandle
+    # max number of turns in a packet of the actions committed so far
+    HISTORY_BATCH_TURNS = 256
+
+    def __init__(self, party, batch_turns=SPECTATOR_BATCH_TURNS,
+                 delay_turns=SPECTATOR_DELAY_TURNS):
+        self.party = party
+        self.batch_turns = max(1, batch_turns)
+        self.delay_turns = delay_turns
+        self._fan_out = get_fan_out_thread()
+        # a maintained snapshot (tuple) of the spectators' connections:
+        # it is never modified, but replaced when a spectator joins or leaves
+        self._spectators = ()
+        # a lock used to replace safely the spectators snapshot
+        self._spectators_lock = threading.Lock()
+        # the first turn, and the actions committed on each turn so far
+        # (a string of a byte per player, the list is only appended to)
+        self._first_turn = None
+        self._history = []
+        # the number of turns handed over to the fan-out thread
+        self._released = 0
+        # (the following is only used by the fan-out thread)
+        self._init_packet = None
+        self._n_players = 0
+        # the number of turns sent to the spectators
+        self._sent = 0
+        self._closed = False
+
+    def add_spectator(self, handle):
+        """Take over the connection of a new spectator.
+        The other server should have shut the handle down silently."""
+        self._fan_out.submit(self._add_spectator, handle)
+
+    def start_game(self, init):
+        """Send the init packet of the game to the spectators"""
+        self._fan_out.submit(self._start_game, init)
+
+    def record(self, turn, actions):
+        """Record the actions committed on the given turn
+        (called by the party on each turn)"""
+        if self._first_turn is None:
+            self._first_turn = turn
+        # (copy the actions: the party reuses its buffers)
+        self._history.append(str(actions))
+        ready = len(self._history) - self.delay_turns
+        if ready - self._released >= self.batch_turns:
+            self._fan_out.submit(self._send_turns, self._released, ready)
+            self._released = ready
+
+    def close(self):
+        """Send the turns not sent yet, then close every spectator connection"""
+        self._fan_out.submit(self._close, len(self._history))
+
+    def get_spectators(self):
+        """Get the (immutable) snapshot of the spectators' connections"""
+        return self._spectators
+
+    def notice_connection_shutdown(self, handle):
+        """This function is called when the connection of a spectator is
+        about to be shut down."""
+        handle.close_connection()
+        self._spectators_lock.acquire()
+        # ------ enter critical section ------
+        self._spectators = tuple(h for h in self._spectators if h is not handle)
+        # ------ exit critical section -------
+        self._spectators_lock.release()
+
+    def _send_to_all(self, packet):
+        """Send a packet to every spectator (encoded once)"""
+        packet.encode()
+        for handle in self.get_spectators():
+            handle.send_client(packet)
+
+    def _start_game(self, init):
+        self._n_players = init.n_players
+        self._init_packet = packets.InitPacket(SPECTATOR_ID, init.n_players,
+            init.turn_length, init.width, init.height, init.tiles,
+            init.positions).wrap()
+        self._send_to_all(self._init_packet)
+
+    def _make_batch(self, start, end):
+        return packets.ActionsBatchPacket(self._first_turn + start,
+            self._n_players, "".join(self._history[start:end])).wrap()
+
+    def _add_spectator(self, handle):
+        if self._closed:
+            handle.close_connection()
+            return
+        # (registered before it is started, as in Server.adopt_connection)
+        new = self.ConnectionHandle.from_instance(handle, self, start=False)
+        self._spectators_lock.acquire()
+        # ------ enter critical section ------
+        self._spectators = self._spectators + (new, )
+        # ------ exit critical section -------
+        self._spectators_lock.release()
+        new.start_handling()
+        if VERBOSE: print "new spectator " + str(new.addr)
+        # catch up with the game
+        if self._init_packet is not None:
+            new.send_client(self._init_packet)
+            for start in xrange(0, self._sent, self.HISTORY_BATCH_TURNS):
+                end = min(self._sent, start + self.HISTORY_BATCH_TURNS)
+                new.send_client(self._make_batch(start, end))
+
+    def _send_turns(self, start, end):
+        if self.get_spectators():
+            self._send_to_all(self._make_batch(start, end))
+        self._sent = end
+
+    def _close(self, end):
+        if self._sent < end:
+            self._send_turns(self._sent, end)
+        self._closed = True
+        # (the last batch may still be queued: send it before closing)
+        for handle in self.get_spectators():
+            handle.shutdown_when_flushed()
+
+
+class FanOutThread(object):
+    """Runs the sends to the spectators of every party of the process,
+    in order, on its own thread."""
+    # tells whether the thread should be stopped when the main thread is done
+    daemon_threads = True
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+
+    def submit(self, fun, *args):
+        """Call fun(*args) on the fan-out thread"""
+        self._queue.put((fun, args))
+
+    def start(self):
+        t = threading.Thread(target=self.run_forever, args=())
+        t.daemon = self.daemon_threads
+        t.start()
+        return t
+
+    def run_forever(self):
+        while True:
+            fun, args = self._queue.get()
+            try:
+                fun(*args)
+            except Exception:
+                if VERBOSE: traceback.print_exc(file=sys.stderr)
+
+
+# the fan-out thread shared by every party of this process
+_shared_fan_out = None
+_shared_fan_out_lock = threading.Lock()
+
+def get_fan_out_thread():
+    """Get the fan-out thread shared by every party of this process.
+    It is started on the first call."""
+    global _shared_fan_out
+    _shared_fan_out_lock.acquire()
+    # ------ enter critical section ------
+    if _shared_fan_out is None:
+        _shared_fan_out = FanOutThread()
+        _shared_fan_out.start()
+    fan_out = _shared_fan_out
+    # ------ exit critical section -------
+    _shared_fan_out_lock.release()
+    return fan_out
@@ -0,0 +1,359 @@
+"""Load generator: a swarm of bots playing from a single process.
+
+The bots find parties through the lobby (creating them as needed), join
+them, send an action request every 1/rate turn, and measure the commits
+they receive. The swarm is grown to each given number of concurrent parties
+in turn, and the percentiles of the latency and of the jitter of the
+commits are printed for each of them:
+- the latency is the time from an action request to the commit of this
+action (it includes the wait for the next turn: half a turn on average
+at one request per turn)
+- the jitter is the deviation of the time between two commits from the
+turn length.
+
+Usage: python swarmclient.py server_ip server_port [n_parties,...]
+                             [duration] [rate]"""
+from gameconst import *
+from event_loop import EventLoop
+import packets
+
+import errno
+import math
+import random
+import socket
+import sys
+
+BotState = enum.enum("BotState",
+    DISCOVERING = 0, # connected to the lobby, looking for a party
+    JOINING = 1, # waiting for the party to answer
+    PENDING = 2, # in a party, waiting for the game to start
+    INGAME = 3
+)
+
+# the actions sent by the bots
+# (never DO_NOTHING: it cannot be told apart from no request in a commit)
+ACTIONS = [Action.MOVE_RIGHT, Action.MOVE_LEFT, Action.MOVE_UP,
+    Action.MOVE_DOWN, Action.POSE_BOMB]
+
+# the errors of a non-blocking socket which is not ready
+NOT_READY = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+
+class SwarmBot(object):
+    """A simulated player, driven by the swarm's event loop.
+    It asks the lobby for the parties with free slots, joins one at random
+    (or creates one if the swarm needs more), plays max_turns turns, then
+    goes back to the lobby. Any failure (a full party, a connection shut
+    down, a timeout) sends it back to the lobby as well."""
+    # time to wait for the answer of the lobby or of a party (in s)
+    JOIN_TIMEOUT = 10.0
+    # time to wait in a party for the game to start (in s)
+    PENDING_TIMEOUT = 60.0
+    # max time to wait before going back to the lobby (in s)
+    RETRY_DELAY = 1.0
+    # the number of parties a bot chooses from
+    PAGE_SIZE = 50
+
+    def __init__(self, swarm):
+        self.swarm = swarm
+        self.loop = swarm.loop
+        self.state = None
+        self.sock = None
+        self._reader = None
+        # the bytes waiting to be sent
+        self._out = bytearray()
+        # the pending timeout, and the timer of the next action
+        self._timeout = None
+        self._action_timer = None
+        # (in game)
+        self.me = None
+        self.turn = 1
+        self.turn_length = TURN_LENGTH
+        self.n_turns = 0
+        self._last_commit = None
+        # the time and the action of the last request not committed yet
+        self._request = None
+
+    def start(self):
+        """Connect to the lobby and look for a party"""
+        self._connect(self.swarm.lobby_addr, BotState.DISCOVERING)
+        if self.sock is not None:
+            self._send(packets.PartyQueryPacket(free_slots=True,
+                order=packets.PartyOrder.FILL_DESC, page=0,
+                page_size=self.PAGE_SIZE))
+
+    def _connect(self, addr, state):
+        self._close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = sock.connect_ex(addr)
+        if err != 0 and err not in NOT_READY:
+            sock.close()
+            self._retry()
+            return
+        self.sock = sock
+        self._reader = packets.PacketReader(sock)
+        self._out = bytearray()
+        self._set_state(state)
+        self.loop.add_reader(sock, self._on_readable)
+        self._set_timeout(self.JOIN_TIMEOUT)
+
+    def _set_state(self, state):
+        if self.state == BotState.INGAME:
+            self.swarm.n_ingame -= 1
+        elif state == BotState.INGAME:
+            self.swarm.n_ingame += 1
+        self.state = state
+
+    def _set_timeout(self, delay):
+        if self._timeout is not None:
+            self._timeout.cancel()
+        self._timeout = self.loop.call_later(delay, self._on_timeout)
+
+    def _close(self):
+        """Close the connection and cancel the timers"""
+        if self._timeout is not None:
+            self._timeout.cancel()
+            self._timeout = None
+        if self._action_timer is not None:
+            self._action_timer.cancel()
+            self._action_timer = None
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock)
+            self.loop.remove_writer(self.sock)
+            self.sock.close()
+            self.sock = None
+        self._set_state(None)
+
+    def _retry(self):
+        """Go back to the lobby after a while"""
+        self._close()
+        self.swarm.n_failures += 1
+        self.loop.call_later(random.random() * self.RETRY_DELAY, self.start)
+
+    def _send(self, packet):
+        self._out += packet.wrap().encode()
+        self.loop.add_writer(self.sock, self._on_writable)
+
+    def _on_writable(self):
+        try:
+            sent = self.sock.send(self._out)
+        except socket.error, e:
+            if e.errno not in NOT_READY:
+                self._retry()
+            return
+        del self._out[:sent]
+        if not self._out:
+            self.loop.remove_writer(self.sock)
+
+    def _on_readable(self):
+        sock = self.sock
+        try:
+            for packet in self._reader.recv_packets():
+                self._process_packet(packet)
+                if self.sock is not sock:
+                    # (the bot moved on to another connection)
+                    return
+        except socket.error, e:
+            if e.errno not in NOT_READY:
+                self._retry()
+        except packets.PacketTooLarge:
+            self._retry()
+
+    def _on_timeout(self):
+        self._timeout = None
+        self._retry()
+
+    def _process_packet(self, packet):
+        if self.state == BotState.DISCOVERING:
+            if packet.type == packets.PacketType.PARTY_PAGE:
+                self._choose_party(packets.PartyPagePacket.decode(packet.payload))
+        elif self.state in (BotState.JOINING, BotState.PENDING):
+            if packet.type == packets.PacketType.PARTY_STATUS:
+                if self.state == BotState.JOINING:
+                    self._set_state(BotState.PENDING)
+                    self._set_timeout(self.PENDING_TIMEOUT)
+            elif packet.type == packets.PacketType.INIT:
+                self._start_game(packets.InitPacket.decode(packet.payload))
+        elif self.state == BotState.INGAME:
+            if packet.type == packets.PacketType.ACTION:
+                self._on_commit(packets.ActionsCommitPacket.decode(packet.payload))
+
+    def _choose_party(self, page):
+        """Join a party of the page at random, or create one if the swarm
+        needs more (the lobby sends the page again when it changes)"""
+        parties = [p for p in page.parties if p.n_players < p.max_players]
+        if parties:
+            party = random.choice(parties)
+            if MULTIPLEX_PARTIES:
+                # let the lobby hand this connection over to the party
+                self._send(packets.JoinPartyPacket(party.id))
+                self._set_state(BotState.JOINING)
+                self._set_timeout(self.JOIN_TIMEOUT)
+            else:
+                self._connect((party.ip, party.port), BotState.JOINING)
+        elif self.swarm.needs_party(page.n_matching):
+            self._send(packets.CreatePartyPacket())
+
+    def _start_game(self, init):
+        self.me = init.player_ID
+        self.turn_length = init.turn_length / 1000.0
+        self.turn = 1
+        self.n_turns = 0
+        self._last_commit = None
+        self._request = None
+        if self._timeout is not None:
+            self._timeout.cancel()
+            self._timeout = None
+        self._set_state(BotState.INGAME)
+        self.swarm.n_games += 1
+        # (the bots of a party do not act in phase)
+        self._action_timer = self.loop.call_later(
+            random.random() * self.swarm.action_interval(self.turn_length),
+            self._act)
+
+    def _act(self):
+        action = random.choice(ACTIONS)
+        self._request = (self.loop.time(), action)
+        self._send(packets.ActionRequestPacket(self.turn, action))
+        self._action_timer = self.loop.call_later(
+            self.swarm.action_interval(self.turn_length), self._act)
+
+    def _on_commit(self, commit):
+        swarm = self.swarm
+        now = self.loop.time()
+        if self._last_commit is not None:
+            swarm.jitters.append(abs(now - self._last_commit - self.turn_length))
+        self._last_commit = now
+        self.turn = commit.turn + 1
+        request = self._request
+        if request is not None and commit.actions[self.me] == request[1]:
+            swarm.latencies.append(now - request[0])
+            self._request = None
+        swarm.n_commits += 1
+        self.n_turns += 1
+        if self.n_turns >= swarm.max_turns:
+            # leave the game for another one
+            self._close()
+            self.start()
+
+
+class Swarm(object):
+    """Runs the bots on an event loop of its own, in the calling thread."""
+    # max time to wait for the new bots to be in game (in s)
+    RAMP_UP_TIMEOUT = 60.0
+    # the share of the bots to be in game before measuring
+    RAMP_UP_SHARE = 0.9
+    # time between the starts of two new bots (in s)
+    START_INTERVAL = 0.002
+    # time for a party created to show in the lobby's pages (in s)
+    CREATE_DELAY = 1.0
+
+    def __init__(self, lobby_addr, rate=1.0, max_turns=300):
+        """rate: the number of action requests per turn of each bot
+        max_turns: the number of turns a bot plays before leaving a game"""
+        self.lobby_addr = lobby_addr
+        self.rate = rate
+        self.max_turns = max_turns
+        self.loop = EventLoop()
+        # (the loop is run step by step: do not block when idle)
+        self.loop.poll_interval = 0.1
+        self.bots = []
+        self.n_ingame = 0
+        # the parties created but which may not show in the pages yet
+        self._n_creating = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.latencies = []
+        self.jitters = []
+        self.n_commits = 0
+        self.n_games = 0
+        self.n_failures = 0
+
+    def action_interval(self, turn_length):
+        return turn_length / self.rate
+
+    def needs_party(self, n_free):
+        """Tell whether a new party should be created, given the number of
+        parties with free slots (and claim its creation if so)"""
+        n_parties = n_free + self._n_creating
+        if n_parties * NUM_PLAYERS >= len(self.bots) - self.n_ingame:
+            return False
+        self._n_creating += 1
+        self.loop.call_later(self.CREATE_DELAY, self._created)
+        return True
+
+    def _created(self):
+        self._n_creating -= 1
+
+    def add_bots(self, n):
+        """Start n new bots, one after the other"""
+        for i in xrange(n):
+            bot = SwarmBot(self)
+            self.bots.append(bot)
+            self.loop.call_later(i * self.START_INTERVAL, bot.start)
+
+    def run(self, duration):
+        """Run the bots for the given time (in s)"""
+        deadline = self.loop.time() + duration
+        while self.loop.time() < deadline:
+            self.loop.run_once()
+
+    def ramp_up(self, n_parties):
+        """Grow the swarm to play n_parties parties at once, and wait until
+        most of its bots are in game"""
+        self.add_bots(n_parties * NUM_PLAYERS - len(self.bots))
+        deadline = self.loop.time() + self.RAMP_UP_TIMEOUT
+        target = self.RAMP_UP_SHARE * len(self.bots)
+        while self.n_ingame < target and self.loop.time() < deadline:
+            self.run(0.5)
+
+
+def percentile(values, q):
+    """The q-th percentile of the sorted values (nearest rank)"""
+    if not values:
+        return float('nan')
+    i = int(math.ceil(q / 100.0 * len(values))) - 1
+    return values[min(max(i, 0), len(values) - 1)]
+
+def raise_fd_limit():
+    """Allow as many sockets as the system lets this process open"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError):
+        pass
+
+def main(addr, levels, duration, rate):
+    raise_fd_limit()
+    swarm = Swarm(addr, rate)
+    print ("%8s %8s %10s %9s | %8s %8s %8s | %8s %8s %8s" % ("parties",
+        "in game", "commits/s", "failures", "lat p50", "p99", "p999",
+        "jit p50", "p99", "p999"))
+    for n_parties in levels:
+        swarm.ramp_up(n_parties)
+        swarm.reset_stats()
+        swarm.run(duration)
+        latencies = sorted(swarm.latencies)
+        jitters = sorted(swarm.jitters)
+        row = [percentile(latencies, q) * 1000 for q in (50, 99, 99.9)]
+        row += [percentile(jitters, q) * 1000 for q in (50, 99, 99.9)]
+        print ("%8d %8d %10.0f %9d | %8.1f %8.1f %8.1f | %8.1f %8.1f %8.1f" %
+            tuple([n_parties, swarm.n_ingame, swarm.n_commits / duration,
+                   swarm.n_failures] + row))
+        sys.stdout.flush()
+    print "(latency and jitter in ms)"
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print ("Usage: swarmclient server_ip server_port [n_parties,...] " +
+            "[duration] [rate]")
+        sys.exit(-1)
+    addr = (sys.argv[1], int(sys.argv[2]))
+    levels = [int(n) for n in sys.argv[3].split(',')] if len(sys.argv) > 3 else [10, 50, 100]
+    duration = float(sys.argv[4]) if len(sys.argv) > 4 else 30.0
+    rate = float(sys.argv[5]) if len(sys.argv) > 5 else 1.0
+    main(addr, levels, duration, rate)
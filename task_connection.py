@@ -27,6 +27,8 @@ class TaskConnectionHandle(TaskShutdownMixIn):
             self.addr        = addr # the socket's destination address
             self.packet_to_send = None # a "buffer" where the packet to send
                                        # will be put
+            # splits the bytes received into packets
+            self._reader = packets.PacketReader(conn, self.__class__.packet_class)
             if start:
                 self.start_handling()
 
@@ -75,16 +77,20 @@ class TaskConnectionHandle(TaskShutdownMixIn):
         if self.conn in ready_to_read:
             # read it
             try:
-                # try to read the packet
-                packet = self.__class__.packet_class.recv(self.conn)
-                if PRINT_PACKETS: print "Received: " + str(packet) + " from " + str(self.addr)
-                # process it
-                self._process_packet(packet)
+                # try to read the packets
+                for packet in self._reader.recv_packets():
+                    if PRINT_PACKETS: print "Received: " + str(packet) + " from " + str(self.addr)
+                    # process it
+                    self._process_packet(packet)
             except socket.error, e:
                 # if the connection was closed on the client side,
                 # shut down the process
                 if VERBOSE: print >> sys.stderr, str(e)
                 self.shutdown()
+            except packets.PacketTooLarge, e:
+                # the stream cannot be trusted anymore: close it
+                if VERBOSE: print >> sys.stderr, str(e)
+                self.shutdown()
             except packets.PacketMismatch, e:
                 if VERBOSE: print >> sys.stderr, str(e)
 
@@ -102,6 +108,20 @@ class TaskConnectionHandle(TaskShutdownMixIn):
         """Close the socket doing the connection"""
         socket_utils.shutdown_close(self.conn)
     
+    def detach(self):
+        """Stop handling the connection without closing the socket, so that
+        another handle (maybe in another process) can take it over.
+        Returns the bytes received but not read as packets yet."""
+        self.shutdown(silent=True)
+        return self._reader.get_buffered_bytes()
+    
+    def feed(self, data):
+        """Process the bytes received from this connection by another handle
+        (see detach), before the ones received by this handle."""
+        self._reader.feed(data)
+        for packet in self._reader.buffered_packets():
+            self._process_packet(packet)
+    
     def send(self, packet):
         """Send a packet to the other end of the connection.
         This function actually just poses a request to send the given packet,
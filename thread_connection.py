@@ -1,8 +1,12 @@
 from thread_shutdown import *
+from outbound_queue import *
 from gameconst import *
+from timer_wheel import get_timer_wheel
+import event_loop
 
 import packets
 import socket_utils
+import errno
 import select
 import socket
 import sys
@@ -13,7 +17,8 @@ class ThreadConnectionHandle(ThreadShutdownMixIn):
     other processes will use this object as an interface.
     The connection's thread attempts to read from the connected socket.
     If nothing is read for a given time, the connection will timeout and will
-    be shut down automatically."""
+    be shut down automatically (the timeout is checked on the shared timer
+    wheel, receiving a packet only records the time)."""
     # tells whether the connection should be shut down when the main thread is done
     daemon_threads = True
     # time interval between checks to a shutdown request (in secs)
@@ -21,6 +26,12 @@ class ThreadConnectionHandle(ThreadShutdownMixIn):
     # timeout (in sec) to shut down the connection automatically
     # if no activity is detected
     timeout = 600
+    # max number of frames waiting to be sent to a slow client
+    max_queue_size = 256
+    # what to do when the queue of a slow client is full
+    queue_policy = QueuePolicy.DROP_STALE
+    # max time (in sec) a client may stay behind before being disconnected
+    max_lag = 10
     # the packet received from this connection should be read as instances of this class
     packet_class = packets.GamePacket
     # dumb client counter, incremented every time a new client is instanced
@@ -39,24 +50,39 @@ class ThreadConnectionHandle(ThreadShutdownMixIn):
             self.thread.daemon = self.__class__.daemon_threads
             # a lock preventing two threads from writing at the same time
             self._write_lock  = threading.Lock()
+            # the frames waiting for the socket to be writable
+            self._outbound = OutboundQueue(self.__class__.max_queue_size,
+                self.__class__.queue_policy, self.__class__.max_lag)
+            # tells whether to shut down once the queued frames are sent
+            self._closing = False
+            # splits the bytes received into packets
+            self._reader = packets.PacketReader(conn, self.__class__.packet_class)
             # get a client id
             self.id = self.__class__._get_new_id()
             if start:
                 self.start_handling()
 
     @classmethod
-    def from_instance(cls, handle, start=True):
-        """Create a new connection handle from an existing one."""
+    def from_instance(cls, handle, master=None, start=True):
+        """Create a new connection handle from an existing one,
+        owned by the given master (by default, the same one).
+        The packets received and the frames queued by the existing handle
+        are taken over by the new one."""
         new = cls(None, None, None, None, no_init=True)
         new.conn        = handle.conn # the socket connecting the master with the client
         new.addr = handle.addr # the client's address
-        new.master      = handle.master # a reference to the master owning the connection
-        new.thread      = threading.thread( # the receiver thread
+        new.master      = master or handle.master # a reference to the master owning the connection
+        new.thread      = threading.Thread( # the receiver thread
             target=new._process_connection,
             args=()
         )
         new.thread.daemon = cls.daemon_threads
-        new._write_lock = handle.thread
+        new._write_lock = handle._write_lock
+        new._outbound = handle._outbound
+        # (the frames queued are kept, under the limits of this class)
+        new._outbound.set_limits(cls.max_queue_size, cls.queue_policy, cls.max_lag)
+        new._closing = False
+        new._reader = handle._reader
         new.id          = handle.id # the client id
         if start:
             new.start_handling()
@@ -65,41 +91,77 @@ class ThreadConnectionHandle(ThreadShutdownMixIn):
     def start_handling(self):
         """Start processing the connection"""
         if VERBOSE: print "handling " + str(self.addr)
+        # the socket is only read when select says so, and never blocks on writes
+        self.conn.setblocking(0)
         self.thread.start()
         
     def _process_connection(self, poll_interval=poll_interval):
         """Function to be run in a new thread while the connection is active"""
-        self._time_left = self.timeout
-        self.do_while_not_shut_down(iter_fun=self._process_connection_iter)
-        
-    def _process_connection_iter(self):
-        """Processing done in one iteration of the processing loop"""
-        if self._time_left < 0:
+        self._last_activity = event_loop.monotonic()
+        self._schedule_timeout()
+        # process the packets received before the handle was started
+        # (e.g. by the handle it was created from)
+        self._process_packets(self._reader.buffered_packets())
+        try:
+            self.do_while_not_shut_down(iter_fun=self._process_connection_iter)
+        finally:
+            self._idle_timer.cancel()
+    
+    def _schedule_timeout(self):
+        """Check for inactivity when the timeout would be due"""
+        deadline = self._last_activity + self.__class__.timeout
+        self._idle_timer = get_timer_wheel().add(deadline, self._check_timeout)
+    
+    def _check_timeout(self):
+        if event_loop.monotonic() - self._last_activity >= self.__class__.timeout:
             # if the time is over, shut down the process
             self.shutdown(non_blocking=True)
         else:
-            # wait to receive a new client packet
-            ready_to_read = select.select([self.conn], [], [], self.__class__.poll_interval)[0]
-            if self.conn in ready_to_read:
-                try:
-                    # try to read the packet
-                    packet = self.__class__.packet_class.recv(self.conn)
-                    if PRINT_PACKETS:
-                        print "Received: " + str(packet) + " from " + str(self.addr)
-                    # process it
-                    self._process_client_packet(packet)
-                    # this client is active, reset _time_left countdown
-                    self._time_left = self.__class__.timeout
-                except socket.error, e:
-                    # if the connection was closed on the client side,
-                    # shut down the process
+            # some packets were received since, wait for the new deadline
+            self._schedule_timeout()
+        
+    def _process_connection_iter(self):
+        """Processing done in one iteration of the processing loop"""
+        # wait to receive a new client packet
+        # (or to be able to send the frames still queued)
+        to_write = [self.conn] if self._outbound else []
+        ready_to_read, ready_to_write, _ = select.select([self.conn],
+            to_write, [], self.__class__.poll_interval)
+        if self.conn in ready_to_write:
+            self._write_lock.acquire()
+            # ------ enter critical section ------
+            self._flush()
+            # ------ exit critical section -------
+            self._write_lock.release()
+        if self.conn in ready_to_read:
+            try:
+                # try to read the packets
+                self._process_packets(self._reader.recv_packets())
+            except socket.error, e:
+                # if the connection was closed on the client side,
+                # shut down the process
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
                     self.shutdown(non_blocking=True)
-                except packets.PacketMismatch, e:
-                    if VERBOSE: print >> sys.stderr, str(e)
-            else:
-                # no activity has been detected thus far,
-                # decrement the _time_left countdown
-                self._time_left -= self.__class__.poll_interval
+            except packets.PacketTooLarge, e:
+                # the stream cannot be trusted anymore: close it
+                if VERBOSE: print >> sys.stderr, str(e)
+                self.shutdown(non_blocking=True)
+    
+    def _process_packets(self, received):
+        """Process the received packets, until the handle is shut down
+        (the remaining ones stay buffered in the reader)"""
+        for packet in received:
+            try:
+                if PRINT_PACKETS:
+                    print "Received: " + str(packet) + " from " + str(self.addr)
+                # process it
+                self._process_client_packet(packet)
+                # this client is active, push back the timeout
+                self._last_activity = event_loop.monotonic()
+            except packets.PacketMismatch, e:
+                if VERBOSE: print >> sys.stderr, str(e)
+            if self._shutdown_request:
+                break
 
     def _process_client_packet(self, packet):
         """Process a packet which was sent by the client.
@@ -116,19 +178,57 @@ class ThreadConnectionHandle(ThreadShutdownMixIn):
         socket_utils.shutdown_close(self.conn)
     
     def send_client(self, packet):
-        """Send a packet to the connected client"""
+        """Send a packet to the connected client.
+        What cannot be sent right away is queued and sent by the connection's
+        thread as soon as the socket is writable, so this never blocks."""
         self._write_lock.acquire()
         # ------ enter critical section ------
-        # send the packet through the connected socket
         try:
-            packet.send(self.conn)
+            was_empty = not self._outbound
+            self._outbound.push(packet.encode())
+            if was_empty:
+                self._flush()
             if PRINT_PACKETS:
                 print "Sent " + str(packet) + " to " + str(self.addr)
-        except socket.error, e:
+        except QueueOverflow, e:
+            # the client is too far behind, disconnect it
+            if VERBOSE: print >> sys.stderr, str(self.addr) + ": " + str(e)
+            self._outbound.clear()
             self.shutdown(non_blocking=True)
         # ------ exit critical section -------
         self._write_lock.release()
     
+    def shutdown_when_flushed(self):
+        """Shut the connection down once the frames queued are sent
+        (or after max_lag seconds, if the client does not read them)."""
+        self._write_lock.acquire()
+        # ------ enter critical section ------
+        self._closing = True
+        is_empty = not self._outbound
+        # ------ exit critical section -------
+        self._write_lock.release()
+        if is_empty:
+            self.shutdown(non_blocking=True)
+        else:
+            get_timer_wheel().add(event_loop.monotonic() + self.__class__.max_lag,
+                self.shutdown, (True, ))
+    
+    def get_send_stats(self):
+        """Get the outbound queue depth and drop counters of this connection"""
+        return self._outbound.get_stats()
+    
+    def _flush(self):
+        """Send as much of the queued frames as the socket accepts.
+        Must be called with the write lock held."""
+        try:
+            is_empty = self._outbound.flush(self.conn)
+        except socket.error, e:
+            self._outbound.clear()
+            self.shutdown(non_blocking=True)
+            return
+        if is_empty and self._closing:
+            self.shutdown(non_blocking=True)
+    
     @classmethod
     def _get_new_id(cls):
         """create a fresh id for a new client"""
@@ -0,0 +1,194 @@
+from gameconst import *
+import event_loop
+
+import sys
+import threading
+import time
+import traceback
+
+class WheelTimer(object):
+    """A call scheduled on a timer wheel.
+    Cancelling it removes it from the wheel right away."""
+
+    def __init__(self, wheel, deadline, fun, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.fun = fun
+        self.args = args
+        # the wheel tick the timer expires on
+        self.tick = None
+
+    def cancel(self):
+        self.wheel.remove(self)
+
+
+class TimerWheel(object):
+    """A hashed timer wheel, for the many long deadlines (such as the idle
+    timeouts of the connections) which are pushed back far more often than
+    they expire.
+    The time is cut into ticks of tick_length seconds, and each timer is put
+    in the slot of its tick modulo the number of slots: adding or cancelling
+    a timer is O(1), and a timer expires at most one tick late.
+    The wheel is driven by the event loop (or by its own thread if the event
+    loop is not used), and only wakes up when a non-empty slot is due."""
+    # the time resolution of the wheel (in sec)
+    tick_length = 1.0
+    # the number of slots (the timers more than n_slots ticks ahead stay in
+    # their slot until their turn comes)
+    n_slots = 512
+    # tells whether the wheel thread should be stopped when the main thread is done
+    daemon_threads = True
+
+    def __init__(self):
+        self._slots = [set() for i in xrange(self.n_slots)]
+        self._n_timers = 0
+        # the last tick processed
+        self._tick = self._get_tick(event_loop.monotonic())
+        self._lock = threading.Lock()
+        # the event loop driving the wheel (None if it has its own thread)
+        self.loop = None
+        # the loop timer set at the next non-empty slot
+        self._timer = None
+
+    def _get_tick(self, t):
+        return int(t // self.tick_length)
+
+    def add(self, deadline, fun, args=()):
+        """Call fun(*args) when the deadline (on the monotonic clock) is
+        passed, at most one tick late.
+        Returns the WheelTimer, which can be cancelled."""
+        timer = WheelTimer(self, deadline, fun, args)
+        # round up, so that the timer never expires early
+        tick = -self._get_tick(-deadline)
+        self._lock.acquire()
+        # ------ enter critical section ------
+        # a deadline already passed expires on the next tick
+        timer.tick = max(tick, self._tick + 1)
+        self._slots[timer.tick % self.n_slots].add(timer)
+        self._n_timers += 1
+        # ------ exit critical section -------
+        self._lock.release()
+        if self.loop is not None and (self._timer is None or
+                self._timer.deadline > timer.tick * self.tick_length):
+            self.loop.call_soon_threadsafe(self._arm_timer)
+        return timer
+
+    def remove(self, timer):
+        """Cancel a timer (nothing happens if it already expired)"""
+        self._lock.acquire()
+        # ------ enter critical section ------
+        slot = self._slots[timer.tick % self.n_slots]
+        if timer in slot:
+            slot.remove(timer)
+            self._n_timers -= 1
+        # ------ exit critical section -------
+        self._lock.release()
+
+    def __len__(self):
+        return self._n_timers
+
+    def advance(self):
+        """Expire every timer whose tick has passed"""
+        now_tick = self._get_tick(event_loop.monotonic())
+        expired = []
+        self._lock.acquire()
+        # ------ enter critical section ------
+        first_tick = self._tick + 1
+        # (each slot only has to be visited once)
+        last_tick = min(now_tick, first_tick + self.n_slots - 1)
+        for tick in xrange(first_tick, last_tick + 1):
+            slot = self._slots[tick % self.n_slots]
+            due = [t for t in slot if t.tick <= now_tick]
+            slot.difference_update(due)
+            expired.extend(due)
+        self._n_timers -= len(expired)
+        self._tick = max(self._tick, now_tick)
+        # ------ exit critical section -------
+        self._lock.release()
+        for timer in expired:
+            try:
+                timer.fun(*timer.args)
+            except Exception:
+                if VERBOSE: traceback.print_exc(file=sys.stderr)
+
+    def next_tick(self):
+        """Get the earliest tick a timer expires on (None if there is none)"""
+        self._lock.acquire()
+        # ------ enter critical section ------
+        next_tick = None
+        if self._n_timers:
+            for tick in xrange(self._tick + 1, self._tick + self.n_slots + 1):
+                slot = self._slots[tick % self.n_slots]
+                if not slot:
+                    continue
+                earliest = min(t.tick for t in slot)
+                if next_tick is None or earliest < next_tick:
+                    next_tick = earliest
+                # (the slot may only hold timers of the next rounds)
+                if earliest == tick:
+                    break
+        # ------ exit critical section -------
+        self._lock.release()
+        return next_tick
+
+    def start(self):
+        """Run the wheel in its own thread"""
+        t = threading.Thread(target=self.run_forever, args=())
+        t.daemon = self.daemon_threads
+        t.start()
+        return t
+
+    def run_forever(self):
+        """Expire the timers tick after tick, forever"""
+        while True:
+            # wake up at the beginning of the next tick
+            now = event_loop.monotonic()
+            time.sleep((self._get_tick(now) + 1) * self.tick_length - now)
+            if self._n_timers:
+                self.advance()
+
+    def attach(self, loop):
+        """Let the event loop drive the wheel"""
+        self.loop = loop
+        loop.call_soon_threadsafe(self._arm_timer)
+
+    def _arm_timer(self):
+        """Set the loop timer at the next non-empty slot.
+        Runs on the loop's thread."""
+        next_tick = self.next_tick()
+        deadline = next_tick * self.tick_length if next_tick is not None else None
+        if self._timer is not None:
+            if self._timer.deadline == deadline:
+                return
+            self._timer.cancel()
+        self._timer = None
+        if deadline is not None:
+            self._timer = self.loop.call_at(deadline, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.advance()
+        self._arm_timer()
+
+
+# the wheel shared by every connection of this process
+_shared_wheel = None
+_shared_wheel_lock = threading.Lock()
+
+def get_timer_wheel():
+    """Get the timer wheel shared by every connection of this process.
+    It is created on the first call, and driven by the shared event loop
+    (or by its own thread if the event loop is not used)."""
+    global _shared_wheel
+    _shared_wheel_lock.acquire()
+    # ------ enter critical section ------
+    if _shared_wheel is None:
+        _shared_wheel = TimerWheel()
+        if USE_EVENT_LOOP:
+            _shared_wheel.attach(event_loop.get_event_loop())
+        else:
+            _shared_wheel.start()
+    wheel = _shared_wheel
+    # ------ exit critical section -------
+    _shared_wheel_lock.release()
+    return wheel
@@ -0,0 +1,210 @@
+from gameconst import *
+import event_loop
+import enum
+
+import heapq
+import sys
+import threading
+import time
+import traceback
+
+OverrunPolicy = enum.enum("OverrunPolicy",
+    # drop the ticks whose deadline has already passed and wait for the next one
+    SKIP = 1,
+    # run the late ticks back to back until the task is on schedule again
+    CATCH_UP = 2
+)
+
+
+class PeriodicTask(object):
+    """A function called by the scheduler every interval seconds.
+    The deadline of each tick is a multiple of the interval after the first
+    one, so that the period does not drift whatever the time spent in fun."""
+
+    def __init__(self, interval, fun, args, deadline):
+        self.interval = interval
+        self.fun = fun
+        self.args = args
+        # the deadline of the next tick (on the monotonic clock)
+        self.deadline = deadline
+        self.cancelled = False
+        # stats
+        self.n_ticks = 0
+        self.n_skipped = 0
+        # how late (in sec) the current/last tick was run
+        self.lateness = 0.0
+        self.max_lateness = 0.0
+
+    def cancel(self):
+        """Stop calling the task (the scheduler drops it on its next deadline)"""
+        self.cancelled = True
+
+    def get_stats(self):
+        return {
+            'ticks': self.n_ticks,
+            'skipped': self.n_skipped,
+            'lateness': self.lateness,
+            'max_lateness': self.max_lateness,
+        }
+
+
+class TurnScheduler(object):
+    """Calls any number of periodic tasks (such as the turns of every party)
+    at absolute deadlines on a monotonic clock (event_loop.monotonic, which
+    reads CLOCK_MONOTONIC on Python 2), so that a step of the wall clock
+    neither stalls nor bursts the turns.
+    The tasks are kept in a heap ordered by deadline. The scheduler either
+    runs in its own thread or on the event loop, so that a single thread
+    drives the turns of all the parties."""
+    # what to do with the ticks of a task whose deadline has already passed
+    overrun_policy = OverrunPolicy.SKIP
+    # a tick later than this (in sec) is reported on the console
+    late_warning = 0.05
+    # max time (in sec) the scheduler thread sleeps before checking
+    # for new tasks
+    poll_interval = 0.05
+    # tells whether the scheduler thread should be stopped when the main thread is done
+    daemon_threads = True
+
+    def __init__(self):
+        # a heap of (deadline, sequence no, task)
+        self._tasks = []
+        self._task_seq = 0
+        self._lock = threading.Lock()
+        # the event loop driving the scheduler (None if it has its own thread)
+        self.loop = None
+        # the loop timer set at the earliest deadline
+        self._timer = None
+
+    def add_periodic(self, interval, fun, args=()):
+        """Call fun(*args) every interval seconds, starting in interval secs.
+        If fun returns False, it will not be called anymore.
+        Returns the PeriodicTask, which can be cancelled."""
+        task = PeriodicTask(interval, fun, args, event_loop.monotonic() + interval)
+        self._lock.acquire()
+        # ------ enter critical section ------
+        self._push(task)
+        # ------ exit critical section -------
+        self._lock.release()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._arm_timer)
+        return task
+
+    def _push(self, task):
+        self._task_seq += 1
+        heapq.heappush(self._tasks, (task.deadline, self._task_seq, task))
+
+    def run_due(self):
+        """Run every tick whose deadline has passed.
+        Returns the earliest deadline to come (None if there is no task)."""
+        while True:
+            self._lock.acquire()
+            # ------ enter critical section ------
+            task = None
+            now = event_loop.monotonic()
+            if self._tasks and self._tasks[0][0] <= now:
+                task = heapq.heappop(self._tasks)[2]
+            next_deadline = self._tasks[0][0] if self._tasks else None
+            # ------ exit critical section -------
+            self._lock.release()
+            if task is None:
+                return next_deadline
+            if not task.cancelled:
+                self._tick(task, now)
+
+    def _tick(self, task, now):
+        """Run one tick of the task and schedule the next one"""
+        task.lateness = now - task.deadline
+        task.max_lateness = max(task.max_lateness, task.lateness)
+        task.n_ticks += 1
+        if task.lateness > self.late_warning and VERBOSE:
+            print >> sys.stderr, "tick %d of %s late by %d ms" % (task.n_ticks,
+                getattr(task.fun, '__name__', task.fun), task.lateness * 1000)
+        try:
+            keep_going = task.fun(*task.args)
+        except Exception:
+            if VERBOSE: traceback.print_exc(file=sys.stderr)
+            keep_going = True
+        if keep_going is False or task.cancelled:
+            return
+        task.deadline += task.interval
+        now = event_loop.monotonic()
+        if task.deadline <= now and self.overrun_policy == OverrunPolicy.SKIP:
+            # skip the ticks which are already over
+            late_ticks = int((now - task.deadline) / task.interval) + 1
+            task.deadline += late_ticks * task.interval
+            task.n_skipped += late_ticks
+        self._lock.acquire()
+        # ------ enter critical section ------
+        self._push(task)
+        # ------ exit critical section -------
+        self._lock.release()
+
+    def start(self):
+        """Run the scheduler in its own thread"""
+        t = threading.Thread(target=self.run_forever, args=())
+        t.daemon = self.daemon_threads
+        t.start()
+        return t
+
+    def run_forever(self):
+        """Run the ticks as their deadlines come, forever"""
+        while True:
+            next_deadline = self.run_due()
+            delay = self.poll_interval
+            if next_deadline is not None:
+                delay = min(delay, next_deadline - event_loop.monotonic())
+            if delay > 0:
+                time.sleep(delay)
+
+    def attach(self, loop):
+        """Let the event loop drive the scheduler"""
+        self.loop = loop
+        loop.call_soon_threadsafe(self._arm_timer)
+
+    def _arm_timer(self):
+        """Set the loop timer at the earliest deadline.
+        Runs on the loop's thread."""
+        self._lock.acquire()
+        # ------ enter critical section ------
+        next_deadline = self._tasks[0][0] if self._tasks else None
+        # ------ exit critical section -------
+        self._lock.release()
+        if self._timer is not None:
+            if self._timer.deadline == next_deadline:
+                return
+            self._timer.cancel()
+        self._timer = None
+        if next_deadline is not None:
+            self._timer = self.loop.call_at(next_deadline, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.run_due()
+        self._arm_timer()
+
+
+# the scheduler shared by every party of this process
+_shared_scheduler = None
+_shared_scheduler_lock = threading.Lock()
+
+def get_turn_scheduler():
+    """Get the scheduler shared by every party of this process.
+    It is created on the first call, and driven by the shared event loop
+    (or by its own thread if the event loop is not used)."""
+    global _shared_scheduler
+    _shared_scheduler_lock.acquire()
+    # ------ enter critical section ------
+    if _shared_scheduler is None:
+        if not event_loop.IS_MONOTONIC and VERBOSE:
+            print >> sys.stderr, ("no monotonic clock on this platform: " +
+                "the turns follow the wall clock")
+        _shared_scheduler = TurnScheduler()
+        if USE_EVENT_LOOP:
+            _shared_scheduler.attach(event_loop.get_event_loop())
+        else:
+            _shared_scheduler.start()
+    scheduler = _shared_scheduler
+    # ------ exit critical section -------
+    _shared_scheduler_lock.release()
+    return scheduler